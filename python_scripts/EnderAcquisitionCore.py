@@ -1,3 +1,17 @@
+import os
+
+from acquisition_plan import AcquisitionPlan, CostModel, PlanExecutor, summary
+from ender_log import get_logger
+from focus_map import FocusMap, anchor_grid, build_focus_map
+from focus_tracker import FocusTracker
+from path_order import PathOptimizer
+from tile_pipeline import TilePipeline
+from frame_writer import FrameWriter
+from zstack import ZStackEngine
+
+logger = get_logger('acquisition')
+
+
 class EnderAcquisitionCore:
     def __init__(self, stage, camera):
         self.positions = []
@@ -5,11 +19,22 @@ class EnderAcquisitionCore:
         self.mosaic_settings = {"rows": 0, "columns": 0}
         self.stage = stage
         self.camera = camera
+        self.focus_map = None
+        # Focus of each position remembered from one timelapse frame to the next
+        self.focus_tracker = FocusTracker(stage, camera.core.autofocus) if camera is not None else None
+        self.events = []
+        self.executor = None
+        # Visiting orders, cached across the compilations of a plan
+        self.path_optimizer = PathOptimizer(stage.motion) if stage is not None else None
+        self.cost_model = CostModel(stage.motion) if stage is not None else None
 
     
-    def save_position(self, position):
-        """Save a position."""
-        self.positions.append(position, self.stage.get_position())
+    def save_position(self, name=None):
+        """Save the current stage position, as {'name', 'x', 'y', 'z'}."""
+        position = dict(self.stage.position)
+        position['name'] = name or f"Position {len(self.positions) + 1}"
+        self.positions.append(position)
+        return position
     
     def delete_position(self, position):
         """Delete a specific position."""
@@ -21,9 +46,8 @@ class EnderAcquisitionCore:
         self.positions.clear()
     
     def go_to_position(self, position):
-        """Simulate going to a position."""
-        for pos in self.positions:
-            self.stage_move_absolute(pos) 
+        """Move the stage to a saved position."""
+        self.stage.move_absolute(position['x'], position['y'], position['z'])
     
     def set_timelapse(self, frame, interval):
         """Set time-lapse settings."""
@@ -35,35 +59,112 @@ class EnderAcquisitionCore:
         self.mosaic_settings['rows'] = rows
         self.mosaic_settings['columns'] = columns
     
-    def execute(self):
-        """Simulate the GO action."""
-        print("Executing acquisition with the following settings:")
-        print(f"Positions: {self.positions}")
-        print(f"Timelapse: {self.timelapse_settings}")
-        print(f"Mosaic: {self.mosaic_settings}")
+    def focus_map_anchors(self, plan, columns=3, rows=3):
+        """Anchors covering the mosaic of every position of `plan`, in travel-time order.
+
+        Each mosaic gets a `columns` x `rows` anchor_grid over its tile
+        centres (a single anchor along a dimension with one tile).
+        """
+        positions = plan.positions or [dict(self.stage.position)]
+        anchors = []
+        for position in positions:
+            x_min, x_max, y_min, y_max = plan.mosaic_bounds(position)
+            grid = anchor_grid(x_min, x_max, y_min, y_max,
+                               columns if x_max > x_min else 1, rows if y_max > y_min else 1)
+            anchors.extend(anchor for anchor in grid if anchor not in anchors)
+        if self.path_optimizer is not None and len(anchors) > 2:
+            order, _ = self.path_optimizer.order([(x, y, 0.0) for x, y in anchors],
+                                                 start=dict(self.stage.position))
+            anchors = [anchors[index] for index in order]
+        return anchors
+
+    def prepare_focus_map(self, anchors, model='plane', path=None, reuse=False):
+        """Focus map used instead of autofocusing every tile, see focus_map.
+
+        With `reuse`, a map saved at `path` by a previous run is loaded if it
+        was built on the same anchors; otherwise the anchors are autofocused
+        and the new map is saved there.
+        """
+        if reuse and path is not None and os.path.exists(path):
+            focus_map = FocusMap.load(path)
+            if focus_map.covers(anchors):
+                self.focus_map = focus_map
+                logger.info(f"Focus map loaded from {path}")
+                return self.focus_map
+            logger.warning(f"Focus map in {path} was built on other anchors, measuring a new one")
+        self.focus_map = build_focus_map(self.stage, self.camera.core.autofocus, anchors, model)
+        if path is not None:
+            self.focus_map.save(path)
+        return self.focus_map
+
+    def focus_tile(self):
+        """Bring the current tile into focus, from the focus map when there is one."""
+        if self.focus_map is None:
+            return self.focus_tracker.focus().z
+        position = self.stage.position
+        z = self.focus_map.refine(position['x'], position['y'], self.camera.core.autofocus)
+        self.stage.move_absolute(position['x'], position['y'], z)
+        return z
+
+    def make_plan(self, use_positions=True, **settings):
+        """AcquisitionPlan over the saved positions (or the current one), see acquisition_plan."""
+        positions = [dict(position) for position in self.positions] if use_positions and self.positions else None
+        settings.setdefault('optimizer', self.path_optimizer)
+        return AcquisitionPlan(positions=positions, **settings)
+
+    def run_plan(self, plan, lights=None, writer=None, progress=None):
+        """Compile and run a plan; resume() continues it after an interruption.
+
+        With several channels, the channel loop is placed where the cost
+        model predicts the shortest run (AcquisitionPlan.choose_order).
+        """
+        if len(plan.channels) > 1:
+            self.cost_model.exposure = self.camera.core.exposure
+            plan.choose_order(self.cost_model, dict(self.stage.position))
+        self.events = plan.compile(dict(self.stage.position))
+        logger.info(f"Acquisition plan: {summary(self.events)}")
+        self.executor = PlanExecutor(self.stage, self.camera.core, lights, writer,
+                                     focus=self.focus_tile if plan.autofocus else None, progress=progress)
+        return self.executor.run(self.events)
+
+    def resume(self):
+        """Run the events of the last plan not done yet."""
+        return self.executor.run(self.events, start=self.executor.done)
+
+    def acquire_tiles(self, tiles, path, writer, correct=None, autofocus=False):
+        """Mosaic of tiles {'x', 'y'[, 'z']} where the move to the next tile overlaps
+        the correction and writing of the current one, see tile_pipeline.
+
+        :returns: the report of TilePipeline.run (tiles/min, occupancy of each stage)
+        """
+        pipeline = TilePipeline(self.stage, self.camera.core, writer, correct=correct,
+                                focus=self.focus_tile if autofocus else None)
+        return pipeline.run(tiles, path)
+
+    def execute(self, lights=None):
+        """Run the timelapse and mosaic settings over the saved positions."""
+        logger.info("Executing acquisition with the following settings:")
+        logger.info(f"Positions: {self.positions}")
+        logger.info(f"Timelapse: {self.timelapse_settings}")
+        logger.info(f"Mosaic: {self.mosaic_settings}")
+        plan = self.make_plan(time_points=max(1, self.timelapse_settings['frame']),
+                              interval=self.timelapse_settings['interval'],
+                              tiles=(max(1, self.mosaic_settings['rows']), max(1, self.mosaic_settings['columns'])))
+        return self.run_plan(plan, lights)
 
     
     
-    def ZStack(self, nSlices=None, step=None, path=None):
-        import time
-        """Perform Z-Stack acquisition."""
-        nSlices = nSlices #50
-        step = step #0.001
-        z_start = (nSlices*step + step)/2 
-        self.stage.move_relative(0, 0, z_start)
-        
-        path = path
-        #path = "240920_ZStacks/TEST_"
-        
-        for s in range(nSlices):
-            self.stage.move_relative(0, 0, -step)
-            time.sleep(0.1)
-            name = f"{path}_{s}.tif"
-            self.camera.core.capture(path=name)
-            time.sleep(self.camera.core.exposure/1000000 + 0.1)  # Wait for exposure
-            
-
-
-
-        
-        
\ No newline at end of file
+    def ZStack(self, nSlices=None, step=None, path=None, writer=None):
+        """Perform Z-Stack acquisition around the current Z, from the top down.
+
+        Slices are saved as `{path}_{n}.tif`, slice 0 being the top one, see zstack.
+        """
+        if writer is None:
+            with FrameWriter() as writer:
+                return self.ZStack(nSlices, step, path, writer)
+        return ZStackEngine(self.stage, self.camera.core, writer).run(nSlices, step, path)
+
+    def ZStack_positions(self, nSlices, step, path, writer, snake=True):
+        """One Z-stack per saved position; with `snake` the stage never rewinds Z between them."""
+        engine = ZStackEngine(self.stage, self.camera.core, writer)
+        return engine.run_positions(self.positions, nSlices, step, path, snake=snake)
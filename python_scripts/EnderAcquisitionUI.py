@@ -1,13 +1,23 @@
 import ipywidgets as widgets
 from EnderAcquisitionCore import EnderAcquisitionCore
+from acquisition_plan import Channel
+from frame_writer import FrameWriter
 import os
 
+def light_core(light):
+    """EnderPiLightCore behind an EnderPiLight wrapper, an EnderPiLightUI or the core itself."""
+    light = getattr(light, 'light', light)
+    return getattr(light, 'core', light)
+
+
 class EnderAcquisitionUI:
     def __init__(self, title="EnderAcquisition", stage=None, camera=None, lightBF=None, lightFluo=None):
         self.core = EnderAcquisitionCore(stage=stage, camera=camera)
         self.title = title
         self.lightBF=lightBF
         self.light_fluo=lightFluo
+        # Images are written in the background while the stage moves on
+        self.writer = FrameWriter()
         
         # Multipos UI
         self.checkbox_multipos = widgets.Checkbox()
@@ -26,6 +36,8 @@ class EnderAcquisitionUI:
         self.checkbox_mosaic = widgets.Checkbox()
         self.rows_input = widgets.IntText(description="Rows")
         self.columns_input = widgets.IntText(description="Columns")
+        self.checkbox_focus_map = widgets.Checkbox(description="Focus map (autofocus on 3x3 anchors only)")
+        self.checkbox_reuse_focus_map = widgets.Checkbox(description="Reuse the saved focus map")
 
         # Z Stack
         self.checkbox_zStack = widgets.Checkbox()
@@ -54,7 +66,8 @@ class EnderAcquisitionUI:
         self.accordion = widgets.Accordion(children=[
             widgets.VBox([self.checkbox_multipos, self.save_button, self.delete_button, self.reset_button, self.go_button, self.position_table]),
             widgets.VBox([self.checkbox_timelpase, self.frame_input, self.interval_input]),
-            widgets.VBox([self.checkbox_mosaic, self.rows_input, self.columns_input]),
+            widgets.VBox([self.checkbox_mosaic, self.rows_input, self.columns_input, self.checkbox_focus_map,
+                         self.checkbox_reuse_focus_map]),
             widgets.VBox([self.checkbox_zStack, self.nSlices, self.stepSize])
         ])
         self.accordion.set_title(0, "Multipos")
@@ -70,8 +83,7 @@ class EnderAcquisitionUI:
         self.go_acquisition_button.on_click(self.on_go_acquisition)
         
     def on_save_position(self, _):
-        position = f"Position {len(self.core.positions) + 1}_{self.stage.get_position()}"
-        self.core.save_position(position)
+        self.core.save_position()
         self.update_position_table()
         
     def on_delete_position(self, _):
@@ -91,115 +103,42 @@ class EnderAcquisitionUI:
         directory = self.file_picker.value
         if not os.path.exists(directory):
             os.makedirs(directory)
-            
-        self.lightBF.core.toggle() #ON
-        #____________________
-        # MATTHIEU ACQUI INIT
-        #exposure = 500000 / gain = 2
-        self.light_fluo.core.set_rgb_color(0, 0, 255)
-        self.light_fluo.core.set_intensity(1)
-        self.lightBF.core.set_rgb_color(255, 255, 255)
-        self.lightBF.core.set_intensity(1)
-        self.lightBF.core.toggle() #ON
-        #____________________
 
+        # MATT SETTINGS: fluorescence under blue light, then bright field at half intensity
+        channels = [
+            Channel('GFP', light='fluo', color=(0, 0, 255), intensity=1.0, fluorescence=True),
+            Channel('BF', light='bf', color=(255, 255, 255), intensity=0.5),
+        ]
+        plan = self.core.make_plan(
+            use_positions=self.checkbox_multipos.value,
+            time_points=self.frame_input.value if self.checkbox_timelpase.value else 1,
+            interval=self.interval_input.value if self.checkbox_timelpase.value else 0,
+            tiles=(self.rows_input.value, self.columns_input.value) if self.checkbox_mosaic.value else (1, 1),
+            z_slices=self.nSlices.value if self.checkbox_zStack.value else 1,
+            z_step=self.stepSize.value,
+            channels=channels,
+            directory=directory,
+            name="gfp"
+        )
+        if self.checkbox_focus_map.value:
+            # Measured once over the mosaic of every position, reused by every tile and timelapse frame
+            self.outputMessage.value = "Focus map..."
+            start = dict(self.core.stage.position)
+            self.core.prepare_focus_map(self.core.focus_map_anchors(plan),
+                                        path=os.path.join(directory, "focus_map.json"),
+                                        reuse=self.checkbox_reuse_focus_map.value)
+            self.core.stage.move_absolute(start['x'], start['y'], start['z'])
+        lights = {'fluo': light_core(self.light_fluo), 'bf': light_core(self.lightBF)}
 
-        
-        if sel.checkbox_timelapse.value == True:
-            self.outputMessage.value = "Timelpase lets_go !"
-            nFrames = self.frame_input.value, 
-            interval = self.interval_input.value
-            self.outputMessage.value = "Time ok !"
-
-        else:
-            nFrames = 1
-            interval = 1
-
-            for frame in range(nFrames):
-                if self.checkbox_multipos.value == True:
-                    self.outputMessage.value = "multipos lets_go to"
-                    nbPos = self.core.positions.lenth()
-                else:
-                    nbPos = 1
-                for pos in range(nPos):
-                    self.stage_move_absolute(positions[pos]) 
-                    self.outputMessage.value = "positionOK"
-                
-                if self.checkbox_mosaic == True:
-                    self.outputMessage.value = "mosaic lets_go to"
-                    nbRows = self.rows_input
-                    nbCols = self.columns_input
-                else:
-                    nbRows = 1
-                    nbCols = 1
-                    
-                # Boucle en X
-                direction = 1
-                pas = 1.5
-                n = nbRows
-                for i in range(n**2):
-                    #HERE IMAGE
-                    if i%n == 0:
-                        self.stage.move_relative(0,pas,0)
-                        #gcode = "G0 Y"+ str(pas) + "\n"
-                        direction *= -1
-                    self.stage.move_relative(pas * direction,0,0)
-                    #gcode = "G0 X" + str(pas * direction) + "\n"
-                    if direction < 0:
-                        nameMosa = "mosa_x"+str(n - i%n)+"_y"+str(i//n)+".tif"
-                    else:
-                        nameMosa = "mosa_x"+str(i%n)+"_y"+str(i//n)+".tif"
-                    
-                        # MATT SETTINGS
-                        nameFLUO = os.path.join(directory, f"gfp_{number}h00_GFP_exp-{exposure}s_gain{gain}_{nameMosa}.tif")
-                        nameBF = os.path.join(directory, f"gfp_{number}h00_BF_exp-{exposure}s_gain{gain}_{nameMosa}.tif")
-
-                        self.camera.core.autofocus()
-                        self.lightBF.core.toggle() #OFF
-                        time.sleep(0.2)
-                        self.light_fluo.core.toggle()  # Toggle light on
-                        
-                        time.sleep(0.2)
-                        self.camera.core.capture(path=nameFLUO)
-                        time.sleep(self.camera.core.exposure/1000000 + 0.1)  # Wait for exposure
-                        self.light_fluo.core.toggle()  # Toggle light off
-                        
-                        time.sleep(0.2)
-                        
-                        # Capture image BF
-                        self.lightBF.core.set_intensity(0.5)
-                        
-                        self.lightBF.core.toggle() # ON
-                        time.sleep(0.2)
-                        self.camera.core.capture(path=nameBF)
-                        time.sleep(self.camera.core.exposure/1000000 + 0.1)  # Wait for exposure
-                    
-                        # WAIT Growth for 1h00 !
-                        self.lightBF.core.set_intensity(1)
-                        
-            time.sleep(interval) #1h00
-            self.lightBF.core.toggle() #OFF
-            
-            #Z-STACK OK
-                    # if self.checkbox_zStack.value == True:
-                    #     self.outputMessage.value = "Z-stack let's go"
-                    #     self.core.ZStack(nSlices = self.nSlices.value, step= self.stepSize.value, path = self.file_picker.value )
-                    #     self.outputMessage.value = "ZSTack ok"
-                    #             # File picker
-                    # else:
-                    #     self.outputMessage.value = "button clicked but noting happend"
+        def progress(done, total, event):
+            self.outputMessage.value = f"{done}/{total} {event.kind}"
 
-            
-                #frame = self.frame_input.value
-        #interval = self.interval_input.value
-        #rows = self.rows_input.value
-        #columns = self.columns_input.value
-        #self.core.set_timelapse(frame, interval)
-        #self.core.set_mosaic(rows, columns)
-        #self.core.execute()
+        self.core.run_plan(plan, lights, self.writer, progress)
+        self.outputMessage.value = "Acquisition done"
 
     def update_position_table(self):
-        positions_html = "<br>".join(self.core.positions)
+        positions_html = "<br>".join(f"{p['name']}: X={p['x']}, Y={p['y']}, Z={p['z']}"
+                                     for p in self.core.positions)
         self.position_table.value = f"<b>Positions:</b> <br> {positions_html}"
         
     def get_controls(self):
@@ -1,15 +1,11 @@
+import logging
+
 import serial
-from serial_utils import SerialDevice, serial_ports
+from serial_utils import G_CODES, StageBase, serial_ports
+from ender_log import LogView
 import ipywidgets as widgets
 from IPython.display import display
 
-G_CODES = {
-    'absolute': 'G90',
-    'relative': 'G91',
-    'homing': 'G28',
-    'finish': 'M400',
-    'current_position': 'M114'
-}
 DIRECTION_PREFIXES = {
     "north": "Y",
     "south": "Y-",
@@ -21,12 +17,16 @@ DIRECTION_PREFIXES = {
 
 
 
-class Stage(SerialDevice):
+class Stage(StageBase):
     def __init__(self, port, baud_rate=115200, parity=serial.PARITY_NONE,
-                 stop_bits=serial.STOPBITS_ONE, byte_size=serial.EIGHTBITS):
-        super().__init__(port, baud_rate, parity, stop_bits, byte_size)
+                 stop_bits=serial.STOPBITS_ONE, byte_size=serial.EIGHTBITS,
+                 connection=None, use_async=False):
+        super().__init__(port, baud_rate, parity, stop_bits, byte_size,
+                         connection=connection, use_async=use_async)
+        # Logs of the stage (and of the camera, lights... sharing ender_log)
+        self.log_view = LogView()
+        self.output_area = self.log_view.textarea
         self.set_relative()
-        self.position = {'x': 0.0, 'y': 0.0, 'z': 0.0}
         self.sensitivityXY = 1.0  # Default sensitivity value
         self.sensitivityZ = 0.1  # Default sensitivity value
 
@@ -54,82 +54,21 @@ class Stage(SerialDevice):
         )
         self.sensitivityZ_slider.observe(self.update_sensitivityZ, names='value')
 
-    def get_position(self, dict=False, debug=False):
-        self.flush_serial_buffer()
-        response = self.write_code(G_CODES['current_position'],
-                                   check_ok=False)
-        if debug:
-            print(response)
-        ok = self.serial.readline()
-        if not ok.decode('utf-8').startswith("ok"):
-            print("Error reading stage position")
-            return
-        position = response.split(" Count")[0]
-        parts = position.split()
-        positions = {part.split(":")[0]: float(part.split(":")[1]) for part in parts}
-        if dict==False:
-            order = ['X','Y', 'Z']
-            positions = tuple([positions[field] for field in order])
-        return positions
-
     
     def update_sensitivityXY(self, change):
         """Update the sensitivity based on slider value."""
         self.sensitivityXY = change['new']
-        print(f"Stage sensitivity set to {self.sensitivityXY:.2f}")
+        self.log(f"Stage sensitivity set to {self.sensitivityXY:.2f}")
 
     def update_sensitivityZ(self, change):
         """Update the sensitivity based on slider value."""
         self.sensitivityZ = change['new']
-        print(f"Stage sensitivity set to {self.sensitivityZ:.2f}")
-
-    def write_code(self, code, check_ok=True, debug=False):
-        super().write_code(code)
-        response = self.serial.readline().decode('utf-8')
-        if check_ok:
-            while not response.startswith("ok"):
-                if debug:
-                    print(response.strip('\n'))
-                response = self.serial.readline().decode('utf-8')
-        if debug:
-            print(code)
-        return response
+        self.log(f"Stage sensitivity set to {self.sensitivityZ:.2f}")
 
     def temp(self, temp, debug=False):
         code = f"M190 S{temp-1} R{temp+1}"
         self.write_code(code, debug=debug)
         
-    def move_absolute(self, x, y, z=None, debug=False):
-        self.set_absolute()
-        if z is None:
-            code = f"G0 X {x} Y {y}"
-        else:
-            code = f"G0 X {x} Y {y} Z {z}"
-        self.write_code(code, debug=debug)
-        self.position = {'x': x, 'y': y, 'z': z if z is not None else self.position['z']}
-
-    def move_relative(self, x, y, z=None, debug=False):
-        self.set_relative(debug=debug)
-        if z is None:
-            code = f"G0 X {x} Y {y}"
-        else:
-            code = f"G0 X {x} Y {y} Z {z}"
-        self.write_code(code, debug=debug)
-        self.position['x'] += x
-        self.position['y'] += y
-        if z is not None:
-            self.position['z'] += z
-
-    def home(self, debug=False):
-        self.write_code('G28', debug=debug)
-        self.position = {'x': 0.0, 'y': 0.0, 'z': 0.0}
-
-    def set_relative(self, debug=False):
-        self.write_code('G91', debug=debug)
-
-    def set_absolute(self, debug=False):
-        self.write_code('G90', debug=debug)
-
     def get_controls(self):
         def create_icon_button(icon, description, color):
             button = widgets.Button(
@@ -155,9 +94,9 @@ class Stage(SerialDevice):
                 x = float(x_input.value)
                 y = float(y_input.value)
                 z = float(z_input.value)
-                self.move_absolute(x, y, z)
+                self.in_background(self.move_absolute, x, y, z)
             except ValueError:
-                print("Please enter valid numeric values for X, Y, and Z.")
+                self.log("Please enter valid numeric values for X, Y, and Z.", logging.ERROR)
 
         x_input = create_simple_floattext('X:', self.position['x'])
         y_input = create_simple_floattext('Y:', self.position['y'])
@@ -180,13 +119,14 @@ class Stage(SerialDevice):
         up_button = create_icon_button('arrow-up', 'Move Up (Z+)', 'lightgreen')
         down_button = create_icon_button('arrow-down', 'Move Down (Z-)', 'lightgreen')
 
-        north_button.on_click(lambda b: self.move_relative(0, 1*self.sensitivityXY))
-        south_button.on_click(lambda b: self.move_relative(0, -1*self.sensitivityXY))
-        west_button.on_click(lambda b: self.move_relative(-1*self.sensitivityXY, 0))
-        east_button.on_click(lambda b: self.move_relative(1*self.sensitivityXY, 0))
-        home_button.on_click(lambda b: self.home())
-        up_button.on_click(lambda b: self.move_relative(0, 0, 1*self.sensitivityZ))
-        down_button.on_click(lambda b: self.move_relative(0, 0, -1*self.sensitivityZ))
+        # Clicks are merged into one move by the jogger, see jog_coalescer
+        north_button.on_click(lambda b: self.jogger.jog(0, 1*self.sensitivityXY))
+        south_button.on_click(lambda b: self.jogger.jog(0, -1*self.sensitivityXY))
+        west_button.on_click(lambda b: self.jogger.jog(-1*self.sensitivityXY, 0))
+        east_button.on_click(lambda b: self.jogger.jog(1*self.sensitivityXY, 0))
+        home_button.on_click(lambda b: self.home_from_ui())
+        up_button.on_click(lambda b: self.jogger.jog(0, 0, 1*self.sensitivityZ))
+        down_button.on_click(lambda b: self.jogger.jog(0, 0, -1*self.sensitivityZ))
 
         movement_controls = widgets.GridBox(
             children=[
@@ -237,7 +177,8 @@ class Stage(SerialDevice):
             movement_controls,
             position_controls,
             sensitivityXY_controls,
-            sensitivityZ_controls
+            sensitivityZ_controls,
+            self.log_view.get_widget()
         ])
 
     def get_output(self):
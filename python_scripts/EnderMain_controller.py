@@ -1,15 +1,11 @@
+import logging
+
 import serial
-from serial_utils import SerialDevice, serial_ports
+from serial_utils import G_CODES, StageBase, serial_ports, serialized
+from ender_log import LogView
 import ipywidgets as widgets
 from IPython.display import display
 
-G_CODES = {
-    'absolute': 'G90',
-    'relative': 'G91',
-    'homing': 'G28',
-    'finish': 'M400',
-    'current_position': 'M114'
-}
 DIRECTION_PREFIXES = {
     "north": "Y",
     "south": "Y-",
@@ -19,12 +15,16 @@ DIRECTION_PREFIXES = {
     "down": "Z-"
 }
 
-class Stage(SerialDevice):
+class Stage(StageBase):
     def __init__(self, port, baud_rate=115200, parity=serial.PARITY_NONE,
-                 stop_bits=serial.STOPBITS_ONE, byte_size=serial.EIGHTBITS):
-        super().__init__(port, baud_rate, parity, stop_bits, byte_size)
+                 stop_bits=serial.STOPBITS_ONE, byte_size=serial.EIGHTBITS,
+                 connection=None, use_async=False):
+        super().__init__(port, baud_rate, parity, stop_bits, byte_size,
+                         connection=connection, use_async=use_async)
+        # Logs of the stage (and of the camera, lights... sharing ender_log)
+        self.log_view = LogView()
+        self.output_area = self.log_view.textarea
         #self.set_relative()
-        self.position = {'x': 0.0, 'y': 0.0, 'z': 0.0}
         self.sensitivityXY = 1.0  # Default sensitivity value
         self.sensitivityZ = 0.1  # Default sensitivity value
 
@@ -52,58 +52,23 @@ class Stage(SerialDevice):
         )
         self.sensitivityZ_slider.observe(self.update_sensitivityZ, names='value')
 
-        # Text area to display logs/output
-        self.output_area = widgets.Textarea(
-            value='',
-            placeholder='Logs will appear here...',
-            description='Output:',
-            layout=widgets.Layout(width='100%', height='100px')
-        )
-
-    def log(self, message):
-        """Helper function to log messages to the TextArea."""
-        self.output_area.value += f"{message}\n"
-        self.output_area.scroll_to_bottom()
-
     def write_code(self, code, check_ok=True, debug=False):
-        self.log(f"Sending command: {code}")
-        super().write_code(code)
-        response = self.serial.readline().decode('utf-8')
-        if check_ok:
-            while not response.startswith("ok"):
-                if debug:
-                    self.log(response.strip('\n'))
-                response = self.serial.readline().decode('utf-8')
-        if debug:
-            self.log(f"Response: {response.strip()}")
-        return response
-
-    def move_relative(self, x, y, z=None, debug=False):
-        self.set_relative(debug=debug)
-        if z is None:
-            code = f"G0 X {x} Y {y}"
-        else:
-            code = f"G0 X {x} Y {y} Z {z}"
-        self.write_code(code, debug=debug)
-        self.position['x'] += x
-        self.position['y'] += y
-        if z is not None:
-            self.position['z'] += z
+        self.log(f"Sending command: {code}", logging.DEBUG)
+        return super().write_code(code, check_ok=check_ok, debug=debug)
+
+    @serialized
+    def move_relative(self, x, y, z=None, feedrate=None, debug=False):
+        super().move_relative(x, y, z, feedrate=feedrate, debug=debug)
         self.log(f"Moved to relative position: X={self.position['x']}, Y={self.position['y']}, Z={self.position['z']}")
 
-    def move_absolute(self, x, y, z=None, debug=False):
-        self.set_absolute()
-        if z is None:
-            code = f"G0 X {x} Y {y}"
-        else:
-            code = f"G0 X {x} Y {y} Z {z}"
-        self.write_code(code, debug=debug)
-        self.position = {'x': x, 'y': y, 'z': z if z is not None else self.position['z']}
+    @serialized
+    def move_absolute(self, x, y, z=None, feedrate=None, debug=False):
+        super().move_absolute(x, y, z, feedrate=feedrate, debug=debug)
         self.log(f"Moved to absolute position: X={x}, Y={y}, Z={self.position['z']}")
 
+    @serialized
     def home(self, debug=False):
-        self.write_code('G28', debug=debug)
-        self.position = {'x': 0.0, 'y': 0.0, 'z': 0.0}
+        super().home(debug=debug)
         self.log("Homed stage to origin (0, 0, 0)")
 
     def get_controls(self):
@@ -131,9 +96,9 @@ class Stage(SerialDevice):
                 x = float(x_input.value)
                 y = float(y_input.value)
                 z = float(z_input.value)
-                self.move_absolute(x, y, z)
+                self.in_background(self.move_absolute, x, y, z)
             except ValueError:
-                self.log("Error: Invalid numeric values for X, Y, and Z")
+                self.log("Invalid numeric values for X, Y, and Z", logging.ERROR)
 
         x_input = create_simple_floattext('X:', self.position['x'])
         y_input = create_simple_floattext('Y:', self.position['y'])
@@ -158,13 +123,14 @@ class Stage(SerialDevice):
         down_button = create_icon_button('arrow-down', 'Move Down (Z-)', 'lightgreen')
 
         # Button actions
-        north_button.on_click(lambda b: self.move_relative(0, 1 * self.sensitivityXY))
-        south_button.on_click(lambda b: self.move_relative(0, -1 * self.sensitivityXY))
-        west_button.on_click(lambda b: self.move_relative(-1 * self.sensitivityXY, 0))
-        east_button.on_click(lambda b: self.move_relative(1 * self.sensitivityXY, 0))
-        home_button.on_click(lambda b: self.home())
-        up_button.on_click(lambda b: self.move_relative(0, 0, 1 * self.sensitivityZ))
-        down_button.on_click(lambda b: self.move_relative(0, 0, -1 * self.sensitivityZ))
+        # Clicks are merged into one move by the jogger, see jog_coalescer
+        north_button.on_click(lambda b: self.jogger.jog(0, 1 * self.sensitivityXY))
+        south_button.on_click(lambda b: self.jogger.jog(0, -1 * self.sensitivityXY))
+        west_button.on_click(lambda b: self.jogger.jog(-1 * self.sensitivityXY, 0))
+        east_button.on_click(lambda b: self.jogger.jog(1 * self.sensitivityXY, 0))
+        home_button.on_click(lambda b: self.home_from_ui())
+        up_button.on_click(lambda b: self.jogger.jog(0, 0, 1 * self.sensitivityZ))
+        down_button.on_click(lambda b: self.jogger.jog(0, 0, -1 * self.sensitivityZ))
 
         # Layout for movement controls
         movement_controls = widgets.GridBox(
@@ -217,7 +183,7 @@ class Stage(SerialDevice):
         # Return final layout including the output area
         final_layout = widgets.VBox([
             control_widget,
-            self.output_area
+            self.log_view.get_widget()
         ])
         return final_layout
 
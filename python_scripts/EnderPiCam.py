@@ -4,5 +4,5 @@ from EnderPiCamUI import EnderPiCamUI
 
 class EnderPiCam(EnderPiCamUI):
     def __init__(self, resolution=(256,256), exposure=10000, gain=4.0, title="EnderPiCam", ui=True, autofocus=False, stage=None):
-        super().__init__(resolution, exposure, gain, title, ui, stage, autofocus)
+        super().__init__(resolution, exposure, gain, title, ui, autofocus=autofocus, stage=stage)
         
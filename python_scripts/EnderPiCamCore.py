@@ -1,23 +1,52 @@
-import io
 from PIL import Image as PILImage, ImageFilter
-from picamera2 import Picamera2
+from picamera2 import MappedArray, Picamera2
 #from EnderPiAutofocus import EnderPiAutofocusCore
 import numpy as np
 import time
-import scipy.ndimage
+
+from ender_log import get_logger
+from autofocus import run_autofocus, sweep_autofocus
+from focus_metrics import DEFAULT_METRIC, focus_score
+from frame_pool import FramePool
+from frame_writer import to_image
+
+logger = get_logger('camera')
+
+# Shortest frame period in us (30 fps preview); longer exposures stretch it
+MIN_FRAME_DURATION = 33333
+
+
+def frame_duration_limits(exposure):
+    """FrameDurationLimits (us) allowing `exposure`, which is otherwise clamped to the frame period."""
+    return (MIN_FRAME_DURATION, max(MIN_FRAME_DURATION, int(exposure)))
 
 class EnderPiCamCore:
-    def __init__(self, resolution=(2028,1520), exposure=500000, gain=1.0, autofocus=False, stage=None):
+    def __init__(self, resolution=(2028,1520), exposure=500000, gain=1.0, autofocus=False, stage=None,
+                 lores_size=(640, 480)):
         self.picam2 = Picamera2()
         self.resolution = resolution
+        self.lores_size = lores_size
         self.exposure = exposure
         self.gain = gain
         self.autofocus_enabled = autofocus
         self.stage = stage  # Optional stage for autofocus
         self.scores = []
+        self._pools = {}
+        # Focus metric settings, see focus_metrics (roi is (x, y, width, height))
+        self.focus_metric = DEFAULT_METRIC
+        self.focus_roi = None
+        self.focus_decimate = 2
+        self.autofocus_strategy = 'coarse_to_fine'
 
-        # Configure the camera
-        self._config = self.picam2.create_still_configuration({'format': 'RGB888', 'size': self.resolution})
+        # Configure the camera: full resolution stills on 'main' and a small
+        # YUV420 'lores' stream for the preview, both running continuously so
+        # that switching between them needs no reconfiguration
+        self._config = self.picam2.create_video_configuration(
+            main={'format': 'RGB888', 'size': self.resolution},
+            lores={'format': 'YUV420', 'size': self.lores_size},
+            buffer_count=4,
+            controls={'FrameDurationLimits': frame_duration_limits(self.exposure)}
+        )
         self.picam2.configure(self._config)
         self.set_controls(exposure=self.exposure, gain=self.gain)
         self.picam2.start()
@@ -27,102 +56,158 @@ class EnderPiCamCore:
         if exposure is not None:
             self.exposure = exposure
             controls['ExposureTime'] = self.exposure
+            controls['FrameDurationLimits'] = frame_duration_limits(self.exposure)
         if gain is not None:
             self.gain = gain
             controls['AnalogueGain'] = self.gain
         self.picam2.set_controls(controls)
 
-    def capture(self, path=None, green=False):
-        """Capture a still image. If a path is provided, save the image to the specified path, else return it as a PIL image."""
-        buffer = io.BytesIO()
-        
-        # Capture the image to a buffer
-        self.picam2.capture_file(buffer, format='png')
-        buffer.seek(0)
-
-        # Open the image from the buffer
-        image = PILImage.open(buffer)
-        
+    def capture_array(self, green=False):
+        """Capture a still as a NumPy array, without any encoding.
+
+        RGB888 frames come out of picamera2 in BGR byte order: the returned
+        (H, W, 3) array is a view of the frame with the channel axis reversed
+        to RGB. If green is True, only the green plane (H, W) is returned,
+        also as a view.
+        """
+        array = self.picam2.capture_array('main')
         if green:
-            # Extract only the green channel and return it as a grayscale image
-            _, green_channel, _ = image.split()
-            image = green_channel
-        
+            return array[..., 1]
+        return array[..., ::-1]
+
+    def capture_lores(self):
+        """Next frame of the lores stream as a grayscale (H, W) uint8 array.
+
+        This is the Y (luminance) plane of the YUV420 frame, returned as a
+        view: no colour conversion and no copy.
+        """
+        array = self.picam2.capture_array('lores')
+        width, height = self.lores_size
+        return array[:height, :width]
+
+    def record_lores(self, stop):
+        """Lores frames until the `stop` threading.Event is set.
+
+        :returns: list of (time, Y plane) where time is the middle of the
+            exposure in time.monotonic() seconds, from the sensor timestamp
+        """
+        frames = []
+        width, height = self.lores_size
+        while not stop.is_set():
+            request = self.picam2.capture_request()
+            try:
+                frame = request.make_array('lores')[:height, :width]
+                metadata = request.get_metadata()
+            finally:
+                request.release()
+            frames.append((metadata['SensorTimestamp'] / 1e9 + metadata['ExposureTime'] / 2e6, frame))
+        return frames
+
+    def frame_pool(self, stream='main', size=4):
+        """FramePool matching a stream of the current configuration, created once."""
+        key = (stream, size)
+        if key not in self._pools:
+            self._pools[key] = FramePool.for_stream(self.picam2, stream, size)
+        return self._pools[key]
+
+    def next_request(self, after=None):
+        """Next completed request whose exposure started after `after` (time.monotonic() seconds).
+
+        Frames already being exposed when the stage stopped or a light
+        changed are dropped instead of waiting a fixed time.
+        """
+        while True:
+            request = self.picam2.capture_request()
+            if after is None or request.get_metadata()['SensorTimestamp'] / 1e9 >= after:
+                return request
+            request.release()
+
+    def capture_burst(self, count, pool=None, stream='main', after=None):
+        """Capture `count` consecutive frames into pooled buffers.
+
+        Yields frame_pool.Frame objects whose metadata holds the sensor
+        timestamp (ns), exposure time (us) and analogue gain of the image.
+        Each frame must be released by its consumer; when the pool is empty
+        the burst waits for a buffer to come back. The first frame is
+        exposed after `after`, see next_request.
+        """
+        pool = pool or self.frame_pool(stream)
+        for index in range(count):
+            frame = pool.acquire()
+            try:
+                request = self.next_request(after if index == 0 else None)
+                try:
+                    with MappedArray(request, stream) as mapped:
+                        height, width = frame.array.shape[:2]
+                        np.copyto(frame.array, mapped.array[:height, :width])
+                    metadata = request.get_metadata()
+                finally:
+                    request.release()
+            except Exception:
+                frame.release()
+                raise
+            frame.index = index
+            frame.metadata = {
+                'timestamp': metadata.get('SensorTimestamp'),
+                'exposure': metadata.get('ExposureTime'),
+                'gain': metadata.get('AnalogueGain'),
+            }
+            yield frame
+
+    def capture_frame(self, pool=None, stream='main', after=None):
+        """A single pooled frame, see capture_burst."""
+        return next(self.capture_burst(1, pool, stream, after))
+
+    def save(self, array, path, format='PNG', channel_order='RGB'):
+        """Save an array returned by capture_array (or a frame's BGR array), encoding it only now."""
+        to_image(array, channel_order).save(path, format)
+
+    def capture(self, path=None, green=False, writer=None, after=None):
+        """Capture a still image. If a path is provided, save the image to the specified path, else return it as a PIL image.
+
+        With a frame_writer.FrameWriter, the image is saved in the background:
+        capture returns as soon as the pixels are in memory, with the Future
+        of the write. `after` drops frames exposed before that time, see next_request.
+        """
+        if path and writer is not None:
+            frame = self.capture_frame(after=after)
+            if green:
+                return writer.submit(frame.green(), path, on_done=frame.release)
+            # BGR frame written as it is, without a reversed copy
+            return writer.submit(frame.array, path, on_done=frame.release, channel_order='BGR')
         if path:
-            # Save the image to the specified path
-            image.save(path, 'PNG')
-            print(f"Image saved to {path}")
+            # Save the image to the specified path, from a pooled buffer
+            with self.capture_frame(after=after) as frame:
+                if green:
+                    self.save(frame.green(), path)
+                else:
+                    self.save(frame.array, path, channel_order='BGR')
+            logger.info(f"Image saved to {path}")
+        elif green:
+            return to_image(self.capture_array(green=True))
+        else:
+            # Return the image as a PIL image, from the BGR frame
+            return to_image(self.picam2.capture_array('main'), 'BGR')
+
+    def focus_score(self, after=None):
+        """Focus score of the green channel of a new frame, see focus_metrics.
+
+        `after` drops the frames exposed before the stage settled, see next_request.
+        """
+        with self.capture_frame(after=after) as frame:
+            return focus_score(frame.green(), self.focus_metric, self.focus_roi, self.focus_decimate)
+
+    def autofocus(self, strategy=None, **params):
+        """Move the stage to the best focus around the current Z.
+
+        strategy is one of autofocus.STRATEGIES, or 'sweep' for a single
+        continuous Z move scored on the lores stream (autofocus.sweep_autofocus).
+        :returns: an autofocus.AutofocusResult (z, captures, moves, duration...)
+        """
+        strategy = strategy or self.autofocus_strategy
+        if strategy == 'sweep':
+            result = sweep_autofocus(self.stage, self, **params)
         else:
-            # Return the image as a PIL image
-            return image
-
-    def autofocus(self):
-        def calculate_focus_score():
-            """Calculate focus score using edge enhancement and variance."""
-            image = self.capture()
-            _, image, _ = image.split()
-            #edges_image = image.filter(ImageFilter.GaussianBlur(radius=2))
-            #edges_image = image.filter(ImageFilter.EDGE_ENHANCE_MORE)
-            image = np.array(image)
-
-            laplacian_kernel = np.array([[0, 1, 0],
-                                 [1, -4, 1],
-                                 [0, 1, 0]])
-            laplacian = np.abs(scipy.ndimage.convolve(image, laplacian_kernel))
-            variance = laplacian.var()
-            
-            return variance
-    
-        # Coarse search
-        step_initial = 0.05
-        nSlices = 10
-        offset_topPosition = (nSlices * step_initial) / 2
-        self.stage.move_relative(0, 0, offset_topPosition + step_initial)
-        
-        focus_data = []
-        for _ in range(nSlices):
-            self.stage.move_relative(0, 0, -step_initial)
-            current_pos = self.stage.get_position()
-            focus_score = calculate_focus_score()
-            focus_data.append((current_pos, focus_score))
-        
-        # Find the best position from the coarse search
-        best_focus_position, best_focus_score = min(focus_data, key=lambda x: x[1])
-        self.stage.move_absolute(best_focus_position[0], best_focus_position[1], best_focus_position[2])
-    
-        #Fine search
-        step_fine = 0.04
-        max_steps = 20
-        
-        # Fine search upwards
-        for i in range(max_steps):
-            self.stage.move_relative(0, 0, step_fine)  # Move upwards
-            current_pos = self.stage.get_position()
-            focus_score = calculate_focus_score()
-            
-            if focus_score < best_focus_score:
-                best_focus_score = focus_score
-                best_focus_position = current_pos
-            else:
-                print(f"Focus decreased upwards, stopping at step {i}.")
-                break
-    
-        self.stage.move_absolute(best_focus_position[0], best_focus_position[1], best_focus_position[2])
-    
-        # Fine search downwards
-        for i in range(max_steps):
-            self.stage.move_relative(0, 0, -step_fine)  # Move downwards
-            current_pos = self.stage.get_position()
-            focus_score = calculate_focus_score()
-            
-            if focus_score < best_focus_score:
-                best_focus_score = focus_score
-                best_focus_position = current_pos
-            else:
-                print(f"Focus decreased downwards, stopping at step {i}.")
-                break
-    
-        # Move stage to the best focus position found
-        self.stage.move_absolute(best_focus_position[0], best_focus_position[1], best_focus_position[2])
-    
-        return best_focus_position #best_focus_position
\ No newline at end of file
+            result = run_autofocus(self.stage, self.focus_score, strategy, **params)
+        self.scores = result.samples
+        return result
@@ -1,17 +1,14 @@
-import io
-import time
-import threading
 import ipywidgets as widgets
-import numpy as np
-from PIL import Image
 from EnderPiCamCore import EnderPiCamCore
+from preview_pipeline import PreviewPipeline
 
 class EnderPiCamUI:
     def __init__(self, resolution=(2028,1520), exposure=10000, gain=4.0, title="EnderPiCam", ui=True, autofocus=False, stage = None):
-        self.core = EnderPiCamCore(resolution, exposure, gain, stage, autofocus)
+        self.core = EnderPiCamCore(resolution, exposure, gain, autofocus=autofocus, stage=stage)
         self.title = title
         self.ui = ui
         self.preview_running = False
+        self.preview = None
         self.autofocus_enabled = autofocus
         
         # Create autofocus button
@@ -64,6 +61,9 @@ class EnderPiCamUI:
         self.preview_button = widgets.Button(description="Toggle Preview")
         self.preview_button.on_click(self.toggle_preview)
 
+        # Achieved frame rate and latency of the preview stages
+        self.preview_stats = widgets.HTML(value='')
+
         self.output = widgets.Textarea(
             value='Hello World',
             placeholder='Type something',
@@ -74,6 +74,7 @@ class EnderPiCamUI:
         if self.ui:
             self.ui_layout = widgets.VBox([
                 widgets.HBox([self.preview_button, self.status_indicator]),
+                self.preview_stats,
                 self.exposure_slider,
                 self.gain_slider,
                 self.file_picker,
@@ -93,10 +94,10 @@ class EnderPiCamUI:
         self.core.set_controls(gain=change['new'])
 
     def capture_image(self, b):
-        image = self.core.capture()
+        array = self.core.capture_array()
         file_path = self.file_picker.value
         if file_path:
-            image.save(file_path)
+            self.core.save(array, file_path, format=None)
             self.output.value = f"Image saved as {file_path}"
 
     def toggle_preview(self, b):
@@ -105,35 +106,33 @@ class EnderPiCamUI:
         else:
             self.start_preview()
 
-    def start_preview(self):
-        """Start preview in a separate thread."""
+    def start_preview(self, target_fps=15.0):
+        """Start the preview pipeline, fed by the lores stream."""
         self.preview_running = True
         self.status_indicator.value = self._get_status_indicator_html('#00FF00')
-        threading.Thread(target=self._preview_loop).start()
+        self.preview = PreviewPipeline(self.core.capture_lores, self._show_preview, target_fps=target_fps)
+        self.preview.start()
 
     def stop_preview(self):
         """Stop preview."""
         self.status_indicator.value = self._get_status_indicator_html('gray')
         self.preview_running = False
+        if self.preview is not None:
+            self.preview.stop()
+            self.preview = None
 
-    def _preview_loop(self):
-        while self.preview_running:
-            imageRaw = self.core.capture()
-            image_gray = imageRaw.convert('L')
-            image_array = np.array(image_gray)
-            min_val = np.min(image_array)
-            max_val = np.max(image_array)
-            normalized_image = (image_array - min_val) * (255.0 / (max_val - min_val))
-            image = Image.fromarray(np.uint8(normalized_image))
-            with io.BytesIO() as output:
-                image.save(output, format="JPEG")
-                self.preview_image.value = output.getvalue()
-            time.sleep(0.1)
+    def _show_preview(self, jpeg):
+        """Called from the display thread of the pipeline."""
+        self.preview_image.value = jpeg
+        preview = self.preview
+        if preview is not None and preview.counts['display'] % 15 == 0:
+            self.preview_stats.value = preview.stats_html()
 
     def run_autofocus(self, b):
         self.output.value = "running..."
-        best_focus_position = self.core.autofocus()  # Call the autofocus method
-        formatted_position = f"Best focus position: {best_focus_position}"
+        result = self.core.autofocus()  # Call the autofocus method
+        formatted_position = (f"Best focus position: Z={result.z:.3f} "
+                              f"({result.captures} frames, {result.duration:.1f} s)")
         self.output.value = formatted_position  # Update output with the result
 
 
@@ -3,6 +3,10 @@ import board
 import threading
 import time
 
+from ender_log import get_logger
+
+logger = get_logger('lights')
+
 
 class EnderPiLightCore:
     # Global buffer to hold the state of all pixels across all lights
@@ -22,6 +26,8 @@ class EnderPiLightCore:
 
         # Initialize NeoPixel object
         self.pixels = neopixel.NeoPixel(board_pin, total_pixels, auto_write=False)
+        # State last written to this light's strip, show() is skipped when nothing changed
+        self.shown_state = None
 
         self.is_on = False  # Light starts off by default
         self.rgb_color = (255, 255, 255)  # Default color is white
@@ -29,9 +35,26 @@ class EnderPiLightCore:
 
     def update_pixels(self):
         """Update the physical NeoPixel strip with the global state."""
+        state = list(EnderPiLightCore.global_pixel_state[:self.total_pixels])
+        if state == self.shown_state:
+            return
         for i in range(self.total_pixels):
-            self.pixels[i] = EnderPiLightCore.global_pixel_state[i]
+            self.pixels[i] = state[i]
         self.pixels.show()
+        self.shown_state = state
+
+    def set_state(self, on, color=None, intensity=None):
+        """Set on/off, colour and intensity at once, with a single write to the strip."""
+        if color is not None:
+            self.rgb_color = tuple(color)
+        if intensity is not None:
+            self.intensity = intensity
+        self.is_on = on
+        value = self._apply_intensity(self.rgb_color) if on else (0, 0, 0)
+        for i in range(self.start_pin, self.end_pin):
+            if i < EnderPiLightCore.global_pixel_count:  # Ensure within bounds
+                EnderPiLightCore.global_pixel_state[i] = value
+        self.update_pixels()
 
     def toggle(self):
         """Toggle the light on and off for the assigned pixel range."""
@@ -41,19 +64,21 @@ class EnderPiLightCore:
             for i in range(self.start_pin, self.end_pin):
                 if i < EnderPiLightCore.global_pixel_count:  # Ensure within bounds
                     EnderPiLightCore.global_pixel_state[i] = self._apply_intensity(self.rgb_color)
-            print(f"Light ON from pixel {self.start_pin} to {self.end_pin - 1}")
+            logger.info(f"Light ON from pixel {self.start_pin} to {self.end_pin - 1}")
         else:
             # Turn off the light only within the assigned pixel range
             for i in range(self.start_pin, self.end_pin):
                 if i < EnderPiLightCore.global_pixel_count:  # Ensure within bounds
                     EnderPiLightCore.global_pixel_state[i] = (0, 0, 0)
-            print(f"Light OFF from pixel {self.start_pin} to {self.end_pin - 1}")
+            logger.info(f"Light OFF from pixel {self.start_pin} to {self.end_pin - 1}")
 
         # Update the NeoPixel strip with the new global state
         self.update_pixels()
 
     def set_intensity(self, value):
         """Set the light intensity."""
+        if value == self.intensity:
+            return
         self.intensity = value
         if self.is_on:
             # Update the color with the new intensity
@@ -77,6 +102,8 @@ class EnderPiLightCore:
 
     def set_rgb_color(self, r, g, b):
         """Set the RGB color of the light."""
+        if (r, g, b) == self.rgb_color:
+            return
         self.rgb_color = (r, g, b)
         if self.is_on:
             # Update the color with the new RGB values
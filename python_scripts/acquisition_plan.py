@@ -0,0 +1,430 @@
+"""Declarative acquisitions.
+
+An AcquisitionPlan describes what to image: positions x time points x
+mosaic tiles x Z slices x channels, and in which order to loop over them.
+compile() turns it into a flat list of Events (move, focus, light, camera,
+capture, wait, flush) that can be inspected, counted, estimated or
+reordered before PlanExecutor runs them, and that can be resumed from any
+index after an interruption.
+
+    plan = AcquisitionPlan(positions, time_points=24, interval=3600, tiles=(3, 3),
+                           channels=[Channel('GFP', 'fluo', color=(0, 0, 255)),
+                                     Channel('BF', 'bf', intensity=0.5)])
+    events = plan.compile()
+    PlanExecutor(stage, camera, {'fluo': light_fluo.core, 'bf': light_bf.core}).run(events)
+
+Light and camera events are only emitted when a setting actually changes.
+Every tile is autofocused under the plan's focus channel (the first
+non-fluorescence channel, usually bright field), and every light is turned
+off while the plan waits for the next time point.
+With several channels, choose_order() picks where the channel loop goes
+(inside Z, around Z, around the tiles) from a CostModel of light switches,
+camera reconfigurations and moves.
+"""
+import itertools
+import os
+import time
+from collections import Counter
+
+from ender_log import get_logger
+from frame_writer import FrameWriter
+from motion_model import AXES, MotionModel
+
+logger = get_logger('acquisition')
+
+LOOPS = ('time', 'position', 'tile', 'z', 'channel')
+DEFAULT_ORDER = ('time', 'position', 'tile', 'channel', 'z')
+# Where the channel loop goes, for choose_order()
+CHANNEL_ORDERS = {
+    'channels_inside_z': ('time', 'position', 'tile', 'z', 'channel'),
+    'z_inside_channels': ('time', 'position', 'tile', 'channel', 'z'),
+    'tiles_inside_channels': ('time', 'position', 'channel', 'tile', 'z'),
+}
+FILE_PATTERN = "{name}_t{time:03d}_p{position:02d}_x{column:02d}_y{row:02d}_z{z:02d}_{channel}.tif"
+
+
+class Channel:
+    def __init__(self, name, light=None, color=(255, 255, 255), intensity=1.0, exposure=None, gain=None,
+                 fluorescence=False):
+        """
+        :param light: key of the light used in PlanExecutor(lights=...), None for no light
+        :param exposure: exposure time in us, None keeps the camera setting
+        :param gain: analogue gain, None keeps the camera setting
+        :param fluorescence: excitation light, kept on as little as possible and never used to focus
+        """
+        self.name = name
+        self.light = light
+        self.color = tuple(color)
+        self.intensity = intensity
+        self.exposure = exposure
+        self.gain = gain
+        self.fluorescence = fluorescence
+
+    def __repr__(self):
+        return f"Channel({self.name!r}, light={self.light!r})"
+
+
+class Event:
+    """One operation of a compiled plan; `index` locates it in the plan loops."""
+    def __init__(self, kind, index=None, **params):
+        self.kind = kind
+        self.index = index or {}
+        self.params = params
+
+    def __repr__(self):
+        params = ", ".join(f"{key}={value!r}" for key, value in self.params.items())
+        return f"Event({self.kind}: {params})"
+
+
+class AcquisitionPlan:
+    def __init__(self, positions=None, time_points=1, interval=0.0, tiles=(1, 1), tile_step=1.5,
+                 z_slices=1, z_step=0.0, channels=None, order=DEFAULT_ORDER, autofocus=True,
+                 directory=".", name="image", optimizer=None, focus_channel=None):
+        """
+        :param positions: list of {'x', 'y', 'z'} dicts, None for the current stage position
+        :param interval: seconds between the starts of two time points
+        :param tiles: mosaic (rows, columns) around each position, visited in snake order
+        :param tile_step: distance in mm between two tiles
+        :param z_slices: slices of the Z stack, centred on the focus
+        :param z_step: distance in mm between two slices
+        :param channels: list of Channel, by default a single channel with no light change
+        :param order: the five LOOPS from outermost to innermost, 'time' first
+        :param autofocus: focus each tile before imaging it
+        :param optimizer: path_order.PathOptimizer reordering positions and tiles
+            to minimise travel time, None to keep the given order
+        :param focus_channel: Channel (or channel name) lighting the autofocus,
+            by default the first channel that is not fluorescence
+        """
+        if sorted(order) != sorted(LOOPS) or order[0] != 'time':
+            raise ValueError(f"order must list {LOOPS} with 'time' first")
+        self.positions = positions
+        self.time_points = time_points
+        self.interval = interval
+        self.tiles = tiles
+        self.tile_step = tile_step
+        self.z_slices = z_slices
+        self.z_step = z_step
+        self.channels = channels or [Channel('image')]
+        self.order = tuple(order)
+        self.autofocus = autofocus
+        self.directory = directory
+        self.name = name
+        self.optimizer = optimizer
+        self.order_report = None
+        if isinstance(focus_channel, str):
+            focus_channel = next(channel for channel in self.channels if channel.name == focus_channel)
+        self.focus_channel = focus_channel or next(
+            (channel for channel in self.channels if not channel.fluorescence), self.channels[0])
+
+    def tile_offsets(self):
+        """(row, column, dx, dy) of the mosaic tiles in snake order."""
+        rows, columns = self.tiles
+        offsets = []
+        for row in range(rows):
+            for column in (range(columns) if row % 2 == 0 else reversed(range(columns))):
+                offsets.append((row, column, column * self.tile_step, row * self.tile_step))
+        return offsets
+
+    def mosaic_bounds(self, position):
+        """(x_min, x_max, y_min, y_max) of the tile centres of the mosaic at `position`."""
+        rows, columns = self.tiles
+        return (position['x'], position['x'] + (columns - 1) * self.tile_step,
+                position['y'], position['y'] + (rows - 1) * self.tile_step)
+
+    def z_offsets(self):
+        """Z offsets in mm of the slices, centred on 0."""
+        return [(index - (self.z_slices - 1) / 2) * self.z_step for index in range(self.z_slices)]
+
+    def loop_sizes(self, positions):
+        return {
+            'time': self.time_points,
+            'position': len(positions),
+            'tile': len(self.tile_offsets()),
+            'z': self.z_slices,
+            'channel': len(self.channels),
+        }
+
+    def visiting_orders(self, positions, current_position=None):
+        """Order of the positions and of the tiles, optimised if the plan has an optimizer."""
+        tiles = self.tile_offsets()
+        if self.optimizer is None:
+            return list(range(len(positions))), list(range(len(tiles)))
+        # A timelapse comes back to where it started for the next time point
+        end = current_position if self.time_points > 1 else None
+        position_order, report = self.optimizer.order(positions, start=current_position, end=end)
+        tile_order, tile_report = self.optimizer.order([(dx, dy, 0.0) for _, _, dx, dy in tiles])
+        self.order_report = {
+            'positions': report,
+            'tiles': tile_report,
+            'saved_s': self.time_points * (report['saved_s'] + len(positions) * tile_report['saved_s']),
+        }
+        logger.info(f"Optimised visiting order saves {self.order_report['saved_s']:.1f} s of travel")
+        return position_order, tile_order
+
+    def choose_order(self, costs, current_position=None):
+        """Set the loop order of CHANNEL_ORDERS with the lowest estimated cost.
+
+        Orders that would autofocus under a fluorescence light are left out
+        (unless every channel is fluorescence), and the excitation a
+        fluorescence light gets outside its captures counts in the cost.
+        :param costs: CostModel
+        :returns: {name: estimated seconds} of every candidate kept
+        """
+        fluorescence = {channel.light for channel in self.channels if channel.fluorescence}
+        compiled = {}
+        for name, order in CHANNEL_ORDERS.items():
+            self.order = order
+            compiled[name] = self.compile(current_position)
+        allowed = {name: events for name, events in compiled.items()
+                   if not focus_under_fluorescence(events, fluorescence)} or compiled
+        estimates = {name: costs.estimate(events, current_position, fluorescence)
+                     for name, events in allowed.items()}
+        best = min(estimates, key=estimates.get)
+        self.order = CHANNEL_ORDERS[best]
+        logger.info("Channel order: " + ", ".join(f"{name} {seconds:.0f} s" for name, seconds in estimates.items())
+                    + f" -> {best}")
+        return estimates
+
+    def compile(self, current_position=None):
+        """Flat list of Events running the plan.
+
+        :param current_position: {'x', 'y', 'z'} used when the plan has no positions
+        """
+        positions = self.positions or [current_position or {'x': 0.0, 'y': 0.0, 'z': 0.0}]
+        sizes = self.loop_sizes(positions)
+        tiles = self.tile_offsets()
+        position_order, tile_order = self.visiting_orders(positions, current_position)
+        z_offsets = self.z_offsets()
+        events = []
+        lights = {}
+        camera = {}
+        focused = set()
+        previous = None
+        for values in itertools.product(*(range(sizes[loop]) for loop in self.order)):
+            index = dict(zip(self.order, values))
+            index['position'] = position_order[index['position']]
+            index['tile'] = tile_order[index['tile']]
+            t, p, tile, z, c = (index[loop] for loop in LOOPS)
+            if previous is None or previous['time'] != t:
+                if previous is not None:
+                    # Nothing stays lit during the interval; the next time point sets everything again
+                    events.extend(self._lights_off(lights, previous))
+                    events.append(Event('flush', dict(previous)))
+                    lights.clear()
+                    camera.clear()
+                events.append(Event('wait', index, start=t * self.interval))
+                focused.clear()
+            position = positions[p]
+            row, column, dx, dy = tiles[tile]
+            x, y = position['x'] + dx, position['y'] + dy
+            if previous is None or (previous['position'], previous['tile']) != (p, tile) \
+                    or previous['z'] != z:
+                # Z is relative to the focus found for this tile (or to the position Z)
+                events.append(Event('move', index, x=x, y=y, dz=z_offsets[z], key=(p, tile), base=position['z']))
+            if self.autofocus and (p, tile) not in focused:
+                events.extend(self._channel_events(self.focus_channel, lights, camera, index))
+                events.append(Event('focus', index, key=(p, tile), dz=z_offsets[z]))
+                focused.add((p, tile))
+            channel = self.channels[c]
+            events.extend(self._channel_events(channel, lights, camera, index))
+            path = os.path.join(self.directory, FILE_PATTERN.format(
+                name=self.name, time=t, position=p, column=column, row=row, z=z, channel=channel.name))
+            events.append(Event('capture', index, path=path, channel=channel.name))
+            previous = index
+        events.extend(self._lights_off(lights, previous))
+        events.append(Event('flush', previous))
+        return events
+
+    @staticmethod
+    def _lights_off(lights, index):
+        """Events turning off every light left on."""
+        events = []
+        for light in sorted(light for light, state in lights.items() if state[0]):
+            events.append(Event('light', index, light=light, on=False))
+            lights[light] = (False,) + lights[light][1:]
+        return events
+
+    @staticmethod
+    def _channel_events(channel, lights, camera, index):
+        """Light and camera changes needed for `channel`, given the state left by the previous ones."""
+        events = []
+        for light, state in lights.items():
+            if light != channel.light and state[0]:
+                events.append(Event('light', index, light=light, on=False))
+                lights[light] = (False,) + state[1:]
+        if channel.light is not None:
+            wanted = (True, channel.color, channel.intensity)
+            if lights.get(channel.light) != wanted:
+                events.append(Event('light', index, light=channel.light, on=True,
+                                    color=channel.color, intensity=channel.intensity))
+                lights[channel.light] = wanted
+        controls = {}
+        if channel.exposure is not None and camera.get('exposure') != channel.exposure:
+            controls['exposure'] = camera['exposure'] = channel.exposure
+        if channel.gain is not None and camera.get('gain') != channel.gain:
+            controls['gain'] = camera['gain'] = channel.gain
+        if controls:
+            events.append(Event('camera', index, **controls))
+        return events
+
+
+class CostModel:
+    """Predicted duration in seconds of the events of a compiled plan.
+
+    After a move, a light switch or a camera change the frame being exposed
+    is dropped (see EnderPiCamCore.next_request), so each costs one frame on
+    top of its own time; new exposure or gain settings take a few frames to
+    reach the sensor. Time spent with a fluorescence light on outside the
+    captures only bleaches the sample: it is added again, weighted by
+    `bleach_weight`.
+    """
+    def __init__(self, motion=None, exposure=500000, light_switch=0.005, camera_frames=3, focus_time=5.0,
+                 bleach_weight=1.0):
+        """
+        :param motion: motion_model.MotionModel of the stage
+        :param exposure: exposure in us until a camera event changes it
+        :param light_switch: seconds to update the NeoPixels
+        :param camera_frames: frames before new controls are applied
+        :param focus_time: seconds per autofocus
+        :param bleach_weight: cost in seconds of one second of needless fluorescence excitation
+        """
+        self.motion = motion or MotionModel()
+        self.exposure = exposure
+        self.light_switch = light_switch
+        self.camera_frames = camera_frames
+        self.focus_time = focus_time
+        self.bleach_weight = bleach_weight
+
+    def estimate(self, events, start=None, fluorescence=()):
+        """Total predicted cost, not counting the timelapse waits.
+
+        :param fluorescence: keys of the lights exciting fluorescence
+        """
+        frame = self.exposure / 1e6
+        position = dict(start) if start else None
+        lit = set()
+        total = 0.0
+        excitation = 0.0
+        for event in events:
+            params = event.params
+            duration = 0.0
+            if event.kind == 'move':
+                target = {'x': params['x'], 'y': params['y'], 'z': params['base'] + params['dz']}
+                if position is not None:
+                    duration += self.motion.wait_time({axis: target[axis] - position[axis] for axis in AXES})
+                duration += frame
+                position = target
+            elif event.kind == 'light':
+                duration = self.light_switch + frame
+                if params['on']:
+                    lit.add(params['light'])
+                else:
+                    lit.discard(params['light'])
+            elif event.kind == 'camera':
+                frame = params.get('exposure', frame * 1e6) / 1e6
+                duration = self.camera_frames * frame
+            elif event.kind == 'capture':
+                duration = frame
+            elif event.kind == 'focus':
+                duration = self.focus_time
+            total += duration
+            if event.kind != 'capture' and lit.intersection(fluorescence):
+                excitation += duration
+        return total + self.bleach_weight * excitation
+
+
+def focus_under_fluorescence(events, fluorescence):
+    """Whether a focus event runs while one of the `fluorescence` lights is on."""
+    lit = set()
+    for event in events:
+        if event.kind == 'light':
+            if event.params['on']:
+                lit.add(event.params['light'])
+            else:
+                lit.discard(event.params['light'])
+        elif event.kind == 'focus' and lit.intersection(fluorescence):
+            return True
+    return False
+
+
+def summary(events):
+    """Number of events of each kind."""
+    return dict(Counter(event.kind for event in events))
+
+
+class PlanExecutor:
+    def __init__(self, stage, camera, lights=None, writer=None, focus=None, progress=None):
+        """
+        :param camera: EnderPiCamCore
+        :param lights: {name: EnderPiLightCore} for the Channel.light keys
+        :param focus: callable focusing the current tile and returning its Z
+            (e.g. EnderAcquisitionCore.focus_tile), camera.autofocus by default
+        :param progress: callable(done, total, event) called after each event
+        """
+        self.stage = stage
+        self.camera = camera
+        self.lights = lights or {}
+        self.writer = writer or FrameWriter()
+        self.focus = focus or (lambda: camera.autofocus().z)
+        self.progress = progress
+        self.focus_z = {}
+        self.changed_at = None
+        self.started = None
+        self.done = 0
+
+    def run(self, events, start=0):
+        """Run events[start:]; self.done tells where to resume after an error."""
+        if self.started is None or start == 0:
+            self.started = time.monotonic()
+        self.done = start
+        for event in events[start:]:
+            getattr(self, '_' + event.kind)(event)
+            self.done += 1
+            if self.progress is not None:
+                self.progress(self.done, len(events), event)
+        return self.done
+
+    def _wait(self, event):
+        delay = self.started + event.params['start'] - time.monotonic()
+        if delay > 0:
+            logger.info(f"Waiting {delay:.0f} s for time point {event.index.get('time')}")
+            time.sleep(delay)
+
+    def _move(self, event):
+        params = event.params
+        base = self.focus_z.get(params['key'], params['base'])
+        self.stage.move_absolute(params['x'], params['y'], base + params['dz'])
+        self.stage.wait_until_settled()
+        self.changed_at = time.monotonic()
+
+    def _focus(self, event):
+        key, dz = event.params['key'], event.params['dz']
+        self.focus_z[key] = self.focus()
+        if dz:
+            position = self.stage.position
+            self.stage.move_absolute(position['x'], position['y'], self.focus_z[key] + dz)
+            self.stage.wait_until_settled()
+        self.changed_at = time.monotonic()
+
+    def _light(self, event):
+        params = event.params
+        light = self.lights[params['light']]
+        wanted = (params['on'], params.get('color', light.rgb_color), params.get('intensity', light.intensity))
+        if (light.is_on, light.rgb_color, light.intensity) == wanted:
+            return
+        light.set_state(*wanted)
+        self.changed_at = time.monotonic()
+
+    def _camera(self, event):
+        controls = {name: value for name, value in event.params.items() if getattr(self.camera, name) != value}
+        if not controls:
+            return
+        self.camera.set_controls(**controls)
+        self.changed_at = time.monotonic()
+
+    def _capture(self, event):
+        # Only frames exposed after the last move or setting change are used
+        self.camera.capture(path=event.params['path'], writer=self.writer, after=self.changed_at)
+
+    def _flush(self, event):
+        self.writer.flush()
@@ -0,0 +1,223 @@
+"""asyncio driver for the Marlin stage.
+
+AsyncStage owns the serial connection. A single reader demultiplexes what
+Marlin sends back ('ok', 'busy:', 'echo:', position reports, errors) into
+per-command futures, so several commands can be in flight and nothing
+blocks the caller while the stage moves, homes or waits for temperature.
+
+It can be driven from any running event loop:
+
+    driver = AsyncStage(serial.Serial('/dev/ttyUSB1', 115200))
+    await driver.start()
+    await driver.move_absolute(10, 10, 2)
+
+or, from a notebook, through ``Stage(port, use_async=True)`` which runs the
+driver on a background event loop: the usual blocking Stage methods keep
+working, the control pad no longer freezes the kernel, and cells can await
+``stage.run_async(stage.driver.home())``.
+"""
+import asyncio
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from gcode_utils import MODAL_CODES, ModalState, parse_ok, parse_position
+from position_tracker import PositionTracker
+from stage_path import move_code
+
+READ_TIMEOUT = 0.1  # seconds, lets the reader notice stop()
+IDLE_POLL = 0.005
+
+
+class StageError(Exception):
+    """Marlin answered a command with an error."""
+
+
+class Command:
+    """A command waiting for its 'ok', with the lines Marlin sent in between."""
+    def __init__(self, code, future):
+        self.code = code
+        self.future = future
+        self.lines = []
+        self.error = None
+        self.busy = 0
+        self.sent = time.perf_counter()
+        self.first_byte = None
+        self.bytes_in = 0
+
+
+class AsyncStage:
+    def __init__(self, connection, window=4):
+        """
+        :param connection: opened serial.Serial (or fake_marlin.FakeMarlin)
+        :param window: maximum number of commands waiting for their 'ok'
+        """
+        self.serial = connection
+        self.window = window
+        self.modal = ModalState()
+        self.tracker = PositionTracker()
+        self.pending = deque()
+        self.echo = deque(maxlen=100)
+        # Callables receiving every line read
+        self.listeners = [self.tracker.feed]
+        # serial_stats.SerialStats recording command timings, or None
+        self.stats = None
+        self.busy = False
+        self.loop = None
+        self._slots = None
+        self._reader = None
+        self._read_executor = None
+        self._thread = None
+
+    @property
+    def position(self):
+        """Commanded position, see position_tracker."""
+        return self.tracker.commanded
+
+    async def start(self):
+        """Start the reader task on the running event loop."""
+        self.loop = asyncio.get_running_loop()
+        self._slots = asyncio.Semaphore(self.window)
+        if hasattr(self.serial, 'timeout'):
+            self.serial.timeout = READ_TIMEOUT
+        self._read_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="AsyncStage-reader")
+        self._reader = self.loop.create_task(self._read_loop())
+
+    async def stop(self):
+        """Stop the reader and cancel every command still waiting for an answer."""
+        if self._reader is not None:
+            self._reader.cancel()
+            try:
+                await self._reader
+            except asyncio.CancelledError:
+                pass
+            self._reader = None
+        self._read_executor.shutdown(wait=False)
+        while self.pending:
+            self.pending.popleft().future.cancel()
+
+    def start_background(self):
+        """Run the driver on its own event loop in a daemon thread, for use from sync code."""
+        loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=loop.run_forever, name="AsyncStage", daemon=True)
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(self.start(), loop).result()
+
+    def stop_background(self):
+        self.submit(self.stop()).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self._thread = None
+
+    def submit(self, coro):
+        """Schedule a coroutine on the driver loop from any thread; returns a concurrent Future."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    async def send(self, code):
+        """Send a command and return the lines received before its 'ok'.
+
+        Up to `window` commands can be waiting at the same time; Marlin
+        answers them in order, so the oldest pending command gets each 'ok'.
+        """
+        await self._slots.acquire()
+        command = Command(code, self.loop.create_future())
+        self.modal.update(code)
+        self.pending.append(command)
+        if not code.endswith("\n"):
+            code += "\n"
+        self.serial.write(bytes(code, "utf-8"))
+        return await command.future
+
+    async def _read_loop(self):
+        while True:
+            raw = await self.loop.run_in_executor(self._read_executor, self.serial.readline)
+            if not raw:
+                await asyncio.sleep(IDLE_POLL)
+                continue
+            self._dispatch(raw.decode('utf-8', errors='replace').strip())
+
+    def _dispatch(self, line):
+        for listener in self.listeners:
+            listener(line)
+        command = self.pending[0] if self.pending else None
+        if self.stats is not None and command is not None:
+            if command.first_byte is None:
+                command.first_byte = time.perf_counter()
+            command.bytes_in += len(line) + 1
+        if parse_ok(line) is not None:
+            if command is None:
+                # Stray ok, e.g. left over from before a reset
+                return
+            self.pending.popleft()
+            self._slots.release()
+            self.busy = False
+            if self.stats is not None:
+                self.stats.record(command.code, command.sent, command.first_byte or time.perf_counter(),
+                                  time.perf_counter(), len(command.code) + 1, command.bytes_in, command.busy)
+            if command.future.done():
+                return
+            if command.error is not None:
+                command.future.set_exception(StageError(f"{command.code}: {command.error}"))
+            else:
+                command.future.set_result(command.lines)
+        elif 'busy:' in line:
+            # Long command (G28, M190...) still running, the ok will come later
+            self.busy = True
+            if command is not None:
+                command.busy += 1
+        elif line.startswith('echo:'):
+            self.echo.append(line)
+            if command is not None:
+                # Some replies (M503...) are printed as echo lines
+                command.lines.append(line)
+        elif line.startswith('Error'):
+            self.modal.invalidate()
+            if command is not None:
+                command.error = line
+        elif line.startswith('start'):
+            # The board was reset
+            self.modal.invalidate()
+            self.tracker.invalidate()
+        elif command is not None:
+            command.lines.append(line)
+
+    async def set_modal(self, key, value):
+        if not self.modal.is_set(key, value):
+            await self.send(MODAL_CODES[key][value])
+
+    def _feedrate_word(self, feedrate):
+        if feedrate is None or self.modal.is_set('feedrate', float(feedrate)):
+            return ""
+        return f" F {feedrate}"
+
+    async def move_absolute(self, x, y, z=None, feedrate=None):
+        await self.set_modal('positioning', 'absolute')
+        await self.send(move_code(x, y, z) + self._feedrate_word(feedrate))
+        self.tracker.move_absolute(x, y, z)
+
+    async def move_relative(self, x, y, z=None, feedrate=None):
+        await self.set_modal('positioning', 'relative')
+        await self.send(move_code(x, y, z) + self._feedrate_word(feedrate))
+        self.tracker.move_relative(x, y, z)
+
+    async def home(self):
+        await self.send('G28')
+        self.modal.invalidate()
+        self.tracker.home()
+
+    async def wait_for_moves(self):
+        """Return once the planner is empty and the stage has stopped (M400)."""
+        await self.send('M400')
+
+    async def get_position(self, real=False):
+        """Position reported by the controller (M114), as {'X': .., 'Y': .., 'Z': .., 'E': ..}.
+
+        real=True asks for the position computed from the stepper counts (M114 R).
+        """
+        code = 'M114 R' if real else 'M114'
+        for line in await self.send(code):
+            position = parse_position(line)
+            if position is not None:
+                return position
+        raise StageError(f"{code}: no position in the response")
@@ -0,0 +1,324 @@
+"""Autofocus search strategies.
+
+A strategy chooses the Z positions to look at; a FocusProbe moves the stage
+there, captures and scores a frame, and counts what it cost (moves,
+captures, time). Scores must grow with sharpness, see focus_metrics.
+
+    'scan'            fixed scan of the whole range (reference, many frames)
+    'golden_section'  bracketing search, for unimodal curves
+    'peak_fit'        3-5 samples around the start, peak of a fitted
+                      parabola or Gaussian, window shifted if the peak is
+                      outside it
+    'coarse_to_fine'  coarse hill climb from the start, stopping one step
+                      past the peak, then a peak fit checked by one capture
+
+sweep_autofocus() does not stop at all: Z moves through the range at a
+constant speed while the camera streams lores frames, and each frame is
+placed in Z from its sensor timestamp and the predicted motion profile.
+
+    result = run_autofocus(stage, camera.focus_score, 'peak_fit', step=0.03)
+
+Run this file to compare the strategies on a simulated focus curve.
+"""
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from ender_log import get_logger
+from focus_metrics import focus_score
+from motion_model import DEFAULT_FEEDRATE, trapezoid_distance, trapezoid_time
+from stage_path import current_position
+
+logger = get_logger('autofocus')
+
+GOLDEN = (math.sqrt(5) - 1) / 2
+
+
+class AutofocusResult:
+    def __init__(self, strategy, z, score, moves, captures, duration, samples):
+        self.strategy = strategy
+        self.z = z
+        self.score = score
+        self.moves = moves
+        self.captures = captures
+        self.duration = duration
+        self.samples = samples
+
+    def __repr__(self):
+        return (f"AutofocusResult({self.strategy}: z={self.z:.4f}, {self.captures} captures, "
+                f"{self.moves} moves, {self.duration:.2f} s)")
+
+
+class FocusProbe:
+    """Moves the stage in Z and scores the frame there, remembering every sample."""
+    def __init__(self, stage, score, resolution=1e-4):
+        """
+        :param stage: Stage (move_absolute, wait_until_settled, position)
+        :param score: callable score(after) returning the focus score of a frame
+            exposed after `after` (time.monotonic() seconds), e.g. EnderPiCamCore.focus_score
+        :param resolution: Z positions closer than this (mm) share a sample
+        """
+        self.stage = stage
+        self.score = score
+        self.resolution = resolution
+        # Read once: the probe only moves in Z, at this XY
+        self.start = current_position(stage)
+        self.z = self.start['z']
+        self.samples = {}
+        self.moves = 0
+        self.captures = 0
+        self.started = time.monotonic()
+        # Frames exposed before the last move settled are not scored
+        self.settled = self.started
+
+    def move(self, z):
+        if abs(self.z - z) < self.resolution:
+            return
+        self.stage.move_absolute(self.start['x'], self.start['y'], z)
+        self.stage.wait_until_settled()
+        self.settled = time.monotonic()
+        self.z = z
+        self.moves += 1
+
+    def measure(self, z):
+        key = round(z / self.resolution)
+        if key not in self.samples:
+            self.move(z)
+            self.samples[key] = (z, self.score(after=self.settled))
+            self.captures += 1
+        return self.samples[key][1]
+
+    def best(self):
+        return max(self.samples.values(), key=lambda sample: sample[1])
+
+    def result(self, strategy, z):
+        """Move to z and summarise the search."""
+        self.move(z)
+        score = self.samples.get(round(z / self.resolution), (z, None))[1]
+        return AutofocusResult(strategy, z, score, self.moves, self.captures,
+                               time.monotonic() - self.started, sorted(self.samples.values()))
+
+
+def fit_peak(samples, model='gaussian'):
+    """Z of the maximum of a parabola (or Gaussian: parabola of the log) through (z, score) samples.
+
+    Returns None when the fit has no maximum, e.g. on a monotonic curve.
+    """
+    z = np.array([sample[0] for sample in samples], dtype=float)
+    scores = np.array([sample[1] for sample in samples], dtype=float)
+    if len(z) < 3:
+        return None
+    if model == 'gaussian':
+        if np.any(scores <= 0):
+            return None
+        scores = np.log(scores)
+    # Centre the positions to keep the fit well conditioned
+    origin = z.mean()
+    a, b, _ = np.polyfit(z - origin, scores, 2)
+    if a >= 0:
+        return None
+    return origin - b / (2 * a)
+
+
+def scan(probe, center, half_range=0.25, step=0.05):
+    """Score every step of the range, keep the best (reference strategy)."""
+    for z in np.arange(center + half_range, center - half_range - step / 2, -step):
+        probe.measure(z)
+    return probe.best()[0]
+
+
+def golden_section(probe, center, half_range=0.25, tolerance=0.005):
+    """Golden-section search for the maximum between center -/+ half_range."""
+    low, high = center - half_range, center + half_range
+    upper = low + GOLDEN * (high - low)
+    lower = high - GOLDEN * (high - low)
+    while high - low > tolerance:
+        if probe.measure(lower) >= probe.measure(upper):
+            high, upper = upper, lower
+            lower = high - GOLDEN * (high - low)
+        else:
+            low, lower = lower, upper
+            upper = low + GOLDEN * (high - low)
+    return probe.best()[0]
+
+
+def peak_fit(probe, center, step=0.05, samples=5, model='gaussian', max_shifts=4):
+    """Sample `samples` positions around center and fit the peak of the focus curve.
+
+    While the best sample is on the edge of the window, the window is
+    shifted that way (samples already taken are reused).
+    """
+    offsets = np.arange(samples) - (samples - 1) / 2
+    for _ in range(max_shifts + 1):
+        window = [center + step * offset for offset in offsets]
+        scores = [probe.measure(z) for z in window]
+        best = int(np.argmax(scores))
+        if 0 < best < samples - 1:
+            break
+        center = window[best]
+    else:
+        logger.warning("Focus peak not bracketed, keeping the best sample")
+        return probe.best()[0]
+    # Fit on the best sample and its neighbours only: far samples are on the tails
+    nearest = sorted(probe.samples.values(), key=lambda sample: abs(sample[0] - window[best]))
+    peak = fit_peak(nearest[:min(len(nearest), 5)], model)
+    if peak is None or abs(peak - window[best]) > step:
+        return window[best]
+    return peak
+
+
+def coarse_to_fine(probe, center, half_range=0.25, coarse_step=0.05, model='gaussian', verify=True):
+    """Coarse hill climb from center with early stop, then a peak fit on the coarse samples.
+
+    The climb goes towards the better neighbour of center and stops at the
+    first sample scoring lower than the previous one, i.e. one step past the
+    peak. The fitted peak is finally checked with one capture (verify=True)
+    and the best coarse sample is kept if it scores better.
+    """
+    scores = {offset: probe.measure(center + offset * coarse_step) for offset in (0, 1, -1)}
+    direction = 1 if scores[1] >= scores[-1] else -1
+    if scores[direction] > scores[0]:
+        offset, previous = direction, scores[direction]
+        while abs(offset + direction) * coarse_step <= half_range:
+            offset += direction
+            score = probe.measure(center + offset * coarse_step)
+            if score < previous:
+                break
+            previous = score
+    best_z, best_score = probe.best()
+    nearest = sorted(probe.samples.values(), key=lambda sample: abs(sample[0] - best_z))[:3]
+    peak = fit_peak(nearest, model)
+    if peak is None or abs(peak - best_z) > coarse_step:
+        return best_z
+    if verify and probe.measure(peak) < best_score:
+        return best_z
+    return peak
+
+
+STRATEGIES = {
+    'scan': scan,
+    'golden_section': golden_section,
+    'peak_fit': peak_fit,
+    'coarse_to_fine': coarse_to_fine,
+}
+
+
+def run_autofocus(stage, score, strategy='coarse_to_fine', center=None, **params):
+    """Find the Z of best focus at the current XY position and move there.
+
+    :param score: callable score(after) returning the focus score of a frame
+        exposed after `after`, see FocusProbe
+    :param center: Z to search around, the current Z by default
+    :param params: parameters of the strategy (step, half_range...)
+    """
+    probe = FocusProbe(stage, score)
+    if center is None:
+        center = probe.start['z']
+    z = STRATEGIES[strategy](probe, center, **params)
+    result = probe.result(strategy, z)
+    logger.info(str(result))
+    return result
+
+
+def wait_for_moves(stage):
+    """Block until the stage has stopped (ok of an M400)."""
+    if getattr(stage, 'streaming', False):
+        stage.synchronize(wait_for_moves=True)
+    else:
+        stage.write_code('M400')
+
+
+def sweep_autofocus(stage, camera, center=None, half_range=0.25, speed=0.25, model='gaussian'):
+    """Autofocus in a single constant-speed Z move, scoring the lores frames streamed meanwhile.
+
+    The stage stops at the bottom of the range, then moves to the top at
+    `speed` mm/s while camera.record_lores() collects frames. The ok of the
+    M400 sent behind the move marks its end; its start is that time minus the
+    duration predicted by stage.motion, and every frame is placed in Z from
+    the middle of its exposure. The focus curve is fitted on the frames
+    around the best one. Sensor timestamps and time.monotonic() must share
+    the same clock (CLOCK_MONOTONIC on the Pi).
+
+    :param speed: sweep speed in mm/s; one frame should not span more than a
+        fraction of the depth of field
+    """
+    started = time.monotonic()
+    position = current_position(stage)
+    # F is modal: the moves after the sweep go back to the travel feedrate (mm/min)
+    modal = getattr(stage, 'modal', None)
+    travel_feedrate = (modal.get('feedrate') if modal is not None else None) or DEFAULT_FEEDRATE * 60
+    if center is None:
+        center = position['z']
+    bottom, top = center - half_range, center + half_range
+    stage.move_absolute(position['x'], position['y'], bottom)
+    wait_for_moves(stage)
+
+    stop = threading.Event()
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="sweep-camera") as executor:
+        recording = executor.submit(camera.record_lores, stop)
+        try:
+            stage.move_absolute(position['x'], position['y'], top, feedrate=speed * 60)
+            wait_for_moves(stage)
+            end = time.monotonic()
+        finally:
+            stop.set()
+        try:
+            frames = recording.result()
+        except Exception:
+            stage.move_absolute(position['x'], position['y'], center, feedrate=travel_feedrate)
+            raise
+
+    profile = stage.motion.profile({'z': top - bottom}, speed)
+    begin = end - trapezoid_time(*profile)
+    samples = [(bottom + trapezoid_distance(*profile, timestamp - begin),
+                focus_score(frame, camera.focus_metric))
+               for timestamp, frame in frames if begin <= timestamp <= end]
+    if not samples:
+        stage.move_absolute(position['x'], position['y'], center, feedrate=travel_feedrate)
+        raise RuntimeError("No frame recorded during the focus sweep")
+
+    best_z, best_score = max(samples, key=lambda sample: sample[1])
+    lowest = min(score for _, score in samples)
+    # Fit on the frames of the peak only: the upper half of the curve
+    peak_samples = [sample for sample in samples if sample[1] >= (lowest + best_score) / 2]
+    z = fit_peak(peak_samples, model)
+    if z is None or not bottom <= z <= top:
+        z = best_z
+    stage.move_absolute(position['x'], position['y'], z, feedrate=travel_feedrate)
+    stage.wait_until_settled()
+    result = AutofocusResult('sweep', z, None, 3, len(samples), time.monotonic() - started, samples)
+    logger.info(str(result))
+    return result
+
+
+class SimulatedStage:
+    """Z axis without hardware, with a Gaussian focus curve peaking at true_z."""
+    def __init__(self, true_z=0.12, depth=0.08, noise=0.02, seed=0):
+        self.position = {'x': 0.0, 'y': 0.0, 'z': 0.0}
+        self.true_z = true_z
+        self.depth = depth
+        self.noise = noise
+        self.rng = np.random.default_rng(seed)
+
+    def move_absolute(self, x, y, z=None, feedrate=None):
+        self.position = {'x': x, 'y': y, 'z': self.position['z'] if z is None else z}
+
+    def wait_until_settled(self):
+        pass
+
+    def score(self, after=None):
+        sharpness = math.exp(-((self.position['z'] - self.true_z) / self.depth) ** 2)
+        return 100 * (0.1 + sharpness) * (1 + self.noise * self.rng.standard_normal())
+
+
+if __name__ == '__main__':
+    for true_z in (0.0, 0.12, -0.2):
+        print(f"true focus at z={true_z}")
+        for strategy in STRATEGIES:
+            stage = SimulatedStage(true_z)
+            result = run_autofocus(stage, stage.score, strategy)
+            print(f"  {strategy:15s} z={result.z:+.4f} error={result.z - true_z:+.4f} "
+                  f"captures={result.captures:2d} moves={result.moves:2d}")
@@ -0,0 +1,134 @@
+"""Logging shared by the stage, camera, lights and acquisition.
+
+Components log through the standard logging module, under the
+'enderscope' logger (get_logger('stage'), get_logger('camera')...). Every
+record is kept in a fixed-size ring buffer; LogView shows the tail of that
+buffer in a Textarea refreshed at a capped rate, so a long acquisition no
+longer grows a string widget line by line. enable_file_log() also writes
+the records to disk with size-based rotation.
+"""
+import logging
+import threading
+import time
+from collections import deque
+from logging.handlers import RotatingFileHandler
+
+ROOT_LOGGER = 'enderscope'
+FORMAT = '%(asctime)s %(levelname)-7s %(name)s: %(message)s'
+LEVELS = ['DEBUG', 'INFO', 'WARNING', 'ERROR']
+
+
+class RingBufferHandler(logging.Handler):
+    """Keeps the last `capacity` records in memory and notifies the views."""
+    def __init__(self, capacity=5000):
+        super().__init__(logging.DEBUG)
+        self.records = deque(maxlen=capacity)
+        self.views = []
+
+    def emit(self, record):
+        self.records.append(record)
+        for view in self.views:
+            view.notify()
+
+    def tail(self, count, level=logging.NOTSET):
+        """The last `count` records at `level` or above, oldest first."""
+        selected = []
+        for record in reversed(self.records):
+            if record.levelno >= level:
+                selected.append(record)
+                if len(selected) == count:
+                    break
+        return selected[::-1]
+
+
+_buffer = None
+
+
+def get_buffer():
+    """The ring buffer attached to the 'enderscope' logger (created on first use)."""
+    global _buffer
+    if _buffer is None:
+        _buffer = RingBufferHandler()
+        root = logging.getLogger(ROOT_LOGGER)
+        root.setLevel(logging.DEBUG)
+        root.addHandler(_buffer)
+    return _buffer
+
+
+def get_logger(name):
+    get_buffer()
+    return logging.getLogger(f"{ROOT_LOGGER}.{name}")
+
+
+def enable_file_log(path, max_bytes=5_000_000, backup_count=3, level=logging.INFO):
+    """Also write the records to `path`, rotated once it reaches max_bytes."""
+    handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count)
+    handler.setLevel(level)
+    handler.setFormatter(logging.Formatter(FORMAT))
+    logging.getLogger(ROOT_LOGGER).addHandler(handler)
+    return handler
+
+
+class LogView:
+    def __init__(self, lines=200, max_rate=4.0, level=logging.INFO, height='100px'):
+        """
+        :param lines: number of records rendered (the buffer keeps more)
+        :param max_rate: maximum number of widget refreshes per second
+        :param level: minimum level displayed
+        """
+        import ipywidgets as widgets
+
+        self.buffer = get_buffer()
+        self.lines = lines
+        self.period = 1.0 / max_rate
+        self.level = level
+        self.formatter = logging.Formatter(FORMAT, datefmt='%H:%M:%S')
+        self.last_refresh = 0.0
+        self.timer = None
+        self.lock = threading.Lock()
+
+        self.textarea = widgets.Textarea(
+            value='',
+            placeholder='Logs will appear here...',
+            description='Output:',
+            layout=widgets.Layout(width='100%', height=height)
+        )
+        self.level_dropdown = widgets.Dropdown(
+            options=LEVELS,
+            value=logging.getLevelName(level),
+            description='Level:',
+            layout=widgets.Layout(width='200px')
+        )
+        self.level_dropdown.observe(self.update_level, names='value')
+        self.buffer.views.append(self)
+        self.refresh()
+
+    def update_level(self, change):
+        self.level = logging.getLevelName(change['new'])
+        self.refresh()
+
+    def notify(self):
+        """A record arrived: refresh now, or once the rate limit allows it."""
+        with self.lock:
+            if self.timer is not None:
+                return
+            delay = max(0.0, self.last_refresh + self.period - time.monotonic())
+            self.timer = threading.Timer(delay, self.refresh)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def refresh(self):
+        with self.lock:
+            self.timer = None
+            self.last_refresh = time.monotonic()
+        records = self.buffer.tail(self.lines, self.level)
+        self.textarea.value = "\n".join(self.formatter.format(record) for record in records)
+
+    def close(self):
+        if self in self.buffer.views:
+            self.buffer.views.remove(self)
+
+    def get_widget(self):
+        import ipywidgets as widgets
+
+        return widgets.VBox([self.level_dropdown, self.textarea])
@@ -0,0 +1,244 @@
+"""In-memory stand-in for the Ender's Marlin board.
+
+FakeMarlin implements the small part of the pyserial interface used by
+SerialDevice (write, readline, read, in_waiting, isOpen) and answers G-code
+the way Marlin does: line numbers and checksums are checked, bad lines get
+a 'Resend:', motion commands update a simulated position and every command
+is acknowledged with 'ok' after a configurable link latency. It lets the
+stage code be exercised and timed without hardware:
+
+    stage = Stage(port=None, connection=FakeMarlin(latency=0.004))
+
+FakeMarlinPty serves the same firmware on a pseudo-terminal (Linux/macOS)
+for code that opens a real port by name:
+
+    fake = FakeMarlinPty()
+    stage = Stage(port=fake.port, use_async=True)
+"""
+import os
+import select
+import threading
+import time
+import tty
+from collections import deque
+
+from gcode_utils import WORD_PATTERN, checksum
+
+AXES = ('X', 'Y', 'Z', 'E')
+
+
+class FakeMarlin:
+    def __init__(self, latency=0.004, command_time=0.0, advanced_ok=False,
+                 buffer_size=4, planner_size=16, corrupt_every=0):
+        """
+        :param latency: round-trip time of the USB-serial link, in seconds
+        :param command_time: time the firmware spends on each command
+        :param advanced_ok: answer 'ok N<line> P<planner> B<buffer>' like ADVANCED_OK builds
+        :param buffer_size: size of the firmware command buffer (BUFSIZE)
+        :param planner_size: number of planner blocks (BLOCK_BUFFER_SIZE)
+        :param corrupt_every: pretend every n-th numbered line arrived corrupted (0 disables)
+        """
+        self.latency = latency
+        self.command_time = command_time
+        self.advanced_ok = advanced_ok
+        self.buffer_size = buffer_size
+        self.planner_size = planner_size
+        self.corrupt_every = corrupt_every
+
+        self.port = 'fake-marlin'
+        self.timeout = None
+        self.is_open = True
+        self.position = {axis: 0.0 for axis in AXES}
+        self.relative = False
+        self.last_line = 0
+        self.received = 0
+        self.commands = []
+
+        self._partial = b''
+        self._pending = deque()  # (ready_time, bytes)
+        self._busy_until = 0.0
+
+    # pyserial interface
+    def isOpen(self):
+        return self.is_open
+
+    def open(self):
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+
+    def write(self, data):
+        self._partial += bytes(data)
+        while b'\n' in self._partial:
+            line, self._partial = self._partial.split(b'\n', 1)
+            self._receive(line.decode('utf-8').strip())
+        return len(data)
+
+    def readline(self):
+        if not self._pending:
+            # Nothing will ever come: behave like a serial timeout
+            return b''
+        ready, line = self._pending[0]
+        delay = ready - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        self._pending.popleft()
+        return line
+
+    def read(self, size=1):
+        data = b''
+        while len(data) < size and self._ready():
+            data += self.readline()
+        return data
+
+    @property
+    def in_waiting(self):
+        return sum(len(line) for ready, line in self._pending
+                   if ready <= time.perf_counter())
+
+    def reset_input_buffer(self):
+        self._pending = deque(item for item in self._pending
+                              if item[0] > time.perf_counter())
+
+    def _ready(self):
+        return bool(self._pending) and self._pending[0][0] <= time.perf_counter()
+
+    # Firmware
+    def _receive(self, line):
+        if not line:
+            return
+        self.received += 1
+        now = time.perf_counter()
+        ready = max(now + self.latency, self._busy_until + self.command_time)
+        self._busy_until = ready
+
+        line, error = self._check_line(line)
+        if error is not None:
+            self._reply(ready, f"Error:{error}, Last Line: {self.last_line}",
+                        f"Resend: {self.last_line + 1}")
+            self._ok(ready)
+            return
+
+        self.commands.append(line)
+        self._reply(ready, *self._execute(line))
+        self._ok(ready)
+
+    def _check_line(self, line):
+        if not line.startswith('N'):
+            return line, None
+        body = line
+        if '*' in line:
+            body, sent = line.rsplit('*', 1)
+            corrupted = self.corrupt_every and self.received % self.corrupt_every == 0
+            if corrupted or checksum(body) != int(sent):
+                return None, "checksum mismatch"
+        number, _, code = body.partition(' ')
+        number = int(number[1:])
+        if code.startswith('M110'):
+            self.last_line = number
+            return code, None
+        if number != self.last_line + 1:
+            return None, "Line Number is not Last Line Number+1"
+        self.last_line = number
+        return code, None
+
+    def _execute(self, code):
+        words = WORD_PATTERN.findall(code.upper())
+        if not words:
+            return ()
+        command = ''.join(words[0])
+        values = {letter: float(value) for letter, value in words[1:]}
+
+        if command in ('G0', 'G1'):
+            for axis in AXES:
+                if axis in values:
+                    if self.relative:
+                        self.position[axis] += values[axis]
+                    else:
+                        self.position[axis] = values[axis]
+        elif command == 'G90':
+            self.relative = False
+        elif command == 'G91':
+            self.relative = True
+        elif command == 'G28':
+            for axis in ('X', 'Y', 'Z'):
+                self.position[axis] = 0.0
+            return ("echo:busy: processing",)
+        elif command == 'M110':
+            self.last_line = int(values.get('N', 0))
+        elif command == 'M114':
+            return (self._position_report(),)
+        elif command == 'M115':
+            return ("FIRMWARE_NAME:Marlin (FakeMarlin) SOURCE_CODE_URL:github.com/MarlinFirmware/Marlin",)
+        return ()
+
+    def _position_report(self):
+        p = self.position
+        return (f"X:{p['X']:.2f} Y:{p['Y']:.2f} Z:{p['Z']:.2f} E:{p['E']:.2f} "
+                f"Count X:{int(p['X'] * 80)} Y:{int(p['Y'] * 80)} Z:{int(p['Z'] * 400)}")
+
+    def _ok(self, ready):
+        if self.advanced_ok:
+            queued = sum(1 for item in self._pending if item[0] > time.perf_counter()
+                         and item[1].startswith(b'ok'))
+            free = max(0, self.buffer_size - queued - 1)
+            self._reply(ready, f"ok N{self.last_line} P{self.planner_size} B{free}")
+        else:
+            self._reply(ready, "ok")
+
+    def _reply(self, ready, *lines):
+        for line in lines:
+            self._pending.append((ready, f"{line}\n".encode('utf-8')))
+
+
+class FakeMarlinPty:
+    def __init__(self, **kwargs):
+        """Start a FakeMarlin(**kwargs) behind a pseudo-terminal; open `self.port` to talk to it."""
+        self.marlin = FakeMarlin(**kwargs)
+        self.master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self.running = True
+        self._thread = threading.Thread(target=self._serve, name="FakeMarlinPty", daemon=True)
+        self._thread.start()
+
+    def _serve(self):
+        while self.running:
+            readable, _, _ = select.select([self.master], [], [], 0.001)
+            if readable:
+                self.marlin.write(os.read(self.master, 1024))
+            while self.marlin._ready():
+                os.write(self.master, self.marlin.readline())
+
+    def close(self):
+        self.running = False
+        self._thread.join()
+        os.close(self.master)
+        os.close(self._slave)
+
+
+def measure_throughput(n_commands=200, window=None, latency=0.004, **kwargs):
+    """Time n_commands small relative moves on a fake stage and return commands/second.
+
+    With window=None every move waits for its ok, like the original Stage;
+    otherwise the moves are streamed with that many commands in flight.
+    """
+    from EnderMain import Stage
+
+    stage = Stage(port=None, connection=FakeMarlin(latency=latency, **kwargs))
+    if window is not None:
+        stage.start_streaming(window=window)
+    start = time.perf_counter()
+    for i in range(n_commands):
+        stage.write_code(f"G0 X{0.01 * (i % 2):.2f}")
+    if window is not None:
+        stage.stop_streaming()
+    return n_commands / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    for window in (None, 2, 4, 8):
+        rate = measure_throughput(window=window)
+        label = "blocking" if window is None else f"window={window}"
+        print(f"{label:>10}: {rate:8.1f} commands/s")
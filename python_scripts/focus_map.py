@@ -0,0 +1,190 @@
+"""Focus surface of the sample holder.
+
+Autofocusing every tile of a mosaic costs more than imaging it. The focus
+plane of a slide or a dish varies slowly, so it is measured on a few anchor
+points and interpolated: a least-squares plane for flat, tilted samples, or
+a thin-plate spline when the surface is curved (warped dish bottom...).
+
+    focus_map = build_focus_map(stage, camera.autofocus, anchor_grid(0, 20, 0, 15))
+    focus_map.save("focus_map.json")
+    z = focus_map.predict(x, y)
+
+Each anchor also gets a leave-one-out residual: how far the other anchors
+predict it from its measured Z. Tiles close to an anchor with a large
+residual are where the surface is poorly known, see needs_refinement().
+"""
+import json
+import math
+
+import numpy as np
+
+from ender_log import get_logger
+
+logger = get_logger('focus_map')
+
+MODELS = ('plane', 'tps')
+
+
+def anchor_grid(x_min, x_max, y_min, y_max, columns=3, rows=3):
+    """Anchor points on a regular grid, in snake order to keep the moves short."""
+    xs = np.linspace(x_min, x_max, columns)
+    ys = np.linspace(y_min, y_max, rows)
+    anchors = []
+    for row, y in enumerate(ys):
+        for x in (xs if row % 2 == 0 else xs[::-1]):
+            anchors.append((float(x), float(y)))
+    return anchors
+
+
+def _tps_kernel(r):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(r > 0, r * r * np.log(r), 0.0)
+
+
+def _fit(points, model, smoothing):
+    """Coefficients of the surface through (x, y, z) points."""
+    points = np.asarray(points, dtype=float)
+    xy, z = points[:, :2], points[:, 2]
+    basis = np.column_stack([np.ones(len(points)), xy])
+    if model == 'plane' or len(points) < 4:
+        coefficients, *_ = np.linalg.lstsq(basis, z, rcond=None)
+        return 'plane', coefficients, None
+    distances = np.linalg.norm(xy[:, None, :] - xy[None, :, :], axis=-1)
+    n = len(points)
+    system = np.zeros((n + 3, n + 3))
+    system[:n, :n] = _tps_kernel(distances) + smoothing * np.eye(n)
+    system[:n, n:] = basis
+    system[n:, :n] = basis.T
+    solution, *_ = np.linalg.lstsq(system, np.concatenate([z, np.zeros(3)]), rcond=None)
+    return 'tps', solution[n:], (xy, solution[:n])
+
+
+def _evaluate(fitted, x, y):
+    kind, affine, spline = fitted
+    z = affine[0] + affine[1] * x + affine[2] * y
+    if kind == 'tps':
+        centres, weights = spline
+        r = np.hypot(x - centres[:, 0], y - centres[:, 1])
+        z += float(np.dot(weights, _tps_kernel(r)))
+    return float(z)
+
+
+class FocusMap:
+    def __init__(self, model='plane', smoothing=0.0, tolerance=0.01):
+        """
+        :param model: 'plane' or 'tps' (thin-plate spline, needs 4 anchors or more)
+        :param smoothing: thin-plate spline regularisation, 0 interpolates the anchors exactly
+        :param tolerance: leave-one-out residual in mm above which an area needs refinement
+        """
+        if model not in MODELS:
+            raise ValueError(f"model must be one of {MODELS}")
+        self.model = model
+        self.smoothing = smoothing
+        self.tolerance = tolerance
+        self.points = []
+        self.residuals = []
+        # (x, y) the map was built on, to tell whether a saved map fits a new run
+        self.anchors = []
+        self._fitted = None
+
+    def add(self, x, y, z, fit=True):
+        self.points.append((float(x), float(y), float(z)))
+        if fit:
+            self.fit()
+
+    def fit(self):
+        if len(self.points) < 3:
+            self._fitted = None
+            return self
+        self._fitted = _fit(self.points, self.model, self.smoothing)
+        self.residuals = self._leave_one_out()
+        return self
+
+    def _leave_one_out(self):
+        if len(self.points) < 4:
+            return [0.0] * len(self.points)
+        residuals = []
+        for index, (x, y, z) in enumerate(self.points):
+            others = self.points[:index] + self.points[index + 1:]
+            residuals.append(z - _evaluate(_fit(others, self.model, self.smoothing), x, y))
+        return residuals
+
+    @property
+    def ready(self):
+        return self._fitted is not None
+
+    def predict(self, x, y):
+        """Z of best focus at (x, y)."""
+        if self._fitted is None:
+            if self.points:
+                # Fewer than 3 anchors: nearest measured Z
+                return min(self.points, key=lambda p: math.hypot(p[0] - x, p[1] - y))[2]
+            raise ValueError("The focus map has no anchor point")
+        return _evaluate(self._fitted, x, y)
+
+    def needs_refinement(self, x, y):
+        """Whether the anchor nearest to (x, y) is badly predicted by the others."""
+        if len(self.residuals) < 4:
+            return False
+        nearest = min(range(len(self.points)),
+                      key=lambda i: math.hypot(self.points[i][0] - x, self.points[i][1] - y))
+        return abs(self.residuals[nearest]) > self.tolerance
+
+    def refine(self, x, y, autofocus, **params):
+        """Autofocus at (x, y) if needs_refinement and add the result as an anchor.
+
+        The stage must already be at (x, y), at the predicted Z.
+        :returns: the Z to use at (x, y)
+        """
+        if not self.needs_refinement(x, y):
+            return self.predict(x, y)
+        z = autofocus(**params).z
+        self.add(x, y, z)
+        logger.info(f"Focus map refined at X={x}, Y={y}: Z={z:.4f}")
+        return z
+
+    def covers(self, anchors, tolerance=1e-3):
+        """Whether the map was built on these anchors (x, y), in any order, within `tolerance` mm."""
+        if len(anchors) != len(self.anchors):
+            return False
+        return all(math.hypot(x - ax, y - ay) <= tolerance
+                   for (x, y), (ax, ay) in zip(sorted(anchors), sorted(self.anchors)))
+
+    def to_dict(self):
+        return {'model': self.model, 'smoothing': self.smoothing, 'tolerance': self.tolerance,
+                'anchors': self.anchors, 'points': self.points}
+
+    @classmethod
+    def from_dict(cls, data):
+        focus_map = cls(data['model'], data['smoothing'], data['tolerance'])
+        focus_map.anchors = [tuple(anchor) for anchor in data.get('anchors', [])]
+        focus_map.points = [tuple(point) for point in data['points']]
+        return focus_map.fit()
+
+    def save(self, path):
+        with open(path, 'w') as file:
+            json.dump(self.to_dict(), file, indent=1)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as file:
+            return cls.from_dict(json.load(file))
+
+
+def build_focus_map(stage, autofocus, anchors, model='plane', smoothing=0.0, tolerance=0.01, **params):
+    """Autofocus on every anchor (x, y) and fit a FocusMap on the results.
+
+    Each anchor starts from the Z predicted by the anchors already measured,
+    which keeps the autofocus searches short.
+    :param autofocus: callable returning an autofocus.AutofocusResult, e.g. camera.autofocus
+    """
+    focus_map = FocusMap(model, smoothing, tolerance)
+    focus_map.anchors = [(float(x), float(y)) for x, y in anchors]
+    for x, y in anchors:
+        z = focus_map.predict(x, y) if focus_map.points else stage.position['z']
+        stage.move_absolute(x, y, z)
+        stage.wait_until_settled()
+        focus_map.add(x, y, autofocus(**params).z)
+    logger.info(f"Focus map of {len(anchors)} anchors, residuals (mm): "
+                + ", ".join(f"{r:+.4f}" for r in focus_map.residuals))
+    return focus_map
@@ -0,0 +1,177 @@
+"""Focus metrics.
+
+Every metric takes a 2D image (uint8, uint16 or float) and returns a score
+that grows as the image gets sharper. They are written with NumPy slicing
+(no convolution call, no full-frame float64 copy): the image is first
+cropped to the region of interest and decimated, both as views, and only
+that region is converted to float32.
+
+    score = focus_score(camera.capture_array(green=True), 'tenengrad',
+                        roi=center_roi(shape, 0.5), decimate=2)
+
+Run this file to compare the speed of the metrics and the sharpness of
+their focus curves on a synthetic defocus stack, and their speed-up over
+the scipy convolution used before (previous_laplacian).
+"""
+import time
+
+import numpy as np
+
+DEFAULT_METRIC = 'laplacian'
+
+
+def center_roi(shape, fraction=0.5):
+    """(x, y, width, height) of a centred region covering `fraction` of each dimension."""
+    height, width = shape[:2]
+    roi_width, roi_height = int(width * fraction), int(height * fraction)
+    return (width - roi_width) // 2, (height - roi_height) // 2, roi_width, roi_height
+
+
+def prepare(image, roi=None, decimate=1):
+    """Crop to roi=(x, y, width, height), keep every `decimate`-th pixel, as float32."""
+    if image.ndim == 3:
+        # Colour frame: the green channel carries most of the detail
+        image = image[..., 1]
+    if roi is not None:
+        x, y, width, height = roi
+        image = image[y:y + height, x:x + width]
+    if decimate > 1:
+        image = image[::decimate, ::decimate]
+    if image.dtype == np.float32:
+        return image
+    return image.astype(np.float32)
+
+
+def laplacian_variance(image):
+    """Variance of the 4-neighbour Laplacian."""
+    laplacian = (image[:-2, 1:-1] + image[2:, 1:-1] + image[1:-1, :-2] + image[1:-1, 2:]
+                 - 4 * image[1:-1, 1:-1])
+    return float(laplacian.var())
+
+
+def tenengrad(image):
+    """Mean squared Sobel gradient magnitude."""
+    left = image[:-2, :-2] + 2 * image[1:-1, :-2] + image[2:, :-2]
+    right = image[:-2, 2:] + 2 * image[1:-1, 2:] + image[2:, 2:]
+    top = image[:-2, :-2] + 2 * image[:-2, 1:-1] + image[:-2, 2:]
+    bottom = image[2:, :-2] + 2 * image[2:, 1:-1] + image[2:, 2:]
+    gx = right - left
+    gy = bottom - top
+    return float(np.mean(gx * gx + gy * gy))
+
+
+def brenner(image):
+    """Mean squared difference between pixels two columns apart."""
+    difference = image[:, 2:] - image[:, :-2]
+    return float(np.mean(difference * difference))
+
+
+def normalized_variance(image):
+    """Intensity variance divided by the mean intensity (robust to illumination changes)."""
+    mean = float(image.mean())
+    if mean == 0:
+        return 0.0
+    return float(image.var()) / mean
+
+
+def fft_high_frequency(image, cutoff=0.25):
+    """Share of the spectral energy above `cutoff` times the Nyquist frequency."""
+    spectrum = np.abs(np.fft.rfft2(image - image.mean())) ** 2
+    fy = np.fft.fftfreq(image.shape[0])[:, None]
+    fx = np.fft.rfftfreq(image.shape[1])[None, :]
+    high = (fx * fx + fy * fy) > (cutoff * 0.5) ** 2
+    total = spectrum.sum()
+    if total == 0:
+        return 0.0
+    return float(spectrum[high].sum() / total)
+
+
+METRICS = {
+    'laplacian': laplacian_variance,
+    'tenengrad': tenengrad,
+    'brenner': brenner,
+    'normalized_variance': normalized_variance,
+    'fft': fft_high_frequency,
+}
+
+
+def focus_score(image, metric=DEFAULT_METRIC, roi=None, decimate=1):
+    """Score of one image with a metric of METRICS (or any callable on a float32 image)."""
+    function = METRICS[metric] if isinstance(metric, str) else metric
+    return function(prepare(image, roi, decimate))
+
+
+def synthetic_stack(shape=(760, 1014), sigmas=(6, 4, 2.5, 1.5, 0.5, 0, 0.5, 1.5, 2.5, 4, 6), seed=0):
+    """uint16 images of a random cell-like texture blurred by increasing amounts (in pixels)."""
+    from scipy.ndimage import gaussian_filter
+
+    rng = np.random.default_rng(seed)
+    sample = gaussian_filter(rng.random(shape, dtype=np.float32), 1.5)
+    sample = (sample > np.percentile(sample, 85)) * 3000.0 + 500.0
+    stack = []
+    for sigma in sigmas:
+        image = gaussian_filter(sample, sigma) if sigma else sample.copy()
+        image += rng.normal(0, 20, shape)
+        stack.append(np.clip(image, 0, 65535).astype(np.uint16))
+    return stack
+
+
+def curve_width(scores):
+    """Number of slices scoring above half-way between the minimum and the peak."""
+    scores = np.asarray(scores, dtype=float)
+    half = scores.min() + (scores.max() - scores.min()) / 2
+    return int(np.count_nonzero(scores > half))
+
+
+def previous_laplacian(image):
+    """The score EnderPiCamCore computed before this module, kept as the benchmark reference.
+
+    Full-frame scipy.ndimage.convolve with an integer kernel, in the dtype of
+    the image, then the variance of its absolute value.
+    """
+    from scipy.ndimage import convolve
+
+    kernel = np.array([[0, 1, 0],
+                       [1, -4, 1],
+                       [0, 1, 0]])
+    return float(np.abs(convolve(image, kernel)).var())
+
+
+def benchmark(stack=None, roi=None, decimate=1, repeat=3, reference=True):
+    """Time per image and focus curve of every metric on a defocus stack.
+
+    :param reference: also time previous_laplacian (full frame, ignores roi and decimate)
+    :returns: {metric: {'ms': .., 'peak': index of the best image, 'width': curve_width, 'scores': [..]}}
+    """
+    if stack is None:
+        stack = synthetic_stack()
+    functions = {name: lambda image, name=name: focus_score(image, name, roi, decimate) for name in METRICS}
+    if reference:
+        functions['previous (scipy)'] = previous_laplacian
+    results = {}
+    for name, function in functions.items():
+        best = float('inf')
+        for _ in range(repeat):
+            start = time.perf_counter()
+            scores = [function(image) for image in stack]
+            best = min(best, time.perf_counter() - start)
+        results[name] = {
+            'ms': 1000 * best / len(stack),
+            'peak': int(np.argmax(scores)),
+            'width': curve_width(scores),
+            'scores': scores,
+        }
+    return results
+
+
+if __name__ == '__main__':
+    stack = synthetic_stack()
+    print(f"{len(stack)} images of {stack[0].shape}, sharpest at index {len(stack) // 2}")
+    reference = benchmark(stack, reference=True)['previous (scipy)']
+    print(f"previous (scipy)       {reference['ms']:7.2f} ms/image  peak {reference['peak']:2d}  "
+          f"width {reference['width']}")
+    for decimate in (1, 2, 4):
+        print(f"decimate={decimate}")
+        for name, result in benchmark(stack, decimate=decimate, reference=False).items():
+            print(f"  {name:20s} {result['ms']:7.2f} ms/image  x{reference['ms'] / result['ms']:5.1f}  "
+                  f"peak {result['peak']:2d}  width {result['width']}")
@@ -0,0 +1,122 @@
+"""Focus memory across the frames of a timelapse.
+
+Between two frames the focus of a position only drifts a little (thermal
+drift of the printer frame, evaporation, cells growing). FocusTracker
+remembers the best Z found at each position and the time it was found; on
+the next visit it extrapolates the drift trend, runs a narrow peak fit of a
+few frames around the prediction, and falls back to a full search only when
+the narrow search fails: peak outside its window or score much lower than
+last time.
+"""
+import json
+import time
+from collections import deque
+
+import numpy as np
+
+from ender_log import get_logger
+
+logger = get_logger('focus_tracker')
+
+
+def position_key(x, y, resolution=0.05):
+    """Key of a stage position, positions closer than `resolution` mm share their focus."""
+    return round(x / resolution), round(y / resolution)
+
+
+class FocusRecord:
+    def __init__(self, history=8):
+        # (time, z, best score) of the previous searches, oldest first
+        self.history = deque(maxlen=history)
+        self.samples = []
+
+    def add(self, result, when):
+        self.history.append((when, result.z, max(score for _, score in result.samples)))
+        self.samples = result.samples
+
+    def predict(self, when, trend_points=4):
+        """Z expected at `when`, from the linear trend of the last searches."""
+        recent = list(self.history)[-trend_points:]
+        if len(recent) < 2:
+            return recent[-1][1]
+        times = np.array([t for t, _, _ in recent]) - recent[-1][0]
+        zs = np.array([z for _, z, _ in recent])
+        if np.ptp(times) == 0:
+            return float(zs[-1])
+        slope, intercept = np.polyfit(times, zs, 1)
+        return float(intercept + slope * (when - recent[-1][0]))
+
+    @property
+    def score(self):
+        return self.history[-1][2]
+
+
+class FocusTracker:
+    def __init__(self, stage, autofocus, step=0.015, samples=3, score_drop=0.7, history=8):
+        """
+        :param autofocus: camera.autofocus (strategy, center and strategy parameters)
+        :param step: Z step in mm of the narrow search
+        :param samples: frames of the narrow search
+        :param score_drop: below this fraction of the last best score, search fully again
+        """
+        self.stage = stage
+        self.autofocus = autofocus
+        self.step = step
+        self.samples = samples
+        self.score_drop = score_drop
+        self.history = history
+        self.records = {}
+        self.full_searches = 0
+        self.narrow_searches = 0
+
+    def focus(self, key=None, when=None):
+        """Focus at the current position; returns the autofocus.AutofocusResult used."""
+        position = self.stage.position
+        if key is None:
+            key = position_key(position['x'], position['y'])
+        when = time.time() if when is None else when
+        record = self.records.get(key)
+        result = None
+        center = None
+        if record is not None:
+            center = record.predict(when)
+            result = self._narrow_search(record, center)
+        if result is None:
+            result = self.autofocus(center=center)
+            self.full_searches += 1
+            record = self.records.setdefault(key, FocusRecord(self.history))
+            # The focus jumped: the previous trend no longer applies
+            record.history.clear()
+        else:
+            self.narrow_searches += 1
+        record.add(result, when)
+        return result
+
+    def _narrow_search(self, record, z):
+        """Peak fit around z, or None if the focus was not found there."""
+        result = self.autofocus('peak_fit', center=z, step=self.step, samples=self.samples, max_shifts=1)
+        zs = [sample_z for sample_z, _ in result.samples]
+        best_z, best_score = max(result.samples, key=lambda sample: sample[1])
+        if best_z in (min(zs), max(zs)):
+            logger.info(f"Focus moved out of the narrow window around Z={z:.4f}, full search")
+            return None
+        if best_score < self.score_drop * record.score:
+            logger.info(f"Focus score dropped to {best_score / record.score:.0%} of the last one, full search")
+            return None
+        return result
+
+    def to_dict(self):
+        return {repr(key): {'history': list(record.history)} for key, record in self.records.items()}
+
+    def save(self, path):
+        with open(path, 'w') as file:
+            json.dump(self.to_dict(), file, indent=1)
+
+    def load(self, path):
+        with open(path) as file:
+            data = json.load(file)
+        for key, value in data.items():
+            record = FocusRecord(self.history)
+            record.history.extend(tuple(entry) for entry in value['history'])
+            self.records[tuple(int(part) for part in key.strip('()').split(','))] = record
+        return self
@@ -0,0 +1,99 @@
+"""Preallocated image buffers.
+
+Allocating a new multi-megabyte array for every capture fragments the
+memory of the Pi during long timelapses. A FramePool allocates its buffers
+once, for the size and format of the camera stream, and hands them out as
+Frame objects: the capture code fills one, the consumers (preview, focus,
+disk writer) read it, and the last of them calls release() to give it back.
+When every buffer is in use acquire() waits, which also throttles a capture
+loop running ahead of its consumers.
+"""
+import threading
+from collections import deque
+
+import numpy as np
+
+# Bytes per pixel of the picamera2 formats, with the array shape they produce
+FORMAT_CHANNELS = {
+    'RGB888': 3,
+    'BGR888': 3,
+    'XRGB8888': 4,
+    'XBGR8888': 4,
+}
+
+
+class Frame:
+    """A pooled array and the metadata of the image it holds.
+
+    For RGB888 streams the array is in picamera2's memory order, which is
+    BGR: use rgb() or green() for views in the usual order, or write the
+    array itself with frame_writer's channel_order='BGR'.
+    """
+    def __init__(self, pool, array):
+        self.pool = pool
+        self.array = array
+        self.metadata = {}
+        self.index = None
+
+    def rgb(self):
+        return self.array[..., 2::-1]
+
+    def green(self):
+        return self.array[..., 1]
+
+    def release(self):
+        self.pool.release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class FramePool:
+    def __init__(self, shape, dtype=np.uint8, size=4):
+        """
+        :param shape: shape of each buffer, e.g. (height, width, 3)
+        :param size: number of buffers allocated up front
+        """
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.size = size
+        self.frames = [Frame(self, np.empty(self.shape, self.dtype)) for _ in range(size)]
+        self.free = deque(self.frames)
+        self.condition = threading.Condition()
+
+    @classmethod
+    def for_stream(cls, picam2, stream='main', size=4):
+        """Pool sized to a stream of the active picamera2 configuration."""
+        config = picam2.stream_configuration(stream)
+        width, height = config['size']
+        channels = FORMAT_CHANNELS.get(config['format'])
+        if channels is None:
+            # YUV420 and similar: the luminance plane only
+            return cls((height, width), np.uint8, size)
+        return cls((height, width, channels), np.uint8, size)
+
+    @property
+    def available(self):
+        return len(self.free)
+
+    def acquire(self, timeout=None):
+        """Take a free buffer, waiting until one is released if needed."""
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.free, timeout):
+                raise TimeoutError(f"No free frame in the pool after {timeout} s "
+                                   f"({self.size} buffers, none released)")
+            frame = self.free.popleft()
+        frame.metadata = {}
+        return frame
+
+    def release(self, frame):
+        if frame.pool is not self:
+            raise ValueError("Frame does not belong to this pool")
+        with self.condition:
+            if any(free is frame for free in self.free):
+                return
+            self.free.append(frame)
+            self.condition.notify()
@@ -0,0 +1,197 @@
+"""Background saving of captured frames.
+
+Encoding a full-resolution PNG/TIFF and writing it to the SD card takes
+longer than moving the stage to the next position. FrameWriter does it in
+worker threads: submit() returns as soon as the frame is queued, so the
+acquisition can move on while earlier frames are still being written.
+
+The queue is bounded: when the disk cannot keep up, submit() waits for a
+slot instead of letting frames pile up in memory. Errors raised while
+writing are reported back on the next submit(), flush() or close() (and
+through the future returned by submit()).
+
+fsync policy:
+    'never'  leave flushing to the operating system (fastest)
+    'close'  fsync every file still unsynced when the writer is flushed/closed
+    'each'   fsync every file before reporting it written (safest)
+"""
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from ender_log import get_logger
+
+logger = get_logger('writer')
+
+FSYNC_POLICIES = ('never', 'close', 'each')
+
+
+class WriteError(Exception):
+    """A frame could not be written to disk."""
+
+
+def image_format(path, default='PNG'):
+    extension = os.path.splitext(path)[1].lower()
+    return Image.registered_extensions().get(extension, default)
+
+
+def to_image(array, channel_order='RGB'):
+    """PIL image of an (H, W) or (H, W, 3) array.
+
+    With channel_order='BGR' (picamera2's RGB888 memory order, see
+    frame_pool.Frame) PIL swaps the channels while it copies the pixels in,
+    instead of NumPy making a reversed full-frame copy first.
+    """
+    if channel_order == 'BGR':
+        if array.ndim == 3 and array.shape[2] == 3 and array.flags.c_contiguous:
+            height, width = array.shape[:2]
+            return Image.frombuffer('RGB', (width, height), array, 'raw', 'BGR', 0, 1)
+        array = array[..., 2::-1]
+    return Image.fromarray(np.ascontiguousarray(array))
+
+
+class FrameWriter:
+    def __init__(self, workers=2, max_queue=8, fsync='never'):
+        """
+        :param workers: number of frames encoded and written in parallel
+        :param max_queue: frames accepted (queued or being written) before submit() waits
+        :param fsync: 'never', 'close' or 'each', see the module documentation
+        """
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"fsync must be one of {FSYNC_POLICIES}")
+        self.fsync = fsync
+        self.workers = workers
+        self.max_queue = max_queue
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="FrameWriter")
+        self.slots = threading.BoundedSemaphore(max_queue)
+        self.lock = threading.Lock()
+        self.futures = set()
+        self.errors = []
+        self.unsynced = []
+        self.reset_metrics()
+
+    def reset_metrics(self):
+        self.written = 0
+        self.bytes_written = 0
+        self.write_time = 0.0
+        self.wait_time = 0.0
+        self.started = time.monotonic()
+
+    @property
+    def queue_depth(self):
+        """Frames queued or being written."""
+        return len(self.futures)
+
+    def submit(self, array, path, on_done=None, channel_order='RGB'):
+        """Queue an array for writing to `path` (format from the extension).
+
+        The array must not be modified until it is written: on_done (e.g.
+        Frame.release) is called once the writer no longer needs it, whether
+        the write succeeded or not. channel_order='BGR' writes a pooled
+        frame's array as it is, see to_image.
+        :returns: a concurrent.futures.Future resolving to the path
+        """
+        self.raise_errors()
+        start = time.perf_counter()
+        self.slots.acquire()
+        self.wait_time += time.perf_counter() - start
+        future = self.executor.submit(self._write, array, path, on_done, channel_order)
+        with self.lock:
+            self.futures.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    def _write(self, array, path, on_done, channel_order):
+        start = time.perf_counter()
+        try:
+            image = to_image(array, channel_order)
+            temporary = path + ".part"
+            with open(temporary, 'wb') as file:
+                image.save(file, image_format(path))
+                file.flush()
+                if self.fsync == 'each':
+                    os.fsync(file.fileno())
+                size = file.tell()
+            os.replace(temporary, path)
+        except Exception as error:
+            raise WriteError(f"Could not write {path}: {error}") from error
+        finally:
+            if on_done is not None:
+                on_done()
+        with self.lock:
+            self.written += 1
+            self.bytes_written += size
+            self.write_time += time.perf_counter() - start
+            if self.fsync == 'close':
+                self.unsynced.append(path)
+        return path
+
+    def _done(self, future):
+        with self.lock:
+            self.futures.discard(future)
+        self.slots.release()
+        error = future.exception()
+        if error is not None:
+            logger.error(str(error))
+            with self.lock:
+                self.errors.append(error)
+
+    def raise_errors(self):
+        """Raise the first write error not reported yet."""
+        with self.lock:
+            if not self.errors:
+                return
+            error, self.errors = self.errors[0], []
+        raise error
+
+    def flush(self):
+        """Wait until every queued frame is written, then report errors."""
+        while True:
+            with self.lock:
+                pending = list(self.futures)
+            if not pending:
+                break
+            for future in pending:
+                future.exception()
+        self._sync_files()
+        self.raise_errors()
+
+    def _sync_files(self):
+        with self.lock:
+            paths, self.unsynced = self.unsynced, []
+        for path in paths:
+            descriptor = os.open(path, os.O_RDONLY)
+            try:
+                os.fsync(descriptor)
+            finally:
+                os.close(descriptor)
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def metrics(self):
+        """Queue depth, frames and megabytes written, throughput and time submit() spent waiting."""
+        elapsed = time.monotonic() - self.started
+        return {
+            'queue_depth': self.queue_depth,
+            'max_queue': self.max_queue,
+            'written': self.written,
+            'megabytes': self.bytes_written / 1e6,
+            'frames_per_s': self.written / elapsed if elapsed else 0.0,
+            'megabytes_per_s': self.bytes_written / 1e6 / elapsed if elapsed else 0.0,
+            'mean_write_ms': 1000 * self.write_time / self.written if self.written else 0.0,
+            'submit_wait_s': self.wait_time,
+        }
@@ -0,0 +1,105 @@
+import re
+
+OK_PATTERN = re.compile(r"^ok(?:\s+N(?P<line>-?\d+))?(?:\s+P(?P<planner>\d+))?(?:\s+B(?P<buffer>\d+))?")
+RESEND_PATTERN = re.compile(r"^(?:Resend|rs)[:\s]\s*N?(?P<line>\d+)", re.IGNORECASE)
+# 'X:10.00 Y:5.00 Z:1.20 E:0.00 Count X:800 Y:400 Z:480' (M114 / M154 auto-report)
+POSITION_PATTERN = re.compile(r"^X:\s*(?P<X>-?\d+\.?\d*)\s+Y:\s*(?P<Y>-?\d+\.?\d*)"
+                              r"\s+Z:\s*(?P<Z>-?\d+\.?\d*)(?:\s+E:\s*(?P<E>-?\d+\.?\d*))?")
+
+
+def checksum(line):
+    """Marlin line checksum: XOR of every byte before the '*'."""
+    value = 0
+    for char in line.encode('utf-8'):
+        value ^= char
+    return value
+
+
+def number_line(code, line_number):
+    """Prefix a command with its line number and append the checksum, e.g. 'N3 G0 X1*57'."""
+    line = f"N{line_number} {code.strip()}"
+    return f"{line}*{checksum(line)}"
+
+
+def parse_ok(response):
+    """Parse an 'ok' line, including the ADVANCED_OK fields when Marlin sends them.
+
+    Returns None if the line is not an acknowledgement, else a dict with the
+    'line', 'planner' and 'buffer' entries (None when not reported).
+    """
+    match = OK_PATTERN.match(response.strip())
+    if match is None:
+        return None
+    return {key: int(value) if value is not None else None
+            for key, value in match.groupdict().items()}
+
+
+def parse_resend(response):
+    """Return the line number requested by a 'Resend: N' line, or None."""
+    match = RESEND_PATTERN.match(response.strip())
+    if match is None:
+        return None
+    return int(match.group('line'))
+
+
+def parse_position(response):
+    """Parse a position report into {'X': .., 'Y': .., 'Z': .., 'E': ..}, or None."""
+    match = POSITION_PATTERN.match(response.strip())
+    if match is None:
+        return None
+    return {axis: float(value) for axis, value in match.groupdict().items() if value is not None}
+
+
+# Modal settings tracked by ModalState and the G-code selecting each value
+MODAL_CODES = {
+    'positioning': {'absolute': 'G90', 'relative': 'G91'},
+    'units': {'mm': 'G21', 'inch': 'G20'},
+    'extruder': {'absolute': 'M82', 'relative': 'M83'},
+}
+WORD_PATTERN = re.compile(r"([A-Z])\s*(-?\d*\.?\d+)")
+
+
+class ModalState:
+    """Last known modal state of the controller (positioning mode, units, feedrate...).
+
+    A value of None means unknown: the next request for that setting is
+    always sent. Call invalidate() whenever the controller may have changed
+    state behind our back (reconnect, reset, homing, error).
+    """
+    def __init__(self):
+        self.state = {}
+        self.invalidate()
+
+    def invalidate(self):
+        self.state = {key: None for key in MODAL_CODES}
+        self.state['feedrate'] = None
+
+    def get(self, key):
+        return self.state.get(key)
+
+    def is_set(self, key, value):
+        return self.state.get(key) == value
+
+    def update(self, code):
+        """Record the effect of a command that was sent to the controller."""
+        words = WORD_PATTERN.findall(code.upper().split(';')[0])
+        if not words:
+            return
+        command = ''.join(words[0])
+        if command == 'G90':
+            # In Marlin, G90/G91 also switch the extruder mode
+            self.state['positioning'] = self.state['extruder'] = 'absolute'
+        elif command == 'G91':
+            self.state['positioning'] = self.state['extruder'] = 'relative'
+        elif command == 'G20':
+            self.state['units'] = 'inch'
+        elif command == 'G21':
+            self.state['units'] = 'mm'
+        elif command == 'M82':
+            self.state['extruder'] = 'absolute'
+        elif command == 'M83':
+            self.state['extruder'] = 'relative'
+        elif command in ('G0', 'G1'):
+            for letter, value in words[1:]:
+                if letter == 'F':
+                    self.state['feedrate'] = float(value)
@@ -0,0 +1,64 @@
+"""Coalescing of the jog clicks of the stage control pad.
+
+Each arrow click used to be a full blocking move; clicking fast queued
+dozens of them and the stage lagged far behind the operator. Clicks are
+now accumulated for a short window and sent as one relative move of their
+sum, so a jog is correct even before the stage position is known. The move
+is sent through Stage.in_background (the async driver's queue) or, without
+the driver, under the stage lock, so it never interleaves with a command
+sent from the kernel thread.
+"""
+import threading
+
+AXES = ('x', 'y', 'z')
+
+
+class JogCoalescer:
+    def __init__(self, stage, window=0.15):
+        """
+        :param stage: Stage receiving the coalesced moves (move_relative)
+        :param window: seconds during which clicks are merged
+        """
+        self.stage = stage
+        self.window = window
+        self.pending = {axis: 0.0 for axis in AXES}
+        self.lock = threading.Lock()
+        self.timer = None
+
+    def jog(self, dx=0.0, dy=0.0, dz=0.0):
+        """Add a displacement; it is sent at most `window` seconds later, merged with others."""
+        with self.lock:
+            self.pending['x'] += dx
+            self.pending['y'] += dy
+            self.pending['z'] += dz
+            if self.timer is None:
+                self._schedule()
+
+    def _schedule(self):
+        self.timer = threading.Timer(self.window, self._flush)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def cancel(self):
+        """Drop the clicks not sent yet (e.g. before homing)."""
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            self.pending = {axis: 0.0 for axis in AXES}
+
+    def _flush(self):
+        with self.lock:
+            self.timer = None
+            if self.stage.streaming:
+                # A path is being streamed, jog once it is done
+                self._schedule()
+                return
+            delta, self.pending = self.pending, {axis: 0.0 for axis in AXES}
+        if any(delta.values()):
+            self.stage.in_background(self._send, delta)
+
+    def _send(self, delta):
+        # Relative moves add up, the order of two jogs racing for the lock does not matter
+        with self.stage.lock:
+            self.stage.move_relative(delta['x'], delta['y'], delta['z'])
@@ -0,0 +1,251 @@
+"""Kinematic model of the Ender stage.
+
+Predicts how long Marlin takes to execute a move from the per-axis
+feedrate and acceleration limits (M203/M201), the travel acceleration
+(M204 T) and the junction deviation or classic jerk (M205), so that
+acquisition code can wait for the stage exactly as long as needed instead
+of sleeping a fixed amount. The limits can be read from the controller
+(M503), set by hand, or fitted from timed moves with calibrate().
+
+Everything but calibrate() is pure Python and does not need the stage.
+"""
+import math
+import re
+import time
+
+AXES = ('x', 'y', 'z')
+
+# Stock Ender 3 Marlin configuration
+DEFAULT_MAX_FEEDRATE = {'x': 500.0, 'y': 500.0, 'z': 5.0}  # mm/s
+DEFAULT_MAX_ACCELERATION = {'x': 500.0, 'y': 500.0, 'z': 100.0}  # mm/s^2
+DEFAULT_ACCELERATION = 500.0  # mm/s^2, M204 T
+DEFAULT_FEEDRATE = 25.0  # mm/s, Marlin's feedrate until an F word is sent
+DEFAULT_SETTLE_TIME = 0.05  # s, vibrations dying out after the stage stops
+
+SETTING_PATTERN = re.compile(r"\b(M20[1345])((?:\s+[A-Z]-?\d+\.?\d*)+)")
+VALUE_PATTERN = re.compile(r"([A-Z])(-?\d+\.?\d*)")
+
+
+def as_delta(delta):
+    """Accept (dx, dy[, dz]) tuples or {'x': .., 'y': .., 'z': ..} dicts; None counts as 0."""
+    if isinstance(delta, dict):
+        return {axis: float(delta.get(axis) or 0.0) for axis in AXES}
+    values = list(delta) + [0.0] * (3 - len(delta))
+    return {axis: float(value or 0.0) for axis, value in zip(AXES, values)}
+
+
+def trapezoid_time(distance, v_start, v_max, acceleration):
+    """Duration of a move starting and ending at v_start, cruising at v_max if it gets there."""
+    if distance <= 0:
+        return 0.0
+    v_start = min(v_start, v_max)
+    ramp = (v_max ** 2 - v_start ** 2) / (2 * acceleration)
+    if 2 * ramp >= distance:
+        # Triangular profile: the move is too short to reach v_max
+        v_peak = math.sqrt(v_start ** 2 + acceleration * distance)
+        return 2 * (v_peak - v_start) / acceleration
+    return 2 * (v_max - v_start) / acceleration + (distance - 2 * ramp) / v_max
+
+
+def trapezoid_distance(distance, v_start, v_max, acceleration, t):
+    """Distance covered `t` seconds into the move described by trapezoid_time()."""
+    if t <= 0 or distance <= 0:
+        return 0.0
+    total = trapezoid_time(distance, v_start, v_max, acceleration)
+    if t >= total:
+        return distance
+    v_start = min(v_start, v_max)
+    ramp = (v_max ** 2 - v_start ** 2) / (2 * acceleration)
+    if 2 * ramp >= distance:
+        v_peak = math.sqrt(v_start ** 2 + acceleration * distance)
+        ramp = distance / 2
+    else:
+        v_peak = v_max
+    t_ramp = (v_peak - v_start) / acceleration
+    if t <= t_ramp:
+        return v_start * t + acceleration * t ** 2 / 2
+    t_cruise = total - 2 * t_ramp
+    if t <= t_ramp + t_cruise:
+        return ramp + v_peak * (t - t_ramp)
+    # Decelerating: mirror image of the acceleration ramp
+    left = total - t
+    return distance - (v_start * left + acceleration * left ** 2 / 2)
+
+
+class MotionModel:
+    def __init__(self, max_feedrate=None, max_acceleration=None, acceleration=DEFAULT_ACCELERATION,
+                 junction_deviation=0.08, jerk=None, feedrate=DEFAULT_FEEDRATE,
+                 settle_time=DEFAULT_SETTLE_TIME):
+        """
+        :param max_feedrate: per-axis speed limits in mm/s (M203)
+        :param max_acceleration: per-axis acceleration limits in mm/s^2 (M201)
+        :param acceleration: travel acceleration in mm/s^2 (M204 T)
+        :param junction_deviation: mm (M205 J), used when jerk is None
+        :param jerk: per-axis classic jerk in mm/s (M205 X/Y/Z) or None
+        :param feedrate: feedrate in mm/s used for moves without an F word
+        :param settle_time: time in s added after the stage stops
+        """
+        self.max_feedrate = dict(max_feedrate or DEFAULT_MAX_FEEDRATE)
+        self.max_acceleration = dict(max_acceleration or DEFAULT_MAX_ACCELERATION)
+        self.acceleration = acceleration
+        self.junction_deviation = junction_deviation
+        self.jerk = dict(jerk) if jerk else None
+        self.feedrate = feedrate
+        self.settle_time = settle_time
+
+    def profile(self, delta, feedrate=None):
+        """(distance, start speed, cruise speed, acceleration) of a move, in mm and seconds."""
+        delta = as_delta(delta)
+        distance = math.sqrt(sum(value ** 2 for value in delta.values()))
+        if distance == 0:
+            return 0.0, 0.0, 0.0, self.acceleration
+        v_max = feedrate if feedrate is not None else self.feedrate
+        acceleration = self.acceleration
+        for axis in AXES:
+            share = abs(delta[axis]) / distance
+            if share > 0:
+                # Marlin scales the whole move so that no axis exceeds its limits
+                v_max = min(v_max, self.max_feedrate[axis] / share)
+                acceleration = min(acceleration, self.max_acceleration[axis] / share)
+        v_start = 0.0
+        if self.jerk:
+            # Classic jerk: the stage may start instantly at the jerk speed
+            v_start = min(self.jerk[axis] / (abs(delta[axis]) / distance)
+                          for axis in AXES if delta[axis] != 0)
+        return distance, min(v_start, v_max), v_max, acceleration
+
+    def move_time(self, delta, feedrate=None):
+        """Predicted duration in seconds of a single move from rest to rest.
+
+        :param delta: displacement (dx, dy, dz) in mm
+        :param feedrate: requested speed in mm/s, None for the current default
+        """
+        return trapezoid_time(*self.profile(delta, feedrate))
+
+    def wait_time(self, delta, feedrate=None):
+        """Time to wait after sending a move before the stage is still."""
+        return self.move_time(delta, feedrate) + self.settle_time
+
+    def path_time(self, points, start=None, feedrate=None):
+        """Duration of a sequence of absolute XYZ targets, stopping at each of them."""
+        total = 0.0
+        previous = as_delta(start) if start is not None else None
+        for point in points:
+            point = as_delta(point)
+            if previous is not None:
+                total += self.move_time({axis: point[axis] - previous[axis] for axis in AXES}, feedrate)
+            previous = point
+        return total
+
+    def update_from_settings(self, text):
+        """Read the limits from the output of M503 (or any M201/M203/M204/M205 lines)."""
+        for command, words in SETTING_PATTERN.findall(text):
+            values = {letter.lower(): float(value) for letter, value in VALUE_PATTERN.findall(words)}
+            if command == 'M203':
+                self.max_feedrate.update({axis: values[axis] for axis in AXES if axis in values})
+            elif command == 'M201':
+                self.max_acceleration.update({axis: values[axis] for axis in AXES if axis in values})
+            elif command == 'M204':
+                # Travel acceleration, older firmware only has S
+                self.acceleration = values.get('t', values.get('s', self.acceleration))
+            elif command == 'M205':
+                if 'j' in values:
+                    self.junction_deviation = values['j']
+                    self.jerk = None
+                elif any(axis in values for axis in AXES):
+                    self.jerk = {axis: values.get(axis, 0.0) for axis in AXES}
+        return self
+
+    @classmethod
+    def from_settings(cls, text, **kwargs):
+        return cls(**kwargs).update_from_settings(text)
+
+
+class MotionClock:
+    """Predicted time at which the moves queued on the controller will be finished.
+
+    Marlin answers 'ok' as soon as a move is in its planner, so the stage is
+    usually still moving when write_code returns.
+    """
+    def __init__(self, model):
+        self.model = model
+        self.end = 0.0
+
+    def queue(self, delta, feedrate=None):
+        now = time.monotonic()
+        self.end = max(self.end, now) + self.model.move_time(delta, feedrate)
+        return self.end
+
+    def stopped(self):
+        """The controller reported the stage still (M400, G28...)."""
+        self.end = time.monotonic()
+
+    def remaining(self):
+        """Seconds until the queued moves are done and the stage has settled."""
+        return max(0.0, self.end + self.model.settle_time - time.monotonic())
+
+    def wait(self):
+        time.sleep(self.remaining())
+
+
+def fit_axis(samples):
+    """Fit (feedrate, acceleration) in mm/s and mm/s^2 to (distance, duration) samples.
+
+    Long moves follow t = d / v + v / a (a line in d), short ones a triangular
+    profile t = 2 * sqrt(d / a). The line is fitted on the longest half of the
+    samples; samples too short to reach v then refine the acceleration.
+    """
+    samples = sorted(samples)
+    if len(samples) < 2:
+        raise ValueError("Need at least two timed moves")
+    long_moves = samples[len(samples) // 2:]
+    if len(long_moves) < 2:
+        long_moves = samples
+    n = len(long_moves)
+    mean_d = sum(d for d, _ in long_moves) / n
+    mean_t = sum(t for _, t in long_moves) / n
+    var_d = sum((d - mean_d) ** 2 for d, _ in long_moves)
+    slope = sum((d - mean_d) * (t - mean_t) for d, t in long_moves) / var_d if var_d else 0.0
+    intercept = mean_t - slope * mean_d
+    if slope <= 0:
+        raise ValueError("Durations do not grow with distance, cannot fit the axis")
+    feedrate = 1.0 / slope
+    acceleration = feedrate / intercept if intercept > 0 else math.inf
+
+    short_moves = [(d, t) for d, t in samples if d < feedrate ** 2 / acceleration and t > 0]
+    if short_moves:
+        acceleration = sum(4 * d / t ** 2 for d, t in short_moves) / len(short_moves)
+    return feedrate, acceleration
+
+
+def calibrate(stage, axis='z', distances=(0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0), feedrate=None):
+    """Fit stage.motion for one axis from timed back-and-forth moves on the real stage.
+
+    Each move is followed by an M400, whose ok marks the end of the motion;
+    the round-trip of a zero-length move plus M400 is measured first and
+    subtracted. feedrate is in mm/s (None keeps the current one).
+
+    :returns: the fitted (feedrate, acceleration)
+    """
+    model = stage.motion
+    index = AXES.index(axis)
+    F = None if feedrate is None else feedrate * 60
+
+    def timed_move(distance):
+        delta = [0, 0, 0]
+        delta[index] = distance
+        start = time.perf_counter()
+        stage.move_relative(*delta, feedrate=F)
+        stage.write_code('M400')
+        return time.perf_counter() - start
+
+    overhead = min(timed_move(0) for _ in range(3))
+    samples = []
+    for distance in distances:
+        for sign in (1, -1):
+            samples.append((distance, max(0.0, timed_move(sign * distance) - overhead)))
+    fitted_feedrate, fitted_acceleration = fit_axis(samples)
+    model.max_feedrate[axis] = fitted_feedrate
+    if math.isfinite(fitted_acceleration):
+        model.max_acceleration[axis] = fitted_acceleration
+    return fitted_feedrate, fitted_acceleration
@@ -0,0 +1,151 @@
+"""Visiting order of positions and tiles that minimises travel time.
+
+Distances are move durations predicted by motion_model, so the slow Z axis
+and the acceleration limits of each axis weigh as much as they do on the
+real stage. The route is built by nearest neighbour and improved by 2-opt
+(reversing a stretch of the route) and Or-opt (moving a run of 1-3 stops
+elsewhere) until neither helps. The start and end can be fixed (current
+stage position, return to the first position for the next timelapse
+frame) or left free.
+
+    optimizer = PathOptimizer(stage.motion)
+    order, report = optimizer.order(positions, start=stage.position)
+
+Orders are cached, so recompiling the same plan reuses them.
+"""
+import numpy as np
+
+from ender_log import get_logger
+from motion_model import AXES, MotionModel, as_delta
+
+logger = get_logger('path_order')
+
+
+def travel_matrix(points, model, feedrate=None):
+    """Predicted move time in seconds between every pair of points."""
+    points = [as_delta(point) for point in points]
+    n = len(points)
+    matrix = np.zeros((n, n))
+    for i in range(n):
+        for j in range(i + 1, n):
+            delta = {axis: points[j][axis] - points[i][axis] for axis in AXES}
+            matrix[i, j] = matrix[j, i] = model.move_time(delta, feedrate)
+    return matrix
+
+
+def route_time(route, matrix):
+    return float(sum(matrix[a, b] for a, b in zip(route[:-1], route[1:])))
+
+
+def nearest_neighbour(matrix, first, stops, last):
+    """Route first -> stops (greedy nearest) -> last."""
+    route = [first]
+    remaining = set(stops)
+    while remaining:
+        current = route[-1]
+        following = min(remaining, key=lambda stop: (matrix[current, stop], stop))
+        route.append(following)
+        remaining.remove(following)
+    route.append(last)
+    return route
+
+
+def two_opt(route, matrix):
+    """Reverse stretches of the route while it gets shorter; the two ends stay in place."""
+    improved = True
+    while improved:
+        improved = False
+        for i in range(1, len(route) - 2):
+            for j in range(i + 1, len(route) - 1):
+                a, b, c, d = route[i - 1], route[i], route[j], route[j + 1]
+                if matrix[a, c] + matrix[b, d] < matrix[a, b] + matrix[c, d] - 1e-9:
+                    route[i:j + 1] = route[i:j + 1][::-1]
+                    improved = True
+    return route
+
+
+def or_opt(route, matrix, max_segment=3):
+    """Move runs of up to max_segment stops (possibly reversed) where they cost least."""
+    improved = True
+    while improved:
+        improved = False
+        for length in range(1, max_segment + 1):
+            for i in range(1, len(route) - length):
+                segment = route[i:i + length]
+                before, after = route[i - 1], route[i + length]
+                removed = matrix[before, segment[0]] + matrix[segment[-1], after] - matrix[before, after]
+                rest = route[:i] + route[i + length:]
+                best = None
+                for k in range(len(rest) - 1):
+                    if k == i - 1:
+                        continue
+                    a, b = rest[k], rest[k + 1]
+                    for candidate in (segment, segment[::-1]):
+                        added = matrix[a, candidate[0]] + matrix[candidate[-1], b] - matrix[a, b]
+                        if added < removed - 1e-9 and (best is None or added < best[0]):
+                            best = (added, k, candidate)
+                if best is not None:
+                    _, k, candidate = best
+                    route[:] = rest[:k + 1] + list(candidate) + rest[k + 1:]
+                    improved = True
+                    break
+            if improved:
+                break
+    return route
+
+
+class PathOptimizer:
+    def __init__(self, model=None, feedrate=None):
+        """
+        :param model: motion_model.MotionModel giving the move times (stage.motion)
+        :param feedrate: feedrate of the moves in mm/s, None for the model default
+        """
+        self.model = model or MotionModel()
+        self.feedrate = feedrate
+        self.cache = {}
+
+    def _key(self, points, start, end):
+        def rounded(point):
+            return None if point is None else tuple(round(value, 4) for value in as_delta(point).values())
+        model = (tuple(self.model.max_feedrate.values()), tuple(self.model.max_acceleration.values()),
+                 self.model.acceleration, self.feedrate)
+        return tuple(rounded(point) for point in points), rounded(start), rounded(end), model
+
+    def order(self, points, start=None, end=None):
+        """Visiting order of `points` (indices) and a report of the time saved.
+
+        :param start: position the stage is at before the first point, None if free
+        :param end: position to finish at (e.g. the first point for a timelapse), None if free
+        :returns: (order, {'naive_s', 'optimized_s', 'saved_s'})
+        """
+        key = self._key(points, start, end)
+        if key in self.cache:
+            return self.cache[key]
+        n = len(points)
+        # Two extra nodes for the ends; a free end costs nothing to reach
+        nodes = list(points) + [start if start is not None else points[0], end if end is not None else points[0]]
+        matrix = travel_matrix(nodes, self.model, self.feedrate)
+        first, last = n, n + 1
+        if start is None:
+            matrix[first, :] = matrix[:, first] = 0.0
+        if end is None:
+            matrix[last, :] = matrix[:, last] = 0.0
+        matrix[first, last] = matrix[last, first] = 0.0
+
+        naive = route_time([first] + list(range(n)) + [last], matrix)
+        route = nearest_neighbour(matrix, first, range(n), last)
+        if n > 2:
+            previous = None
+            while previous != route:
+                previous = list(route)
+                two_opt(route, matrix)
+                or_opt(route, matrix)
+        optimized = route_time(route, matrix)
+        if optimized > naive:
+            route = [first] + list(range(n)) + [last]
+            optimized = naive
+        report = {'naive_s': naive, 'optimized_s': optimized, 'saved_s': naive - optimized}
+        result = (route[1:-1], report)
+        self.cache[key] = result
+        logger.info(f"Travel of {n} stops: {naive:.1f} s -> {optimized:.1f} s")
+        return result
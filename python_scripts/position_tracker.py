@@ -0,0 +1,72 @@
+"""Dead-reckoning model of the stage position.
+
+The commanded position is updated locally on every move, so reading it
+costs nothing. Position reports from the controller (M114 replies or the
+M154 auto-report) are fed in as they arrive and kept as the reported
+position; the two are compared to detect lost steps or moves made behind
+our back.
+"""
+import time
+
+from gcode_utils import parse_position
+
+AXES = ('x', 'y', 'z')
+
+
+class PositionTracker:
+    def __init__(self, tolerance=0.05):
+        """
+        :param tolerance: distance (mm) on any axis above which commanded and
+            reported positions are considered to have diverged
+        """
+        self.tolerance = tolerance
+        self.commanded = {axis: 0.0 for axis in AXES}
+        self.reported = None
+        self.reported_time = None
+        # False until homing or a report tells us where the stage really is
+        self.known = False
+
+    def move_absolute(self, x, y, z=None):
+        self.commanded = {'x': x, 'y': y, 'z': z if z is not None else self.commanded['z']}
+
+    def move_relative(self, x, y, z=None):
+        self.commanded['x'] += x
+        self.commanded['y'] += y
+        if z is not None:
+            self.commanded['z'] += z
+
+    def home(self):
+        self.commanded = {axis: 0.0 for axis in AXES}
+        self.known = True
+
+    def invalidate(self):
+        """Forget what we know, e.g. after a reset or an error; the next read goes to the hardware."""
+        self.known = False
+
+    def feed(self, response):
+        """Record a position report if `response` is one; returns True when it was."""
+        position = parse_position(response)
+        if position is None:
+            return False
+        self.reported = {axis: position[axis.upper()] for axis in AXES}
+        self.reported_time = time.monotonic()
+        if not self.known:
+            self.commanded = dict(self.reported)
+            self.known = True
+        return True
+
+    def divergence(self):
+        """Commanded minus reported position per axis, or None without a report.
+
+        Only meaningful once the stage is stationary: reports sent during a
+        move lag behind the commanded target.
+        """
+        if self.reported is None:
+            return None
+        return {axis: self.commanded[axis] - self.reported[axis] for axis in AXES}
+
+    def diverged(self):
+        divergence = self.divergence()
+        if divergence is None:
+            return False
+        return any(abs(value) > self.tolerance for value in divergence.values())
@@ -0,0 +1,211 @@
+"""Frame-dropping live preview.
+
+The preview is split in stages running in their own threads:
+
+    grab -> decimate + contrast stretch -> JPEG encode -> display
+
+Each stage hands its result to the next through a LatestSlot, a buffer
+holding a single item where a new frame replaces the one not consumed yet.
+A slow stage therefore never builds a backlog: the preview shows the most
+recent frame the slowest stage could handle, and the other frames are
+dropped. The grab stage is also capped at a target frame rate.
+
+Contrast is stretched with a 256-entry lookup table built from the
+percentiles of the frame histogram, so that the per-pixel work is a single
+uint8 table lookup instead of float arithmetic.
+"""
+import io
+import math
+import threading
+import time
+
+import numpy as np
+from PIL import Image
+
+STAGES = ('grab', 'process', 'encode', 'display')
+
+
+class LatestSlot:
+    """Buffer of one item: put() replaces the item not taken yet."""
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.item = None
+        self.dropped = 0
+        self.closed = False
+
+    def put(self, item):
+        with self.condition:
+            if self.item is not None:
+                self.dropped += 1
+            self.item = item
+            self.condition.notify()
+
+    def get(self, timeout=None):
+        """Wait for an item and take it; None once the slot is closed."""
+        with self.condition:
+            while self.item is None and not self.closed:
+                if not self.condition.wait(timeout):
+                    return None
+            item, self.item = self.item, None
+            return item
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+def decimate(frame, max_width):
+    """Keep every n-th row and column so that the frame is at most max_width wide (a view)."""
+    step = max(1, math.ceil(frame.shape[1] / max_width))
+    return frame[::step, ::step]
+
+
+def stretch_lut(frame, clip=(0.5, 99.5), sample_step=4):
+    """Lookup table mapping the clip percentiles of a uint8 frame to 0..255."""
+    histogram = np.bincount(frame[::sample_step, ::sample_step].ravel(), minlength=256)
+    cumulative = np.cumsum(histogram)
+    total = cumulative[-1]
+    low = int(np.searchsorted(cumulative, total * clip[0] / 100))
+    high = int(np.searchsorted(cumulative, total * clip[1] / 100))
+    scale = 255.0 / max(1, high - low)
+    return np.clip((np.arange(256) - low) * scale, 0, 255).astype(np.uint8)
+
+
+def stretch(frame, clip=(0.5, 99.5)):
+    """Contrast stretch of a grayscale frame, returned as uint8."""
+    if frame.dtype != np.uint8:
+        # Wider frames (raw, float) are reduced to 8 bits first
+        low, high = np.percentile(frame[::4, ::4], clip)
+        return np.clip((frame - low) * (255.0 / max(1e-9, high - low)), 0, 255).astype(np.uint8)
+    return stretch_lut(frame, clip)[frame]
+
+
+def encode_jpeg(frame, quality=80):
+    with io.BytesIO() as output:
+        Image.fromarray(np.ascontiguousarray(frame)).save(output, format="JPEG", quality=quality)
+        return output.getvalue()
+
+
+class PreviewPipeline:
+    def __init__(self, grab, show, target_fps=15.0, max_width=640, clip=(0.5, 99.5), quality=80):
+        """
+        :param grab: callable returning the next grayscale frame (e.g. camera.capture_lores)
+        :param show: callable receiving the JPEG bytes (e.g. setting widgets.Image.value)
+        :param target_fps: maximum number of frames grabbed per second
+        :param max_width: frames are decimated to at most this width
+        :param clip: percentiles mapped to black and white
+        :param quality: JPEG quality
+        """
+        self.grab = grab
+        self.show = show
+        self.target_fps = target_fps
+        self.max_width = max_width
+        self.clip = clip
+        self.quality = quality
+        self.running = False
+        self.threads = []
+        self.slots = {stage: LatestSlot() for stage in STAGES[1:]}
+        self.latency = {stage: 0.0 for stage in STAGES}
+        self.counts = {stage: 0 for stage in STAGES}
+        self.error = None
+        self._fps_start = time.monotonic()
+        self._fps_count = 0
+        self.fps = 0.0
+
+    def start(self):
+        self.running = True
+        self.slots = {stage: LatestSlot() for stage in STAGES[1:]}
+        self.threads = [
+            threading.Thread(target=self._grab_loop, name="preview-grab", daemon=True),
+            threading.Thread(target=self._stage_loop, args=('process', self._process, 'encode'),
+                             name="preview-process", daemon=True),
+            threading.Thread(target=self._stage_loop, args=('encode', self._encode, 'display'),
+                             name="preview-encode", daemon=True),
+            threading.Thread(target=self._stage_loop, args=('display', self._display, None),
+                             name="preview-display", daemon=True),
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self, timeout=2.0):
+        self.running = False
+        for slot in self.slots.values():
+            slot.close()
+        for thread in self.threads:
+            if thread is not threading.current_thread():
+                thread.join(timeout)
+        self.threads = []
+
+    def _timed(self, stage, function, item):
+        start = time.perf_counter()
+        result = function(item)
+        elapsed = time.perf_counter() - start
+        # Exponential moving average, in seconds
+        self.latency[stage] += 0.1 * (elapsed - self.latency[stage])
+        self.counts[stage] += 1
+        return result
+
+    def _grab_loop(self):
+        period = 1.0 / self.target_fps if self.target_fps else 0.0
+        next_grab = time.monotonic()
+        while self.running:
+            delay = next_grab - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            next_grab = max(next_grab + period, time.monotonic())
+            try:
+                frame = self._timed('grab', lambda _: self.grab(), None)
+            except Exception as error:
+                self.error = error
+                self.running = False
+                break
+            self.slots['process'].put(frame)
+        for slot in self.slots.values():
+            slot.close()
+
+    def _stage_loop(self, stage, function, next_stage):
+        slot = self.slots[stage]
+        while self.running:
+            item = slot.get(timeout=0.5)
+            if item is None:
+                continue
+            try:
+                result = self._timed(stage, function, item)
+            except Exception as error:
+                self.error = error
+                self.stop()
+                break
+            if next_stage is not None:
+                self.slots[next_stage].put(result)
+
+    def _process(self, frame):
+        return stretch(decimate(frame, self.max_width), self.clip)
+
+    def _encode(self, frame):
+        return encode_jpeg(frame, self.quality)
+
+    def _display(self, jpeg):
+        # Frames encoded while the previous one was being pushed to the front
+        # end replace each other in the slot, only the latest is shown.
+        self.show(jpeg)
+        self._fps_count += 1
+        now = time.monotonic()
+        if now - self._fps_start >= 1.0:
+            self.fps = self._fps_count / (now - self._fps_start)
+            self._fps_start, self._fps_count = now, 0
+
+    def stats(self):
+        """Displayed frame rate, per-stage latency in ms and frames dropped before each stage."""
+        return {
+            'fps': self.fps,
+            'latency_ms': {stage: 1000 * value for stage, value in self.latency.items()},
+            'frames': dict(self.counts),
+            'dropped': {stage: slot.dropped for stage, slot in self.slots.items()},
+        }
+
+    def stats_html(self):
+        stats = self.stats()
+        latency = ", ".join(f"{stage} {value:.1f}" for stage, value in stats['latency_ms'].items())
+        dropped = sum(stats['dropped'].values())
+        return f"{stats['fps']:.1f} fps | latency ms: {latency} | dropped: {dropped}"
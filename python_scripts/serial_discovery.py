@@ -0,0 +1,163 @@
+"""Fast serial port discovery.
+
+Ports are enumerated from metadata (serial.tools.list_ports, or sysfs on
+Linux) instead of opening every /dev/tty* in turn. Only the ports matching
+a known device profile are probed, in parallel and with a timeout, and the
+result is cached on disk keyed on the set of connected devices, so that a
+notebook restart with the same hardware plugged in does not probe at all.
+
+    from serial_discovery import find_stage_port
+    stage = Stage(port=find_stage_port())
+"""
+import glob
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import serial
+
+# USB bridges found on the boards driving the stage
+DEVICE_PROFILES = [
+    {'name': 'CH340 (Creality 1.1.x / 4.2.x boards)', 'vid': 0x1A86, 'pid': 0x7523, 'firmware': 'marlin'},
+    {'name': 'STM32 virtual COM port (Creality, BTT SKR)', 'vid': 0x0483, 'pid': 0x5740, 'firmware': 'marlin'},
+    {'name': 'LPC176x virtual COM port (BTT SKR 1.x)', 'vid': 0x1D50, 'pid': 0x6029, 'firmware': 'marlin'},
+    {'name': 'FTDI FT232R', 'vid': 0x0403, 'pid': 0x6001, 'firmware': 'marlin'},
+    {'name': 'Silicon Labs CP210x', 'vid': 0x10C4, 'pid': 0xEA60, 'firmware': 'marlin'},
+    {'name': 'Arduino Mega 2560', 'vid': 0x2341, 'pid': 0x0042, 'firmware': 'marlin'},
+]
+CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'enderscope', 'serial_ports.json')
+PROBE_TIMEOUT = 3.0  # seconds, opening the port resets most boards
+
+
+def list_ports():
+    """Describe the serial ports present, without opening any of them.
+
+    :returns: a list of dicts with 'device', 'vid', 'pid', 'serial_number'
+        and 'description' (None when unknown)
+    """
+    try:
+        from serial.tools import list_ports as pyserial_list_ports
+    except ImportError:
+        return _sysfs_ports()
+    return [{'device': port.device, 'vid': port.vid, 'pid': port.pid,
+             'serial_number': port.serial_number, 'description': port.description}
+            for port in pyserial_list_ports.comports()]
+
+
+def _sysfs_ports():
+    ports = []
+    for tty in sorted(glob.glob('/sys/class/tty/*/device')):
+        name = tty.split('/')[-2]
+        entry = {'device': f'/dev/{name}', 'vid': None, 'pid': None,
+                 'serial_number': None, 'description': name}
+        # Walk up from the tty's device to the USB device holding the IDs
+        path = os.path.realpath(tty)
+        while path != '/' and not os.path.exists(os.path.join(path, 'idVendor')):
+            path = os.path.dirname(path)
+        if path != '/':
+            entry['vid'] = int(_read(path, 'idVendor'), 16)
+            entry['pid'] = int(_read(path, 'idProduct'), 16)
+            entry['serial_number'] = _read(path, 'serial')
+            entry['description'] = _read(path, 'product') or name
+        ports.append(entry)
+    return ports
+
+
+def _read(path, name):
+    try:
+        with open(os.path.join(path, name)) as file:
+            return file.read().strip()
+    except OSError:
+        return None
+
+
+def match_profile(port, profiles=DEVICE_PROFILES):
+    for profile in profiles:
+        if port['vid'] == profile['vid'] and port['pid'] == profile['pid']:
+            return profile
+    return None
+
+
+def fingerprint(ports):
+    """Cache key identifying the set of connected devices."""
+    devices = sorted((p['device'], p['vid'], p['pid'], p['serial_number']) for p in ports)
+    return hashlib.sha1(json.dumps(devices).encode('utf-8')).hexdigest()
+
+
+def probe(device, baud_rate=115200, timeout=PROBE_TIMEOUT):
+    """Ask a port for its firmware (M115); returns the reply line or None."""
+    deadline = time.monotonic() + timeout
+    try:
+        with serial.Serial(device, baud_rate, timeout=0.2, write_timeout=timeout) as port:
+            port.write(b"M115\n")
+            while time.monotonic() < deadline:
+                line = port.readline().decode('utf-8', errors='replace').strip()
+                if 'FIRMWARE_NAME' in line:
+                    return line
+                if line == 'start':
+                    # The board rebooted when the port opened, ask again
+                    port.write(b"M115\n")
+    except (OSError, serial.SerialException):
+        pass
+    return None
+
+
+def _load_cache(path):
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_cache(path, cache):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary = f"{path}.tmp"
+    with open(temporary, 'w') as file:
+        json.dump(cache, file, indent=1)
+    os.replace(temporary, path)
+
+
+def discover(profiles=DEVICE_PROFILES, probe_ports=True, baud_rate=115200,
+             timeout=PROBE_TIMEOUT, use_cache=True, cache_path=CACHE_PATH):
+    """Find the ports with a stage controller behind them.
+
+    Ports matching `profiles` are the candidates (every USB port if none
+    match). With probe_ports, candidates are asked for their firmware in
+    parallel and only those answering are kept.
+
+    :returns: a list of dicts with 'device', 'profile' and 'firmware'
+    """
+    ports = list_ports()
+    key = fingerprint(ports)
+    cache = _load_cache(cache_path) if use_cache else {}
+    if key in cache:
+        return cache[key]
+
+    candidates = [(port, match_profile(port, profiles)) for port in ports]
+    candidates = [(port, profile) for port, profile in candidates if profile is not None] \
+        or [(port, None) for port in ports if port['vid'] is not None]
+
+    if probe_ports and candidates:
+        with ThreadPoolExecutor(max_workers=len(candidates)) as pool:
+            replies = list(pool.map(lambda c: probe(c[0]['device'], baud_rate, timeout), candidates))
+    else:
+        replies = [None] * len(candidates)
+
+    found = [{'device': port['device'],
+              'profile': profile['name'] if profile is not None else port['description'],
+              'firmware': reply}
+             for (port, profile), reply in zip(candidates, replies)
+             if reply is not None or not probe_ports]
+    if use_cache and found:
+        cache[key] = found
+        _save_cache(cache_path, cache)
+    return found
+
+
+def find_stage_port(**kwargs):
+    """Device name of the first stage controller found, or None."""
+    found = discover(**kwargs)
+    return found[0]['device'] if found else None
@@ -0,0 +1,132 @@
+"""Timing of the commands sent on the serial link.
+
+Enabled with ``stage.enable_stats()``; while ``stage.stats`` is None the
+write paths skip all bookkeeping, so instrumentation can stay in place in
+production. Each acknowledged command records when it was sent, when the
+first line of its answer came back, when its 'ok' arrived, the bytes sent
+and received and how many 'busy:' lines Marlin printed while working on
+it. Samples are grouped by G-code (G0, M114, M400...).
+"""
+import csv
+import json
+import time
+from collections import defaultdict, deque
+
+COLUMNS = ('command', 'count', 'mean_ms', 'p50_ms', 'p90_ms', 'p99_ms', 'max_ms',
+           'first_byte_p50_ms', 'bytes_out', 'bytes_in', 'busy')
+
+
+def command_word(code):
+    """'N12 G0 X1*71' -> 'G0'"""
+    words = code.split('*')[0].split()
+    if words and words[0].startswith('N') and len(words) > 1:
+        words = words[1:]
+    return words[0].upper() if words else ''
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not values:
+        return None
+    index = min(len(values) - 1, max(0, int(round(fraction * (len(values) - 1)))))
+    return values[index]
+
+
+class SerialStats:
+    def __init__(self, max_samples=2000):
+        """:param max_samples: samples kept per command for the percentiles"""
+        self.max_samples = max_samples
+        self.reset()
+
+    def reset(self):
+        self.round_trips = defaultdict(lambda: deque(maxlen=self.max_samples))
+        self.first_bytes = defaultdict(lambda: deque(maxlen=self.max_samples))
+        self.totals = defaultdict(lambda: {'count': 0, 'bytes_out': 0, 'bytes_in': 0, 'busy': 0})
+        self.started = time.monotonic()
+
+    def record(self, code, sent, first_byte, ok, bytes_out, bytes_in, busy=0):
+        """Record one acknowledged command; times are time.perf_counter() values."""
+        command = command_word(code)
+        self.round_trips[command].append(ok - sent)
+        self.first_bytes[command].append(first_byte - sent)
+        totals = self.totals[command]
+        totals['count'] += 1
+        totals['bytes_out'] += bytes_out
+        totals['bytes_in'] += bytes_in
+        totals['busy'] += busy
+
+    def summary(self):
+        """One dict per command with latency percentiles in milliseconds, see COLUMNS."""
+        rows = []
+        for command in sorted(self.totals):
+            round_trips = sorted(self.round_trips[command])
+            first_bytes = sorted(self.first_bytes[command])
+            totals = self.totals[command]
+            rows.append({
+                'command': command,
+                'count': totals['count'],
+                'mean_ms': 1000 * sum(round_trips) / len(round_trips),
+                'p50_ms': 1000 * percentile(round_trips, 0.5),
+                'p90_ms': 1000 * percentile(round_trips, 0.9),
+                'p99_ms': 1000 * percentile(round_trips, 0.99),
+                'max_ms': 1000 * round_trips[-1],
+                'first_byte_p50_ms': 1000 * percentile(first_bytes, 0.5),
+                'bytes_out': totals['bytes_out'],
+                'bytes_in': totals['bytes_in'],
+                'busy': totals['busy'],
+            })
+        return rows
+
+    def histogram(self, command, bins=10):
+        """(edges_ms, counts) of the round-trip times of one command."""
+        values = [1000 * value for value in self.round_trips[command]]
+        if not values:
+            return [], []
+        low, high = min(values), max(values)
+        width = (high - low) / bins or 1.0
+        counts = [0] * bins
+        for value in values:
+            counts[min(bins - 1, int((value - low) / width))] += 1
+        return [low + i * width for i in range(bins + 1)], counts
+
+    def to_json(self, path=None):
+        data = {'duration_s': time.monotonic() - self.started, 'commands': self.summary()}
+        text = json.dumps(data, indent=1)
+        if path is not None:
+            with open(path, 'w') as file:
+                file.write(text)
+        return text
+
+    def to_csv(self, path):
+        with open(path, 'w', newline='') as file:
+            writer = csv.DictWriter(file, fieldnames=COLUMNS)
+            writer.writeheader()
+            writer.writerows(self.summary())
+
+    def to_html(self):
+        header = "".join(f"<th>{column}</th>" for column in COLUMNS)
+        rows = ""
+        for row in self.summary():
+            cells = "".join(f"<td>{row[column]:.1f}</td>" if isinstance(row[column], float)
+                            else f"<td>{row[column]}</td>" for column in COLUMNS)
+            rows += f"<tr>{cells}</tr>"
+        return f"<table><tr>{header}</tr>{rows}</table>"
+
+    def get_widget(self):
+        """Small table of the statistics with a refresh button."""
+        import ipywidgets as widgets
+
+        table = widgets.HTML(value=self.to_html())
+        refresh_button = widgets.Button(description="Refresh", icon='refresh')
+        reset_button = widgets.Button(description="Reset")
+
+        def refresh(b):
+            table.value = self.to_html()
+
+        def reset(b):
+            self.reset()
+            refresh(b)
+
+        refresh_button.on_click(refresh)
+        reset_button.on_click(reset)
+        return widgets.VBox([widgets.HBox([refresh_button, reset_button]), table])
@@ -1,37 +1,60 @@
-import glob
-import sys
-from time import sleep
+import asyncio
+import functools
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter, sleep
 
 import serial
 
+from async_stage import AsyncStage
+from ender_log import get_logger
+from gcode_utils import MODAL_CODES, ModalState, number_line, parse_ok, parse_position, parse_resend
+from jog_coalescer import JogCoalescer
+from motion_model import MotionClock, MotionModel
+from position_tracker import PositionTracker
+from serial_discovery import list_ports
+from serial_stats import SerialStats
+from stage_path import iter_path
+
+logger = get_logger('serial')
+
+G_CODE_RESET_LINE_NUMBER = 'M110 N0'
+HISTORY_SIZE = 256
+G_CODES = {
+    'absolute': 'G90',
+    'relative': 'G91',
+    'homing': 'G28',
+    'finish': 'M400',
+    'current_position': 'M114',
+    'real_position': 'M114 R',
+    'position_report': 'M154'
+}
+
 
 def serial_ports():
     """ Lists serial port names
-    		from: https://stackoverflow.com/a/14224477
-        :raises EnvironmentError:
-            On unsupported or unknown platforms
+
+        Ports are read from the system's device metadata rather than opened
+        one by one, see serial_discovery for probing and device profiles.
         :returns:
             A list of the serial ports available on the system
     """
-    if sys.platform.startswith('win'):
-        ports = [f'COM{i + 1}' for i in range(256)]
-    elif sys.platform.startswith('linux') or sys.platform.startswith('cygwin'):
-        # this excludes your current terminal "/dev/tty"
-        ports = glob.glob('/dev/tty[A-Za-z]*')
-    elif sys.platform.startswith('darwin'):
-        ports = glob.glob('/dev/tty.*')
-    else:
-        raise EnvironmentError('Unsupported platform')
-
-    result = []
-    for port in ports:
-        try:
-            s = serial.Serial(port)
-            s.close()
-            result.append(port)
-        except (OSError, serial.SerialException):
-            pass
-    return result
+    return [port['device'] for port in list_ports()]
+
+
+def serialized(method):
+    """Run a SerialDevice method holding the device lock.
+
+    Commands sent from another thread (e.g. the jog timer) then cannot
+    interleave with a move or a query in progress.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
 
 
 def open_port(com, port, speed):
@@ -47,18 +70,70 @@ def open_port(com, port, speed):
 
 class SerialDevice:
     def __init__(self, port, baud_rate, parity=serial.PARITY_NONE,
-                 stop_bits=serial.STOPBITS_ONE, byte_size=serial.EIGHTBITS):
-        self.serial = serial.Serial()
-        self.serial.port = port
+                 stop_bits=serial.STOPBITS_ONE, byte_size=serial.EIGHTBITS,
+                 connection=None):
+        if connection is not None:
+            # Already opened serial-like object (e.g. fake_marlin.FakeMarlin)
+            self.serial = connection
+        else:
+            self.serial = serial.Serial()
+            self.serial.port = port
+
+            self.serial.baudrate = baud_rate
+            self.serial.parity = parity
+            self.serial.stopbits = stop_bits
+            self.serial.bytesize = byte_size
+
+            self.serial.open()
+        while not self.serial.isOpen():
+            sleep(0.1)
+
+        # Held for a whole exchange with the controller, see serialized()
+        self.lock = threading.RLock()
+
+        # Streaming state, see start_streaming()
+        self.streaming = False
+        self.window = 1
+        self.line_number = 0
+        self.in_flight = deque()
+        self.history = {}
+        self.resend_queue = deque()
+        self.ignore_resends = 0
+        self.buffer_free = None
+        self.planner_free = None
+        self.responses = deque(maxlen=100)
+
+        # Optional asyncio driver owning the port (see async_stage.AsyncStage);
+        # when set, streamed commands become futures on its event loop
+        self.driver = None
+        self.driver_futures = deque()
+
+        # Command timing, see enable_stats(); None costs nothing
+        self.stats = None
+        self.busy_lines = 0
+
+    def enable_stats(self, stats=None):
+        """Start recording per-command timings; returns the serial_stats.SerialStats."""
+        self.stats = stats if stats is not None else SerialStats()
+        if self.driver is not None:
+            self.driver.stats = self.stats
+        return self.stats
 
-        self.serial.baudrate = baud_rate
-        self.serial.parity = parity
-        self.serial.stopbits = stop_bits
-        self.serial.bytesize = byte_size
+    def disable_stats(self):
+        self.stats = None
+        if self.driver is not None:
+            self.driver.stats = None
 
+    def reconnect(self):
+        """Close and reopen the port, dropping any streamed command still in flight."""
+        self.serial.close()
         self.serial.open()
         while not self.serial.isOpen():
             sleep(0.1)
+        self.streaming = False
+        self.window = 1
+        self.in_flight.clear()
+        self.resend_queue.clear()
 
     def flush_serial_buffer(self):
         while self.serial.in_waiting > 0:
@@ -68,3 +143,424 @@ class SerialDevice:
         if not code.endswith("\n"):
             code += "\n"
         self.serial.write(bytes(code, "utf-8"))
+
+    def start_streaming(self, window=4):
+        """Keep up to `window` numbered commands in flight instead of waiting for each ok.
+
+        Lines are sent as 'N<n> <code>*<checksum>' so that Marlin can ask for
+        a resend on corruption. When the firmware reports ADVANCED_OK slot
+        counts, sending also pauses while its command buffer is full.
+        """
+        if self.streaming:
+            self.synchronize()
+        self.window = max(1, int(window))
+        self.history.clear()
+        self.resend_queue.clear()
+        self.ignore_resends = 0
+        self.buffer_free = None
+        self.planner_free = None
+        self.streaming = True
+        self.line_number = 0
+        if self.driver is not None:
+            # The driver keeps its own window of commands in flight
+            return
+        self._transmit(G_CODE_RESET_LINE_NUMBER)
+
+    def stop_streaming(self):
+        """Wait for every queued command to be acknowledged and go back to blocking mode."""
+        if self.streaming:
+            self.synchronize()
+        self.streaming = False
+        self.window = 1
+
+    def stream_code(self, code):
+        """Queue a command; only blocks while the in-flight window is full."""
+        if self.driver is not None:
+            self.driver_futures.append(self.driver.submit(self.driver.send(code)))
+            return
+        self._send_resends()
+        while not self._can_send():
+            self.read_response()
+            self._send_resends()
+        self.line_number += 1
+        line = number_line(code, self.line_number)
+        self.history[self.line_number] = line
+        if len(self.history) > HISTORY_SIZE:
+            del self.history[min(self.history)]
+        self._transmit(line)
+
+    def synchronize(self, wait_for_moves=False):
+        """Block until every streamed command has been acknowledged.
+
+        With wait_for_moves, an M400 is queued first so that the last ok
+        also means the planner is empty and the stage has stopped.
+        """
+        if wait_for_moves:
+            self.stream_code('M400')
+        while self.driver_futures:
+            self.driver_futures.popleft().result()
+        while self.in_flight or self.resend_queue:
+            self._send_resends()
+            if self.in_flight:
+                self.read_response()
+
+    def read_response(self):
+        """Read one line from the device and update the streaming bookkeeping."""
+        raw = self.serial.readline()
+        response = raw.decode('utf-8', errors='replace')
+        if not response:
+            return response
+        resend = parse_resend(response)
+        if resend is not None:
+            self._request_resend(resend)
+            return response
+        ok = parse_ok(response)
+        if ok is not None:
+            if self.in_flight:
+                line, sent = self.in_flight.popleft()
+                if self.stats is not None:
+                    now = perf_counter()
+                    self.stats.record(line, sent, now, now, len(line) + 1, len(raw), self.busy_lines)
+                    self.busy_lines = 0
+            if ok['buffer'] is not None:
+                self.buffer_free = ok['buffer']
+            if ok['planner'] is not None:
+                self.planner_free = ok['planner']
+        else:
+            self.responses.append(response)
+            if self.stats is not None and 'busy:' in response:
+                self.busy_lines += 1
+        return response
+
+    def _can_send(self):
+        if len(self.in_flight) >= self.window:
+            return False
+        # ADVANCED_OK: never overrun the firmware command buffer
+        return self.buffer_free is None or self.buffer_free > 0 or not self.in_flight
+
+    def _transmit(self, line):
+        # Bypass subclass overrides (Stage.write_code waits for the ok)
+        SerialDevice.write_code(self, line)
+        self.in_flight.append((line, perf_counter()))
+        if self.buffer_free is not None:
+            self.buffer_free = max(0, self.buffer_free - 1)
+
+    def _request_resend(self, line_number):
+        # Every line already in flight behind the bad one gets rejected with
+        # the same request, so only the first one triggers a resend.
+        if self.ignore_resends > 0:
+            self.ignore_resends -= 1
+            return
+        if line_number not in self.history:
+            logger.error(f"Cannot resend line {line_number}: no longer in history")
+            return
+        self.ignore_resends = max(0, len(self.in_flight) - 1)
+        self.resend_queue = deque(self.history[n] for n in sorted(self.history)
+                                  if n >= line_number)
+
+    def _send_resends(self):
+        while self.resend_queue and self._can_send():
+            self._transmit(self.resend_queue.popleft())
+
+
+class StageBase(SerialDevice):
+    """Marlin XYZ stage without its widgets, shared by EnderMain and EnderMain_controller.
+
+    Keeps the commanded position (position_tracker), the active modal
+    settings (gcode_utils.ModalState) and the predicted end of the queued
+    moves (motion_model.MotionClock), and talks to the controller either
+    directly or through the asyncio driver (use_async, see async_stage).
+    """
+    def __init__(self, port, baud_rate=115200, parity=serial.PARITY_NONE,
+                 stop_bits=serial.STOPBITS_ONE, byte_size=serial.EIGHTBITS,
+                 connection=None, use_async=False):
+        super().__init__(port, baud_rate, parity, stop_bits, byte_size,
+                         connection=connection)
+        self.modal = ModalState()
+        # Ready before the driver can call check_response
+        self.logger = get_logger('stage')
+        self.ui_executor = None
+        if use_async:
+            # The driver owns the port from now on, see async_stage
+            self.driver = AsyncStage(self.serial)
+            self.driver.start_background()
+            self.ui_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="Stage-ui")
+        # Shared with the driver so that both see the same commanded position
+        self.tracker = self.driver.tracker if self.driver is not None else PositionTracker()
+        if self.driver is not None:
+            self.driver.listeners.append(self.check_response)
+        self.auto_report = False
+        self.motion = MotionModel()
+        self.motion_clock = MotionClock(self.motion)
+        self.jogger = JogCoalescer(self)
+
+    @property
+    def position(self):
+        """Commanded position, see position_tracker.
+
+        Until homing or a report has told us where the stage is, the first
+        read asks the controller (M114) instead of assuming X0 Y0 Z0.
+        """
+        if not self.tracker.known:
+            self.query_position()
+            if not self.tracker.known:
+                raise RuntimeError("Stage position unknown: home the stage or check the connection")
+        return self.tracker.commanded
+
+    @position.setter
+    def position(self, value):
+        self.tracker.commanded = value
+
+    def get_position(self, dict=False, debug=False, confirmed=False, real=False):
+        """Stage position as an (X, Y, Z) tuple, or a dict with dict=True.
+
+        Once homing or a report has told us where the stage is, the commanded
+        position is returned without a round-trip to the controller.
+        confirmed=True always asks the hardware (M114, or M114 R with real=True
+        for the position computed from the stepper counts).
+        """
+        if confirmed or not self.tracker.known:
+            positions = self.query_position(debug=debug, real=real)
+            if positions is None:
+                return
+        else:
+            if self.auto_report:
+                self.poll_reports()
+            positions = {axis.upper(): value for axis, value in self.tracker.commanded.items()}
+        if dict==False:
+            order = ['X','Y', 'Z']
+            positions = tuple([positions[field] for field in order])
+        return positions
+
+    @serialized
+    def query_position(self, debug=False, real=False):
+        """Blocking position query; the answer is also recorded by the tracker."""
+        code = G_CODES['real_position'] if real else G_CODES['current_position']
+        if self.streaming:
+            self.synchronize()
+        if self.driver is not None:
+            positions = self.driver.submit(self.driver.get_position(real=real)).result()
+            if debug:
+                self.log(positions)
+        else:
+            self.flush_serial_buffer()
+            response = self.write_code(code, check_ok=False)
+            if debug:
+                self.log(response)
+            ok = self.serial.readline()
+            positions = parse_position(response)
+            if positions is None or not ok.decode('utf-8').startswith("ok"):
+                self.log("Error reading stage position", logging.ERROR)
+                return
+        if self.tracker.diverged():
+            self.log(f"Stage position differs from the commanded one: {self.tracker.divergence()}", logging.WARNING)
+        return positions
+
+    def enable_position_report(self, interval=1.0):
+        """Have the controller report its position every `interval` seconds (M154, 0 disables)."""
+        self.write_code(f"M154 S{interval:g}")
+        self.auto_report = interval > 0
+
+    def poll_reports(self):
+        """Read position auto-reports waiting in the input buffer, without sending anything."""
+        if self.driver is not None or self.streaming:
+            # Lines are already consumed by the driver / the streaming reader
+            return
+        while self.serial.in_waiting > 0:
+            self.check_response(self.serial.readline().decode('utf-8'))
+
+    def log(self, message, level=logging.INFO):
+        """Log a message through ender_log."""
+        self.logger.log(level, message)
+
+    @serialized
+    def write_code(self, code, check_ok=True, debug=False):
+        self.modal.update(code)
+        if self.streaming:
+            if check_ok:
+                # Queued: the ok is collected later, see synchronize()
+                self.stream_code(code)
+                if debug:
+                    self.log(code)
+                return None
+            # The caller wants the response itself, drain the queue first
+            self.synchronize()
+        if self.driver is not None:
+            lines = self.driver.submit(self.driver.send(code)).result()
+            response = lines[0] if lines and not check_ok else "ok\n"
+            if debug:
+                self.log(f"{code}: {response.strip()}")
+            return response
+        stats = self.stats
+        if stats is not None:
+            sent = perf_counter()
+        super().write_code(code)
+        raw = self.serial.readline()
+        if stats is not None:
+            first_byte = perf_counter()
+            bytes_in, busy = len(raw), 0
+        response = raw.decode('utf-8')
+        self.check_response(response)
+        if check_ok:
+            while not response.startswith("ok"):
+                if debug:
+                    self.log(response.strip('\n'))
+                raw = self.serial.readline()
+                if stats is not None:
+                    bytes_in += len(raw)
+                    busy += 'busy:' in response
+                response = raw.decode('utf-8')
+                self.check_response(response)
+            if code.startswith(G_CODES['finish']):
+                # The ok of an M400 means the stage has stopped
+                self.motion_clock.stopped()
+        if stats is not None:
+            stats.record(code, sent, first_byte, perf_counter(), len(code) + 1, bytes_in, busy)
+        if debug:
+            self.log(f"{code}: {response.strip()}")
+        return response
+
+    def read_response(self):
+        response = super().read_response()
+        self.check_response(response)
+        return response
+
+    @serialized
+    def query(self, code):
+        """Send a command and return every line the controller printed before its ok."""
+        if self.streaming:
+            self.synchronize()
+        self.modal.update(code)
+        if self.driver is not None:
+            return self.driver.submit(self.driver.send(code)).result()
+        SerialDevice.write_code(self, code)
+        lines = []
+        response = self.serial.readline().decode('utf-8')
+        while not response.startswith("ok"):
+            self.check_response(response)
+            lines.append(response.strip())
+            response = self.serial.readline().decode('utf-8')
+        return lines
+
+    def synchronize(self, wait_for_moves=False):
+        super().synchronize(wait_for_moves)
+        if wait_for_moves:
+            self.motion_clock.stopped()
+
+    def read_motion_settings(self):
+        """Load the motion model limits from the controller settings (M503)."""
+        self.motion.update_from_settings("\n".join(self.query('M503')))
+        return self.motion
+
+    def queue_motion(self, delta):
+        """Account for a move the controller has just queued, see motion_model.MotionClock."""
+        feedrate = self.modal.get('feedrate')
+        self.motion_clock.queue(delta, None if feedrate is None else feedrate / 60)
+
+    def wait_until_settled(self):
+        """Sleep until the queued moves are predicted to be finished and settled."""
+        self.motion_clock.wait()
+
+    def home_from_ui(self):
+        """Home button: forget pending jogs, then home off the kernel thread when possible."""
+        self.jogger.cancel()
+        self.in_background(self.home)
+
+    def run_async(self, coro):
+        """Run a driver coroutine on its loop; the result can be awaited from a notebook cell."""
+        return asyncio.wrap_future(self.driver.submit(coro))
+
+    def in_background(self, function, *args):
+        """Run a blocking stage call off the kernel thread when the async driver is in use.
+
+        Calls are executed one at a time, in the order they were made.
+        """
+        if self.ui_executor is None:
+            return function(*args)
+        return self.ui_executor.submit(function, *args)
+
+    def check_response(self, response):
+        """Record position reports; forget cached state on controller errors or resets."""
+        if self.tracker.feed(response):
+            return
+        if response.startswith(('Error', 'start')):
+            self.modal.invalidate()
+            self.log(f"Controller state reset: {response.strip()}", logging.WARNING)
+        if response.startswith('start'):
+            self.tracker.invalidate()
+
+    def reconnect(self):
+        super().reconnect()
+        self.modal.invalidate()
+        self.log("Reconnected to stage")
+
+    def set_modal(self, key, value, debug=False):
+        """Switch a modal setting, skipping the round-trip when it is already active."""
+        if self.modal.is_set(key, value):
+            return
+        self.write_code(MODAL_CODES[key][value], debug=debug)
+
+    def set_relative(self, debug=False):
+        self.set_modal('positioning', 'relative', debug=debug)
+
+    def set_absolute(self, debug=False):
+        self.set_modal('positioning', 'absolute', debug=debug)
+
+    def set_units(self, units='mm', debug=False):
+        self.set_modal('units', units, debug=debug)
+
+    def feedrate_word(self, feedrate):
+        """' F<feedrate>' for a move, or '' when the controller already uses that feedrate."""
+        if feedrate is None or self.modal.is_set('feedrate', float(feedrate)):
+            return ""
+        return f" F {feedrate}"
+
+    @serialized
+    def move_absolute(self, x, y, z=None, feedrate=None, debug=False):
+        self.set_absolute(debug=debug)
+        if z is None:
+            code = f"G0 X {x} Y {y}"
+        else:
+            code = f"G0 X {x} Y {y} Z {z}"
+        code += self.feedrate_word(feedrate)
+        start = dict(self.position)
+        self.write_code(code, debug=debug)
+        self.queue_motion({'x': x - start['x'], 'y': y - start['y'],
+                           'z': 0.0 if z is None else z - start['z']})
+        self.tracker.move_absolute(x, y, z)
+
+    @serialized
+    def move_relative(self, x, y, z=None, feedrate=None, debug=False):
+        self.set_relative(debug=debug)
+        if z is None:
+            code = f"G0 X {x} Y {y}"
+        else:
+            code = f"G0 X {x} Y {y} Z {z}"
+        code += self.feedrate_word(feedrate)
+        self.write_code(code, debug=debug)
+        self.queue_motion((x, y, z))
+        self.tracker.move_relative(x, y, z)
+
+    def iter_path(self, points, mode='absolute', sync_every=None, feedrate=None, window=8):
+        """Generator version of move_path(), yielding (index, point) at each sync point."""
+        return iter_path(self, points, mode=mode, sync_every=sync_every,
+                         feedrate=feedrate, window=window)
+
+    def move_path(self, points, mode='absolute', sync_every=None, callback=None,
+                  feedrate=None, window=8):
+        """Move through a list (or NumPy array) of XY/XYZ targets as one streamed batch.
+
+        An M400 is queued every `sync_every` waypoints and callback(index, point)
+        is called once the stage has stopped there, e.g. to take a capture.
+        """
+        for index, point in self.iter_path(points, mode=mode, sync_every=sync_every,
+                                           feedrate=feedrate, window=window):
+            if callback is not None:
+                callback(index, point)
+
+    @serialized
+    def home(self, debug=False):
+        self.write_code(G_CODES['homing'], debug=debug)
+        self.modal.invalidate()
+        self.motion_clock.stopped()
+        self.tracker.home()
@@ -0,0 +1,98 @@
+"""Batched trajectories for Stage.move_path().
+
+A path is a sequence of XY or XYZ targets (list of tuples, position dicts
+or a NumPy array of shape (N, 2) or (N, 3)). The moves are streamed to
+Marlin in one go; the stage only waits for an M400 every `sync_every`
+waypoints, which is where captures can be attached.
+"""
+
+
+def as_points(points):
+    """Normalise path targets to a list of (x, y, z) tuples, z being None when not given."""
+    if hasattr(points, 'tolist'):
+        # NumPy array
+        points = points.tolist()
+    normalised = []
+    for point in points:
+        if isinstance(point, dict):
+            point = (point.get('x', point.get('X')), point.get('y', point.get('Y')),
+                     point.get('z', point.get('Z')))
+        if len(point) == 2:
+            x, y = point
+            z = None
+        elif len(point) == 3:
+            x, y, z = point
+        else:
+            raise ValueError(f"Expected XY or XYZ targets, got {point!r}")
+        normalised.append((float(x), float(y), None if z is None else float(z)))
+    return normalised
+
+
+def current_position(stage):
+    """Where the stage is, as {'x', 'y', 'z'}.
+
+    Uses Stage.get_position, which asks the controller (M114) while the
+    position is not known yet; stages without it (simulations) give their
+    position attribute.
+    """
+    if not hasattr(stage, 'get_position'):
+        return dict(stage.position)
+    position = stage.get_position(dict=True)
+    if position is None:
+        raise RuntimeError("Could not read the stage position")
+    return {axis: float(position[axis.upper()]) for axis in ('x', 'y', 'z')}
+
+
+def move_code(x, y, z=None):
+    if z is None:
+        return f"G0 X {x} Y {y}"
+    return f"G0 X {x} Y {y} Z {z}"
+
+
+def iter_path(stage, points, mode='absolute', sync_every=None, feedrate=None, window=8):
+    """Stream a path on `stage` and yield (index, point) at every synchronisation point.
+
+    :param mode: 'absolute' targets or 'relative' displacements
+    :param sync_every: wait for the stage to stop (M400) after every n waypoints;
+        None only waits once at the end of the path
+    :param window: number of commands kept in flight while streaming
+
+    The yielded waypoint has been reached and the stage is stationary until
+    the generator is resumed, so a capture can be taken in the loop body.
+    """
+    if mode not in ('absolute', 'relative'):
+        raise ValueError(f"Unknown path mode: {mode}")
+    points = as_points(points)
+    if not points:
+        return
+    sync_every = len(points) if sync_every is None else max(1, int(sync_every))
+
+    # Resolve an unknown position (M114) before the batch is queued
+    stage.position
+    was_streaming = stage.streaming
+    if not was_streaming:
+        stage.start_streaming(window=window)
+    try:
+        if mode == 'absolute':
+            stage.set_absolute()
+        else:
+            stage.set_relative()
+        for index, (x, y, z) in enumerate(points):
+            code = move_code(x, y, z)
+            if index == 0:
+                code += stage.feedrate_word(feedrate)
+            stage.write_code(code)
+            if mode == 'absolute':
+                stage.position = {'x': x, 'y': y, 'z': stage.position['z'] if z is None else z}
+            else:
+                stage.position['x'] += x
+                stage.position['y'] += y
+                if z is not None:
+                    stage.position['z'] += z
+
+            if (index + 1) % sync_every == 0 or index == len(points) - 1:
+                stage.synchronize(wait_for_moves=True)
+                yield index, points[index]
+    finally:
+        if not was_streaming:
+            stage.stop_streaming()
@@ -0,0 +1,237 @@
+"""Mosaic acquisition overlapping motion, exposure and processing.
+
+A serial mosaic loop moves, waits, captures, corrects, saves, and only then
+moves on: the stage stands still while the image is written, the camera
+idles while the stage moves. TilePipeline issues the move to tile N+1 as
+soon as the exposure of tile N has ended; tile N is corrected (flat field,
+see flat_field()) on worker threads and written by a
+frame_writer.FrameWriter in the meantime. Frames come from the camera's
+FramePool, so a slow disk throttles the loop instead of filling the memory.
+
+    pipeline = TilePipeline(stage, camera.core, writer, correct=flat_field(flat))
+    report = pipeline.run(tiles, "mosaic/tile")
+
+The report gives the fraction of the run each stage was busy (occupancy):
+the one closest to 1 is the bottleneck, motion, exposure or I/O.
+
+    python tile_pipeline.py
+
+compares the serial and pipelined loops on a simulated stage and camera.
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from autofocus import wait_for_moves
+from ender_log import get_logger
+from frame_pool import FramePool
+from motion_model import MotionModel
+
+logger = get_logger('tile_pipeline')
+
+STAGES = ('motion', 'focus', 'exposure', 'processing', 'io', 'stalled')
+
+
+def flat_field(flat, dark=None):
+    """Correction dividing the images by a normalised flat field (an image of an empty field).
+
+    :param flat: (H, W, 3) RGB or (H, W) image
+    :param dark: image taken with the light off, subtracted from both
+    :returns: a function uint8 image -> corrected uint8 image, accepting
+        green-only (H, W) images (Frame.green()) with an RGB flat field
+    """
+    dark = np.zeros_like(flat, dtype=np.float32) if dark is None else dark.astype(np.float32)
+    signal = flat.astype(np.float32) - dark
+    gain = signal.mean(axis=(0, 1)) / np.maximum(signal, 1.0)
+    tables = {gain.ndim: (dark, gain)}
+    if gain.ndim == 3:
+        tables[2] = (dark[..., 1], gain[..., 1])
+
+    def correct(image):
+        image_dark, image_gain = tables[image.ndim]
+        corrected = (image.astype(np.float32) - image_dark) * image_gain
+        return np.clip(corrected, 0, 255).astype(np.uint8)
+    return correct
+
+
+class Occupancy:
+    """Busy time of each stage of the pipeline, added from any thread."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.busy = dict.fromkeys(STAGES, 0.0)
+
+    def add(self, stage, seconds):
+        with self.lock:
+            self.busy[stage] += seconds
+
+    def fractions(self, elapsed, lanes):
+        """Busy time over run time, divided by the number of threads of each stage."""
+        return {stage: busy / (elapsed * lanes.get(stage, 1)) if elapsed else 0.0
+                for stage, busy in self.busy.items()}
+
+
+class TilePipeline:
+    def __init__(self, stage, camera, writer, correct=None, focus=None, workers=2, settle_time=None,
+                 green=False):
+        """
+        :param camera: EnderPiCamCore, or anything with capture_frame(after=...)
+        :param writer: frame_writer.FrameWriter
+        :param correct: function applied to each image before writing, e.g. flat_field(flat)
+        :param focus: called at each tile before the capture, e.g. EnderAcquisitionCore.focus_tile
+        :param workers: threads correcting images
+        :param settle_time: seconds of vibrations after the stop, default stage.motion.settle_time
+        """
+        self.stage = stage
+        self.camera = camera
+        self.writer = writer
+        self.correct = correct
+        self.focus = focus
+        self.workers = workers
+        self.settle_time = stage.motion.settle_time if settle_time is None else settle_time
+        self.green = green
+        self.last_report = None
+
+    def run(self, tiles, path, pipelined=True, extension='.tif'):
+        """Acquire tiles {'x', 'y'[, 'z']} in order, saved as `{path}_{n}{extension}`.
+
+        :param pipelined: False runs the serial loop, for comparison
+        :returns: report with tiles_per_min and the occupancy of each stage
+        """
+        occupancy = Occupancy()
+        # Bounded like the writer queue, the capture loop waits for the workers
+        slots = threading.BoundedSemaphore(2 * self.workers)
+        write_time = self.writer.write_time
+        start = time.monotonic()
+        with ThreadPoolExecutor(self.workers, thread_name_prefix="TilePipeline") as executor:
+            pending = []
+            self._move(tiles[0])
+            moving_since = start
+            for number, tile in enumerate(tiles):
+                wait_for_moves(self.stage)
+                stopped = time.monotonic()
+                occupancy.add('motion', stopped - moving_since)
+                if self.focus is not None:
+                    self.focus()
+                    occupancy.add('focus', time.monotonic() - stopped)
+                    stopped = time.monotonic()
+                frame = self.camera.capture_frame(after=stopped + self.settle_time)
+                exposed = time.monotonic()
+                occupancy.add('exposure', exposed - stopped)
+                following = tiles[number + 1] if number + 1 < len(tiles) else None
+                if pipelined and following is not None:
+                    # The sensor is done with this tile, the stage can leave
+                    self._move(following)
+                    moving_since = exposed
+                slots.acquire()
+                occupancy.add('stalled', time.monotonic() - exposed)
+                future = executor.submit(self._process, frame, f"{path}_{number}{extension}", occupancy)
+                future.add_done_callback(lambda _: slots.release())
+                pending.append(future)
+                if not pipelined:
+                    future.result().result()
+                    if following is not None:
+                        self._move(following)
+                        moving_since = time.monotonic()
+            for future in pending:
+                future.result()
+        self.writer.flush()
+        elapsed = time.monotonic() - start
+        occupancy.add('io', self.writer.write_time - write_time)
+        fractions = occupancy.fractions(elapsed, {'processing': self.workers, 'io': self.writer.workers})
+        self.last_report = {
+            'tiles': len(tiles),
+            'elapsed_s': elapsed,
+            'tiles_per_min': 60 * len(tiles) / elapsed if elapsed else 0.0,
+            'occupancy': fractions,
+            'bound': max(('motion', 'exposure', 'processing', 'io'), key=fractions.get),
+        }
+        logger.info(self.report_text())
+        return self.last_report
+
+    def _move(self, tile):
+        self.stage.move_absolute(tile['x'], tile['y'], tile.get('z'))
+
+    def _process(self, frame, path, occupancy):
+        """Correct a frame and queue it for writing; returns the Future of the write."""
+        start = time.monotonic()
+        if self.correct is None:
+            occupancy.add('processing', time.monotonic() - start)
+            if self.green:
+                return self.writer.submit(frame.green(), path, on_done=frame.release)
+            return self.writer.submit(frame.array, path, on_done=frame.release, channel_order='BGR')
+        image = frame.green() if self.green else frame.rgb()
+        try:
+            image = self.correct(image)
+        finally:
+            frame.release()
+        occupancy.add('processing', time.monotonic() - start)
+        return self.writer.submit(image, path)
+
+    def report_text(self):
+        report = self.last_report
+        if report is None:
+            return "No tile acquired"
+        busy = ", ".join(f"{stage} {fraction:.0%}" for stage, fraction in report['occupancy'].items())
+        return (f"{report['tiles']} tiles in {report['elapsed_s']:.1f} s, {report['tiles_per_min']:.1f} tiles/min, "
+                f"{report['bound']}-bound ({busy})")
+
+
+class SimulatedStage:
+    """XY(Z) stage without hardware, taking the time the motion model predicts."""
+    streaming = False
+
+    def __init__(self, motion=None):
+        self.motion = motion or MotionModel()
+        self.position = {'x': 0.0, 'y': 0.0, 'z': 0.0}
+        self.end = time.monotonic()
+
+    def move_absolute(self, x, y, z=None):
+        target = {'x': x, 'y': y, 'z': self.position['z'] if z is None else z}
+        delta = {axis: target[axis] - self.position[axis] for axis in target}
+        self.end = max(self.end, time.monotonic()) + self.motion.move_time(delta)
+        self.position = target
+
+    def write_code(self, code):
+        if code == 'M400':
+            time.sleep(max(0.0, self.end - time.monotonic()))
+
+
+class SimulatedCamera:
+    """Free-running sensor exposing one frame every `frame_time` seconds."""
+    def __init__(self, shape=(480, 640, 3), exposure=0.05, frame_time=None, pool_size=6, seed=0):
+        self.exposure = exposure
+        self.frame_time = frame_time or exposure
+        self.pool = FramePool(shape, np.uint8, pool_size)
+        self.rng = np.random.default_rng(seed)
+        self.epoch = time.monotonic()
+
+    def capture_frame(self, pool=None, stream='main', after=None):
+        frame = (pool or self.pool).acquire()
+        now = time.monotonic()
+        earliest = max(now if after is None else after, now) - self.epoch
+        # Next frame whose exposure starts after `earliest`
+        exposure_start = self.epoch + np.ceil(earliest / self.frame_time) * self.frame_time
+        time.sleep(max(0.0, exposure_start + self.exposure - time.monotonic()))
+        frame.array[...] = self.rng.integers(0, 255, frame.array.shape, np.uint8)
+        frame.metadata = {'SensorTimestamp': int(exposure_start * 1e9), 'ExposureTime': int(self.exposure * 1e6)}
+        return frame
+
+
+if __name__ == '__main__':
+    import tempfile
+
+    from frame_writer import FrameWriter
+
+    tiles = [{'x': 1.5 * column, 'y': 1.5 * row} for row in range(4) for column in range(5)]
+    # Full sensor frames saved as PNG, as on the Pi
+    shape = (1520, 2028, 3)
+    flat = np.full(shape, 200, np.uint8)
+    with tempfile.TemporaryDirectory() as directory:
+        for pipelined in (False, True):
+            with FrameWriter() as writer:
+                pipeline = TilePipeline(SimulatedStage(), SimulatedCamera(shape), writer,
+                                        correct=flat_field(flat))
+                pipeline.run(tiles, f"{directory}/tile", pipelined=pipelined, extension='.png')
+                print(f"{'pipelined' if pipelined else 'serial':10s} {pipeline.report_text()}")
@@ -0,0 +1,100 @@
+"""Z-stacks synchronised on the stage instead of fixed sleeps.
+
+Each slice is an absolute Z move followed by an M400 (stage_path.iter_path
+with sync_every=1): the capture starts as soon as the controller
+acknowledges that the stage has stopped. Instead of sleeping for the
+settling time, the camera drops the frames exposed before the stage has
+settled (`after`, see EnderPiCamCore.next_request). The move to the next
+slice is sent as soon as the frame is in memory, and the slice is written
+by a frame_writer.FrameWriter while the stage moves.
+
+As in the original ZStack, slice 0 is the top of the stack and stacks go
+from the top down. Over several positions the stacks are snaked: every
+other stack goes up instead, so the stage never rewinds Z between two
+positions. The slice numbers do not depend on the direction.
+
+    engine = ZStackEngine(stage, camera.core, writer)
+    engine.run_positions(positions, slices=21, step=0.002, path="stacks/well")
+"""
+import time
+
+from ender_log import get_logger
+from stage_path import current_position
+
+logger = get_logger('zstack')
+
+
+def slice_offsets(slices, step):
+    """Z offsets in mm of `slices` slices centred on 0, highest (slice 0) first."""
+    return [((slices - 1) / 2 - index) * step for index in range(slices)]
+
+
+class ZStackEngine:
+    def __init__(self, stage, camera, writer, settle_time=None, green=False):
+        """
+        :param camera: EnderPiCamCore
+        :param writer: frame_writer.FrameWriter receiving the slices
+        :param settle_time: seconds of vibrations after the stop, default stage.motion.settle_time
+        :param green: save the green channel only
+        """
+        self.stage = stage
+        self.camera = camera
+        self.writer = writer
+        self.settle_time = stage.motion.settle_time if settle_time is None else settle_time
+        self.green = green
+        self.slices_done = 0
+        self.motion_time = 0.0
+        self.capture_time = 0.0
+
+    def run(self, slices, step, path, center=None, descending=True, feedrate=None):
+        """Acquire one stack at the current XY, saved as `{path}_{slice}.tif`.
+
+        :param center: Z of the middle slice, default the current Z (read from the
+            controller if the stage position is not known yet)
+        :param descending: go from the top slice (slice 0) down, else from the bottom up
+        :returns: the Futures of the writes, in slice order (top first)
+        """
+        position = current_position(self.stage)
+        center = position['z'] if center is None else center
+        offsets = slice_offsets(slices, step)
+        indices = list(range(slices)) if descending else list(range(slices))[::-1]
+        points = [(position['x'], position['y'], center + offsets[index]) for index in indices]
+        futures = [None] * slices
+        moving_since = time.monotonic()
+        for index, _ in self.stage.iter_path(points, sync_every=1, feedrate=feedrate):
+            stopped = time.monotonic()
+            self.motion_time += stopped - moving_since
+            slice_index = indices[index]
+            futures[slice_index] = self.camera.capture(path=f"{path}_{slice_index}.tif", green=self.green,
+                                                       writer=self.writer, after=stopped + self.settle_time)
+            moving_since = time.monotonic()
+            self.capture_time += moving_since - stopped
+            self.slices_done += 1
+        self.writer.raise_errors()
+        return futures
+
+    def run_positions(self, positions, slices, step, path, snake=True, feedrate=None):
+        """One stack per position {'x', 'y', 'z'}, saved as `{path}_p{n}_{slice}.tif`.
+
+        With `snake`, odd positions are acquired from the bottom up, so each
+        stack starts next to where the previous one ended.
+        :returns: the Futures of every stack
+        """
+        futures = []
+        for number, position in enumerate(positions):
+            descending = not (snake and number % 2 == 1)
+            offsets = slice_offsets(slices, step)
+            first = position['z'] + (offsets[0] if descending else offsets[-1])
+            # Go straight to the first slice, the stack then only steps in Z
+            self.stage.move_absolute(position['x'], position['y'], first)
+            futures.append(self.run(slices, step, f"{path}_p{number}", center=position['z'],
+                                    descending=descending, feedrate=feedrate))
+        logger.info(self.report())
+        return futures
+
+    def report(self):
+        """Time spent moving and capturing, per slice."""
+        if not self.slices_done:
+            return "No slice acquired"
+        return (f"{self.slices_done} slices: {1000 * self.motion_time / self.slices_done:.0f} ms moving, "
+                f"{1000 * self.capture_time / self.slices_done:.0f} ms capturing per slice")